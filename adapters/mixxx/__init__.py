@@ -6,9 +6,10 @@ import logging
 import struct
 
 from .beats_pb2 import BeatGrid as BeatGridV2
-from udlf.marker import TimedMarker, Beatgrid, BeatgridRegion
+from udlf.marker import TimedMarker, Beatgrid, BeatgridRegion, MarkerSet
 from udlf.trackinfo import TrackInfo
 from udlf.utiltypes import Color
+from util.index import matcher_from_args
 
 logger = logging.getLogger(__name__)
 
@@ -62,6 +63,9 @@ CUE_MAIN = 2
 CUE_HOT = 1
 CUE_LOOP = 4
 
+""" UDL keys the adapter exchanges with its library; other keys are never loaded for it """
+KEYS = ('beatgrid', 'markers/cue', 'markers/loop', 'markers/hotcue')
+
 def setup_args(parser):
     parser.add_argument(
         '--mixxx-db',
@@ -70,14 +74,22 @@ def setup_args(parser):
         help="Override Mixxx database location"
     )
 
+""" Files whose changes mean the adapter's data may have changed. """
+def watch_paths(args): return [args.mixxx_db, pathlib.Path(f'{args.mixxx_db}-wal')]
+
 class Connection:
     def __init__(self, args): self.args = args
     def __enter__(self):
         logger.debug("Attempting to open connection to Mixxx DB")
         self.con = sqlite3.connect(self.args.mixxx_db)
+        self.matcher = matcher_from_args(self.args)
+        if not self.matcher is None: self.matcher.__enter__()
         return self
     def __exit__(self, exc_type, exc_value, exc_tb):
         logger.debug("Closing connection to Mixxx DB")
+        if not self.matcher is None: self.matcher.__exit__(exc_type, exc_value, exc_tb)
+    """ Writes out pending changes. The Mixxx adapter is read-only, so there are none. """
+    def flush(self): pass
     
     def read_cues(self, track_id, cuetype, samplerate, n_channels):
         cur = self.con.execute(
@@ -100,20 +112,39 @@ class Connection:
 
             yield (hotcue, marker) if cuetype == CUE_HOT else marker
                 
+    """ Paths of the tracks Mixxx knows below the library paths, at their current location if they were moved. """
+    def known_tracks(self, library):
+        sql = 'SELECT location FROM track_locations'
+        params = []
+        if self.matcher is None:
+            sql += ' WHERE ' + ' OR '.join('location LIKE ?' for p in library.paths)
+            params = [f'{p}%' for p in library.paths]
+        paths = [location for (location,) in self.con.execute(sql, params)]
+        if self.matcher is None: return paths
+        return [p if os.path.exists(p) else self.matcher.relocate(p) or p for p in paths]
+    
     def read_tracks(self, library):
         if not len(library.paths): return
         sql = \
             'SELECT library.id,track_locations.location,library.beats,library.beats_version,library.samplerate,library.channels,library.duration ' \
-            'FROM library INNER JOIN track_locations ON library.location = track_locations.id ' \
-            'WHERE '
-        sql += ' OR '.join('track_locations.location LIKE ?' for p in library.paths)
+            'FROM library INNER JOIN track_locations ON library.location = track_locations.id'
+        # An explicit track list can be far longer than SQLite's parameter limit, so it is
+        # filtered below instead
+        if library.tracks is None:
+            sql += ' WHERE ' + ' OR '.join('track_locations.location LIKE ?' for p in library.paths)
+            params = [f'{p}%' for p in library.paths]
+        else:
+            params = []
         sql += ';'
-        cur = self.con.execute(sql, [f'{p}%' for p in library.paths])
+        cur = self.con.execute(sql, params)
         while True:
             track = cur.fetchone()
             if track is None: return
             
             (track_id, location, beats, beats_ver, samplerate, n_channels, duration) = track
+            if not self.matcher is None and not os.path.exists(location):
+                location = self.matcher.relocate(location) or location
+            if (not library.tracks is None or not library.shard is None) and not location in library: continue
 
             ti = TrackInfo(location)
             
@@ -132,9 +163,7 @@ class Connection:
                 self.read_cues(track_id, CUE_LOOP, samplerate, n_channels),
                 f'Found more than one main loop in {location}'
             )
-            hotcues = {t[0]: t[1] for t in self.read_cues(track_id, CUE_HOT, samplerate, n_channels)}
-            cuerange = range(0, max(hotcues.keys())+1) if len(hotcues.keys()) else []
-            hotcues = [hotcues[i] if i in hotcues else None for i in cuerange]
+            hotcues = MarkerSet({t[0]: t[1] for t in self.read_cues(track_id, CUE_HOT, samplerate, n_channels)})
 
             if maincue: ti.setcuepoint(maincue)
             if mainloop: ti.setloops([mainloop])
@@ -0,0 +1,391 @@
+import os
+import re
+import json
+import mmap
+import sqlite3
+import pathlib
+import logging
+import xml.etree.ElementTree as ET
+from xml.parsers import expat
+from pyrekordbox.rbxml import RekordboxXml,Track,decode_path
+
+from util.info import NAME as APP_NAME,VERSION as APP_VER
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    tag_start INTEGER NOT NULL,
+    tag_end INTEGER NOT NULL,
+    close INTEGER,
+    entries INTEGER NOT NULL,
+    max_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    file TEXT NOT NULL,
+    path TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    attrib TEXT NOT NULL,
+    children TEXT,
+    PRIMARY KEY (file, path)
+);
+CREATE INDEX IF NOT EXISTS tracks_start ON tracks(file, start);
+'''
+
+""" Bytes handed to the parser at once while indexing """
+SCAN_CHUNK = 1 << 20
+
+def default_cache_path():
+    return pathlib.Path.home() / ".udltool" / "rekordbox-cache.sqlite"
+
+""" Matches a whole tag, skipping '>' inside quoted attribute values """
+TAG = re.compile(rb'<[^"\'>]*(?:(?:"[^"]*"|\'[^\']*\')[^"\'>]*)*>')
+ENTRIES = re.compile(rb'\sEntries\s*=\s*"[^"]*"')
+
+def tag_end(data, start): return TAG.match(data, start).end()
+
+""" Expat reports the end of an element at its end tag, or just after it for an empty element. """
+def is_end_tag(data, i): return data[i:i + 2] == b'</'
+
+def track_path(location): return os.path.normpath(decode_path(location))
+
+"""
+    Attributes of the children of a TRACK element (TEMPO and POSITION_MARK) as a list of
+    [tag, attributes], or None if the element holds anything else (text or deeper nesting) and
+    has to be read from the XML itself.
+"""
+def track_children(el):
+    children = []
+    for child in el:
+        if len(child) or (child.text or '').strip(): return None
+        children.append([child.tag, dict(child.attrib)])
+    if (el.text or '').strip(): return None
+    return children
+
+"""
+    Streams through a Rekordbox XML without building a tree. Returns the collection's
+    (tag start, tag end, offset of the end tag or None for an empty `<COLLECTION />`) and a row of
+    (path, start, end, attributes, children) for every track, with byte offsets into `data`.
+"""
+def scan(data):
+    parser = expat.ParserCreate()
+    stack = []
+    collection = {}
+    tracks = []
+    current = None
+    def start_element(name, attrib):
+        nonlocal current
+        stack.append(name)
+        if len(stack) == 2 and name == 'COLLECTION':
+            collection['start'] = parser.CurrentByteIndex
+        elif len(stack) == 3 and name == 'TRACK' and stack[1] == 'COLLECTION':
+            current = [parser.CurrentByteIndex, attrib, []]
+        elif not current is None:
+            if len(stack) == 4 and not current[2] is None: current[2].append([name, attrib])
+            else: current[2] = None
+    def end_element(name):
+        nonlocal current
+        depth = len(stack)
+        stack.pop()
+        if depth == 3 and not current is None:
+            (start, attrib, children) = current
+            location = attrib.get('Location')
+            if not location is None:
+                i = parser.CurrentByteIndex
+                tracks.append((track_path(location), start, tag_end(data, i) if is_end_tag(data, i) else i, attrib, children))
+            current = None
+        elif depth == 2 and name == 'COLLECTION':
+            i = parser.CurrentByteIndex
+            collection['close'] = i if is_end_tag(data, i) else None
+    def character_data(text):
+        if not current is None and len(stack) > 3 and text.strip(): current[2] = None
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    for i in range(0, len(data), SCAN_CHUNK):
+        parser.Parse(data[i:i + SCAN_CHUNK], False)
+    parser.Parse(b'', True)
+    if not 'start' in collection: raise ValueError('Rekordbox XML has no collection')
+    return ((collection['start'], tag_end(data, collection['start']), collection['close']), tracks)
+
+def serialize(el):
+    el.tail = None
+    ET.indent(el, space='\t', level=2)
+    return ET.tostring(el, encoding='unicode').encode('utf-8')
+
+""" Raised when the XML to write was changed by someone else since it was read """
+class XmlChangedError(Exception): pass
+
+"""
+    A Rekordbox XML that is only parsed in full when it changed since the last run. A pre-parsed
+    form (byte offsets, attributes, tempos and position marks of every track) is kept in an
+    SQLite cache keyed by the XML's path, size and mtime, so single tracks are looked up without
+    reading the XML at all. Saving copies the XML, splicing in the changed tracks, and moves the
+    cached offsets along instead of indexing the result again.
+"""
+class CachedXml:
+    def __init__(self, xmlpath, cache_path = None):
+        self.xmlpath = xmlpath
+        self.cache_path = cache_path
+        self.tracks = {} # Path the track was looked up by -> Track
+        self.changed = set() # Paths of existing tracks to write out
+        self.new = {} # Path -> Track not in the XML yet
+    def __enter__(self):
+        if self.cache_path is None:
+            self.con = sqlite3.connect(':memory:')
+        else:
+            pathlib.Path(self.cache_path).parent.mkdir(parents=True, exist_ok=True)
+            self.con = sqlite3.connect(self.cache_path)
+        self.con.executescript(SCHEMA)
+        self.data = None
+        self.open()
+        return self
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close_data()
+        self.con.close()
+
+    def close_data(self):
+        if isinstance(self.data, mmap.mmap): self.data.close()
+        self.data = None
+
+    """ Maps the XML and makes sure the cache describes it, indexing it if it doesn't. """
+    def open(self):
+        self.close_data()
+        try:
+            with open(self.xmlpath, 'rb') as f:
+                st = os.fstat(f.fileno())
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.stamp = (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            self.data = RekordboxXml(name=APP_NAME + '-pyrekordbox', version=APP_VER).tostring().encode('utf-8')
+            self.stamp = None
+        row = self.con.execute(
+            'SELECT size, mtime, tag_start, tag_end, close, entries, max_id FROM files WHERE path = ?',
+            (self.xmlpath,)
+        ).fetchone()
+        if not row is None and not self.stamp is None and row[:2] == self.stamp:
+            logger.debug(f'Using cached index of {self.xmlpath}')
+            (self.collection, self.entries, self.max_id) = (row[2:5], row[5], row[6])
+            return
+        logger.info(f'Indexing {self.xmlpath}')
+        (self.collection, rows) = scan(self.data)
+        self.entries = len(rows)
+        self.max_id = max((int(r[3].get('TrackID', 0)) for r in rows), default=0)
+        self.con.execute('DELETE FROM tracks WHERE file = ?', (self.xmlpath,))
+        self.con.executemany(
+            'INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)',
+            ((self.xmlpath, p, s, e, json.dumps(a), None if c is None else json.dumps(c)) for (p, s, e, a, c) in rows)
+        )
+        self.store_file()
+        logger.debug(f'Indexed {len(rows)} tracks')
+
+    def store_file(self):
+        if self.stamp is None:
+            self.con.execute('DELETE FROM files WHERE path = ?', (self.xmlpath,))
+        else:
+            self.con.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.xmlpath, *self.stamp, *self.collection, self.entries, self.max_id)
+            )
+        self.con.commit()
+
+    def row(self, path):
+        return self.con.execute(
+            'SELECT start, end, attrib, children FROM tracks WHERE file = ? AND path = ?', (self.xmlpath, path)
+        ).fetchone()
+
+    """ Returns the track at `location`, or None if it isn't in the XML. """
+    def get_track(self, location):
+        path = os.path.normpath(location)
+        if path in self.tracks: return self.tracks[path]
+        if path in self.new: return self.new[path]
+        row = self.row(path)
+        if row is None: return None
+        (start, end, attrib, children) = row
+        if children is None:
+            el = ET.fromstring(self.data[start:end])
+        else:
+            el = ET.Element('TRACK', json.loads(attrib))
+            for (tag, child_attrib) in json.loads(children): ET.SubElement(el, tag, child_attrib)
+        self.tracks[path] = Track(element=el)
+        return self.tracks[path]
+
+    """ Paths of all tracks in the XML, including added ones """
+    def paths(self):
+        rows = self.con.execute('SELECT path FROM tracks WHERE file = ?', (self.xmlpath,))
+        return [p for (p,) in rows] + list(self.new)
+    """ Marks the track looked up by `location` to be written on `save`, even if it was moved since. """
+    def set_changed(self, location): self.changed.add(os.path.normpath(location))
+
+    def add_track(self, location):
+        path = os.path.normpath(location)
+        track = Track(element=ET.Element('TRACK'))
+        track['Location'] = location
+        track._element.set('TrackID', str(self.max_id + len(self.new) + 1))
+        self.new[path] = track
+        return track
+
+    def dirty(self): return len(self.changed) or len(self.new)
+
+    """
+        Writes pending changes to the XML. Callers hold the XML's write lock. Raises
+        XmlChangedError if the XML changed since it was opened.
+    """
+    def save(self):
+        if not self.dirty(): return
+        try:
+            st = os.stat(self.xmlpath)
+            current = (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            current = None
+        if current != self.stamp:
+            # The changes were made to the tracks as they were before; writing them would undo
+            # whatever was written to the same tracks in between
+            raise XmlChangedError(f'{self.xmlpath} was written by someone else since it was read; Run again to use the new version')
+
+        edits = [] # (start, end, replacement, path of the track, 'tag' or 'close')
+        new = list(self.new.items())
+        for path in self.changed:
+            row = self.row(path)
+            if row is None: new.append((path, self.tracks[path]))
+            else: edits.append((row[0], row[1], serialize(self.tracks[path]._element), path))
+        for (i, (_, track)) in enumerate(new):
+            track._element.set('TrackID', str(self.max_id + i + 1))
+        pieces = [b'\t' + serialize(t._element) + b'\n\t' for (_, t) in new]
+        added = b''.join(pieces)
+
+        (tag_start, tag_end, close) = self.collection
+        entries = self.entries + len(new)
+        tag = ENTRIES.sub(b' Entries="%d"' % entries, self.data[tag_start:tag_end])
+        if close is None:
+            tag = re.sub(rb'\s*/>$', b'>', tag)
+            edits.append((tag_start, tag_end, tag + b'\n\t' + added + b'</COLLECTION>', 'tag'))
+        else:
+            edits.append((tag_start, tag_end, tag, 'tag'))
+            edits.append((close, close, added, 'close'))
+        edits.sort(key=lambda e: (e[0], e[1]))
+
+        tmp = self.xmlpath + '.tmp'
+        ranges = {} # Key of an edit -> its (start, end) in the new XML
+        segments = [] # Unchanged (start, end, shift)
+        (pos, shift) = (0, 0)
+        with open(tmp, 'wb') as out:
+            for (start, end, replacement, key) in edits:
+                out.write(self.data[pos:start])
+                segments.append((pos, start, shift))
+                ranges[key] = (start + shift, start + shift + len(replacement))
+                out.write(replacement)
+                shift += len(replacement) - (end - start)
+                pos = end
+            out.write(self.data[pos:])
+            segments.append((pos, len(self.data), shift))
+        self.close_data()
+        os.replace(tmp, self.xmlpath)
+
+        # Moves the cached offsets of untouched tracks; negated in between so no row is moved twice
+        for (start, end, shift) in segments:
+            if shift == 0 or start == end: continue
+            self.con.execute(
+                'UPDATE tracks SET start = -1 - (start + ?), end = end + ? WHERE file = ? AND start >= ? AND start < ?',
+                (shift, shift, self.xmlpath, start, end)
+            )
+        self.con.execute('UPDATE tracks SET start = -1 - start WHERE file = ? AND start < 0', (self.xmlpath,))
+        for path in self.changed:
+            self.con.execute('DELETE FROM tracks WHERE file = ? AND path = ?', (self.xmlpath, path))
+        rows = [(*ranges[path], self.tracks[path]) for path in self.changed if path in ranges]
+        pos = ranges['tag'][0] + len(tag) + 2 if close is None else ranges['close'][0]
+        for ((_, track), piece) in zip(new, pieces):
+            rows.append((pos + 1, pos + len(piece) - 2, track))
+            pos += len(piece)
+        tracks = {}
+        for (start, end, track) in rows:
+            el = track._element
+            children = track_children(el)
+            path = track_path(el.get('Location'))
+            tracks[path] = track
+            self.con.execute(
+                'INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)',
+                (self.xmlpath, path, start, end, json.dumps(dict(el.attrib)), None if children is None else json.dumps(children))
+            )
+
+        if close is None:
+            self.collection = (tag_start, tag_start + len(tag), ranges['tag'][1] - len(b'</COLLECTION>'))
+        else:
+            self.collection = (ranges['tag'][0], ranges['tag'][1], ranges['close'][1])
+        (self.entries, self.max_id) = (entries, self.max_id + len(new))
+        for path in self.changed: del self.tracks[path]
+        self.tracks.update(tracks)
+        (self.changed, self.new) = (set(), {})
+        with open(self.xmlpath, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.stamp = (st.st_size, st.st_mtime_ns)
+        self.store_file()
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+
+    def describe(el): return (dict(el.attrib), [(c.tag, dict(c.attrib)) for c in el])
+    def parsed(xmlpath):
+        xml = RekordboxXml(xmlpath)
+        return {track_path(el.get('Location')): describe(el) for el in xml._collection.findall('TRACK')}
+    def cached(xmlpath, cache_path):
+        with CachedXml(xmlpath, cache_path) as c:
+            return {p: describe(c.get_track(p)._element) for p in c.paths()}
+
+    with tempfile.TemporaryDirectory() as d:
+        (xmlpath, cache_path) = (os.path.join(d, 'rekordbox.xml'), os.path.join(d, 'cache.sqlite'))
+        xml = RekordboxXml(name=APP_NAME, version=APP_VER)
+        for (i, name) in enumerate(['a', 'b', 'c']):
+            track = xml.add_track(f'/music/{name}.mp3', TrackID=i + 1, Name=name.upper())
+            track.add_tempo(Inizio=0.1, Bpm=120.0, Metro='4/4', Battito=1)
+            track.add_mark(Name='Cue', Type='cue', Start=1.5, Num=0)
+        xml.save(xmlpath)
+        expected = parsed(xmlpath)
+        assert(cached(xmlpath, cache_path) == expected)
+
+        # Changed tracks are spliced in, new ones appended, and everything else is kept
+        with CachedXml(xmlpath, cache_path) as c:
+            c.get_track('/music/b.mp3')._element.set('Name', 'A much longer name than before')
+            c.set_changed('/music/b.mp3')
+            c.add_track('/music/d.mp3')._element.set('Name', 'D')
+            c.save()
+            assert(c.get_track('/music/c.mp3')._element.get('Name') == 'C')
+        result = parsed(xmlpath)
+        assert(sorted(result) == ['/music/a.mp3', '/music/b.mp3', '/music/c.mp3', '/music/d.mp3'])
+        assert(result['/music/a.mp3'] == expected['/music/a.mp3'])
+        assert(result['/music/c.mp3'] == expected['/music/c.mp3'])
+        assert(result['/music/b.mp3'][0]['Name'] == 'A much longer name than before')
+        assert(result['/music/b.mp3'][1] == expected['/music/b.mp3'][1])
+        assert(result['/music/d.mp3'][0]['TrackID'] == '4')
+        assert(RekordboxXml(xmlpath)._collection.get('Entries') == '4')
+        # The cached offsets were moved along rather than indexed again
+        assert(cached(xmlpath, cache_path) == result)
+
+        # Shrinking a track moves the ones after it the other way
+        with CachedXml(xmlpath, cache_path) as c:
+            c.get_track('/music/a.mp3')._element.set('Name', '')
+            c.set_changed('/music/a.mp3')
+            c.save()
+        result = parsed(xmlpath)
+        assert(result['/music/a.mp3'][0]['Name'] == '')
+        assert(cached(xmlpath, cache_path) == result)
+
+        # An XML written by someone else since it was read is not overwritten
+        with CachedXml(xmlpath, cache_path) as c:
+            c.get_track('/music/c.mp3')._element.set('Name', 'Lost')
+            c.set_changed('/music/c.mp3')
+            time.sleep(0.01)
+            with open(xmlpath, 'ab') as f: f.write(b'\n')
+            try:
+                c.save()
+                assert(False)
+            except XmlChangedError:
+                pass
+        assert(parsed(xmlpath)['/music/c.mp3'][0]['Name'] == 'C')
+        print('Splicing ok')
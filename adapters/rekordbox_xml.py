@@ -1,16 +1,21 @@
 import os
+import copy
 import sqlite3
 import pathlib
 import platform
 import logging
 import struct
-from pyrekordbox.rbxml import RekordboxXml
+from pyrekordbox.rbxml import RekordboxXml,decode_path
 
-from udlf.marker import TimedMarker, Beatgrid, BeatgridRegion
+from udlf.marker import TimedMarker, Beatgrid, BeatgridRegion, resolve_markers
 from udlf.trackinfo import TrackInfo
 from udlf.utiltypes import Color
 from util.library import CancellableUpdate
+from util.index import matcher_from_args
 from util.info import NAME as APP_NAME,VERSION as APP_VER
+from util.lock import file_lock
+from util.shard import shard_path
+from .rekordbox_cache import CachedXml,default_cache_path
 
 logger = logging.getLogger(__name__)
 
@@ -19,19 +24,42 @@ DESC = "Connects your Rekordbox (https://rekordbox.com/en/) library database to
         "This adapter works using the Rekordbox XML import method, which is the safest " \
         "method available and is the only officially supported method."
 
+""" UDL keys the adapter exchanges with its library; other keys are never loaded for it """
+KEYS = ('beatgrid', 'markers/cue', 'markers/loop', 'markers/hotcue')
+
 def setup_args(parser):
     parser.add_argument(
         '--rekordbox-xml',
         type=pathlib.Path,
         help="Rekordbox XML path"
     )
+    parser.add_argument(
+        '--rekordbox-cache',
+        type=pathlib.Path,
+        default=default_cache_path(),
+        help="Override the location of the cache of pre-parsed Rekordbox XML files"
+    )
+    parser.add_argument(
+        '--no-rekordbox-cache',
+        action='store_true',
+        help="Parse the Rekordbox XML on every run instead of caching it"
+    )
 
 def load_track_info(rk_track, udl_track): pass
 
+""" Removes position marks matching `pred` from the track, including their XML elements. """
+def remove_marks(rk_track, pred):
+    for mark in [mark for mark in rk_track.marks if pred(mark)]:
+        rk_track._element.remove(mark._element)
+        rk_track.marks.remove(mark)
+def remove_tempos(rk_track):
+    for tempo in rk_track.tempos: rk_track._element.remove(tempo._element)
+    rk_track.tempos = []
+
 def save_track_info(rk_track, udl_track):
     beatgrid = udl_track.getbeatgrid()
     if not beatgrid is None and len(beatgrid.regions):
-        rk_track.tempos = []
+        remove_tempos(rk_track)
         for (meta, el) in beatgrid.regions_meta():
             rk_track.add_tempo(
                 Inizio=meta.start,
@@ -40,40 +68,42 @@ def save_track_info(rk_track, udl_track):
                 Battito=meta.dbi+1
             )
     
+    # Resolve all markers against the beatgrid in one go
     maincue = udl_track.getcuepoint()
+    loops = udl_track.getloops()
+    loop = loops[0] if len(loops) else None
+    hotcues = udl_track.gethotcues()
+    (maincue_res, loop_res, *hotcues_res) = resolve_markers([maincue, loop, *hotcues], beatgrid)
+    
     if not maincue is None:
-        resolved = maincue.resolve(beatgrid)
-        if not resolved is None:
-            rk_track.marks = [mark for mark in rk_track.marks if mark.Type != 'cue']
+        if not maincue_res is None:
+            remove_marks(rk_track, lambda mark: mark.Type == 'load')
             rk_track.add_mark(
                 Name=maincue.name or '',
                 Type="load",
-                Start=resolved[0]
+                Start=maincue_res[0]
             )
         else:
             logger.debug('Could not resolve main cue')
     
-    loops = udl_track.getloops()
-    if len(loops) and not loops[0] is None:
-        resolved = loops[0].resolve(beatgrid)
-        if not resolved is None:
-            rk_track.marks = [mark for mark in rk_track.marks if mark.Type != 'loop']
+    if not loop is None:
+        if not loop_res is None:
+            remove_marks(rk_track, lambda mark: mark.Type == 'loop')
             rk_track.add_mark(
-                Name=loops[0].name or '',
+                Name=loop.name or '',
                 Type="loop",
-                Start=resolved[0],
-                End=resolved[1]
+                Start=loop_res[0],
+                End=loop_res[1]
             )
         else:
             logger.debug('Could not resolve loop')
     
-    hotcues = udl_track.gethotcues()
     for i in range(0, len(hotcues)):
         hotcue = hotcues[i]
         if hotcue is None: continue
-        resolved = hotcue.resolve(beatgrid)
+        resolved = hotcues_res[i]
         if not resolved is None:
-            rk_track.marks = [mark for mark in rk_track.marks if mark.Type != 'loop']
+            remove_marks(rk_track, lambda mark: mark.Num == i)
             rk_track.add_mark(
                 Name=hotcue.name or '',
                 Type="cue",
@@ -81,8 +111,70 @@ def save_track_info(rk_track, udl_track):
                 Num=i
             )
         else:
-            logger.debug(f'Could not resolve hotcue {i}')
+            logger.debug('Could not resolve hotcue %s', i)
+
+""" Files whose changes mean the adapter's data may have changed. """
+def watch_paths(args): return [args.rekordbox_xml] if args.rekordbox_xml else []
+
+""" Writers of the XML hold this lock; the XML itself may not exist yet. """
+def lock_path(xmlpath): return xmlpath + '.lock'
+
+""" Set on tracks in partial results that were moved, holding the encoded location they were moved from """
+PREVIOUS_LOCATION = 'UdlPreviousLocation'
+
+def open_xml(xmlpath):
+    try:
+        return RekordboxXml(xmlpath, name=APP_NAME + '-pyrekordbox', version=APP_VER)
+    except FileNotFoundError:
+        return RekordboxXml(name=APP_NAME + '-pyrekordbox', version=APP_VER)
+
+""" Replaces the contents of track element `el` with those of `source`, keeping its TrackID. """
+def replace_track_element(el, source):
+    track_id = el.get('TrackID')
+    el.attrib.clear()
+    el.attrib.update(source.attrib)
+    el.set('TrackID', track_id)
+    for child in list(el): el.remove(child)
+    for child in source: el.append(copy.deepcopy(child))
+
+"""
+    Combines the partial results written by `export --shard K/N` for all N shards into the XML.
+    Changed tracks replace the XML's copy, new tracks are added with fresh IDs, and everything
+    else in the XML (other tracks, playlists) is kept. The partial results are deleted afterwards.
+"""
+def merge_shards(args, n):
+    if not args.rekordbox_xml:
+        raise ValueError("Rekordbox XML file not specified. This isn't actually optional, that's just a limitation of argparse")
+    xmlpath = os.path.abspath(args.rekordbox_xml)
+    partials = [shard_path(xmlpath, (k, n)) for k in range(1, n + 1)]
+    missing = [p for p in partials if not os.path.exists(p)]
+    if len(missing): raise FileNotFoundError(f"Missing partial results {', '.join(missing)}")
+    with file_lock(lock_path(xmlpath), create=True):
+        xml = open_xml(xmlpath)
+        tracks = {el.get('Location'): el for el in xml._collection.findall('TRACK')}
+        last_id = max((int(el.get('TrackID', 0)) for el in tracks.values()), default=0)
+        count = 0
+        for partial in partials:
+            for source in RekordboxXml(partial)._collection.findall('TRACK'):
+                location = source.get('Location')
+                el = tracks.get(source.attrib.pop(PREVIOUS_LOCATION, location))
+                if el is None: el = tracks.get(location)
+                if el is None:
+                    last_id += 1
+                    el = xml.add_track(decode_path(location), TrackID=last_id)._element
+                replace_track_element(el, source)
+                tracks[location] = el
+                count += 1
+        xml.save(xmlpath)
+    for partial in partials: os.remove(partial)
+    logger.info(f'Merged {count} tracks from {n} shards into {xmlpath}')
 
+"""
+    The XML is accessed through the cache of `CachedXml`, so it is only parsed when it changed
+    since the last run. Without `--shard`, the XML is only written if nobody else wrote it since
+    it was read (see `CachedXml.save`). With `--shard`, only the tracks changed by this shard are
+    written, to a partial result next to the XML (see `merge_shards`).
+"""
 class Connection:
     def __init__(self, args): self.args = args
     def __enter__(self):
@@ -90,34 +182,79 @@ class Connection:
             raise ValueError("Rekordbox XML file not specified. This isn't actually optional, that's just a limitation of argparse")
         logger.debug("Attempting to open connection to the Rekordbox XML")
         self.xmlpath = os.path.abspath(self.args.rekordbox_xml)
-        try:
-            self.xml = RekordboxXml(self.xmlpath, name=APP_NAME + '-pyrekordbox', version=APP_VER)
-        except FileNotFoundError:
-            self.xml = RekordboxXml(name=APP_NAME + '-pyrekordbox', version=APP_VER)
+        cache_path = None if self.args.no_rekordbox_cache else os.path.abspath(self.args.rekordbox_cache)
+        self.xml = CachedXml(self.xmlpath, cache_path).__enter__()
+        self.matcher = matcher_from_args(self.args)
+        if not self.matcher is None: self.matcher.__enter__()
+        self.shard = getattr(self.args, 'shard', None)
+        self.changed = {} # Location -> (track element, location it was moved from)
+        self.dirty = False
         return self
     def __exit__(self, exc_type, exc_value, exc_tb):
         logger.debug("Closing connection to Rekordbox")
-        self.xml.save(self.xmlpath)
+        if not self.matcher is None: self.matcher.__exit__(exc_type, exc_value, exc_tb)
+        try:
+            self.flush()
+        finally:
+            self.xml.__exit__(exc_type, exc_value, exc_tb)
+    """ Writes out pending changes. """
+    def flush(self):
+        if self.shard is None:
+            if not self.dirty: return
+            with file_lock(lock_path(self.xmlpath), create=True):
+                self.xml.save()
+        else:
+            # Also written without changes, so merging can tell the shard ran
+            self.save_partial()
+        self.dirty = False
+    def save_partial(self):
+        partial = RekordboxXml(name=APP_NAME + '-pyrekordbox', version=APP_VER)
+        for (el, previous) in self.changed.values():
+            el = copy.deepcopy(el)
+            if not previous is None: el.set(PREVIOUS_LOCATION, previous)
+            partial._collection.append(el)
+        partial._collection.set('Entries', str(len(self.changed)))
+        path = shard_path(self.xmlpath, self.shard)
+        partial.save(path)
+        logger.debug(f'Wrote {len(self.changed)} tracks to {path}')
                 
     def read_tracks(self, library):
         if False: yield # TODO yes I'm that lazy
     
+    """ Paths of the tracks in the XML, at their current location if they were moved. """
+    def known_tracks(self, library):
+        paths = self.xml.paths()
+        if self.matcher is None: return paths
+        return [p if os.path.exists(p) else self.matcher.relocate(p) or p for p in paths]
+    
+    def find_track(self, track_path): return self.xml.get_track(f'{track_path}')
+    
     def open_track(self, track_path):
         track = TrackInfo(track_path)
-        try:
-            rk_track = self.xml.get_track(Location=f'{track_path}')
-        except TypeError:
-            rk_track = None
+        rk_track = self.find_track(track_path)
+        (found_at, moved_from) = (track_path, None)
+        if rk_track is None and not self.matcher is None:
+            # The track may have been moved since it was added to Rekordbox
+            for alias in self.matcher.aliases(track_path):
+                rk_track = self.find_track(alias)
+                if not rk_track is None:
+                    logger.info(f'Matched moved track {alias} to {track_path}')
+                    (found_at, moved_from) = (alias, rk_track._element.get('Location'))
+                    rk_track['Location'] = track_path
+                    break
         
         if not rk_track is None:
             load_track_info(rk_track, track)
 
         def on_complete(is_cancelled, _):
             if not is_cancelled:
-                save_track_info(
-                    self.xml.add_track(track_path) if rk_track is None else rk_track,
-                    track
-                )
+                self.dirty = True
+                target = self.xml.add_track(track_path) if rk_track is None else rk_track
+                save_track_info(target, track)
+                if not rk_track is None: self.xml.set_changed(found_at)
+                location = target._element.get('Location')
+                if not self.shard is None and not location in self.changed:
+                    self.changed[location] = (target._element, moved_from)
         
         return CancellableUpdate(track, on_complete)
         
@@ -0,0 +1,224 @@
+"""
+    Python API for loading, saving, importing and exporting many tracks per call, for programs
+    that would otherwise run `udltool.py` once per batch. Configuration is a plain `Config`, and
+    each function returns a `TrackResult` per track instead of logging and moving on.
+
+        from api import Config,Session
+        with Session(Config(library_paths=['/music'], adapters={'mixxx': {'mixxx_db': 'mixxx.sqlite'}})) as s:
+            for result in s.import_from('mixxx', mode='replace'): ...
+            results = s.load_many(['/music/a.mp3', '/music/b.mp3'])
+
+    A `Session` keeps the storage, adapter connections and worker processes open between calls;
+    the module-level functions open one for a single call.
+"""
+import os
+import argparse
+from typing import Any,Dict,List,Optional
+from dataclasses import dataclass,field
+
+from adapters import ADAPTERS
+from udlf.marker import Tolerance
+from udlf.trackinfo import TrackInfo,UnknownFormatError
+from util.library import Library,MergeOverwriteMode
+from util.storage import storage_from_args
+from util.prefetch import PREFETCH_WINDOW
+from util.index import matcher_cmdline_opt
+from util.supervise import FILE_MEMORY,FILE_TIMEOUT,Quarantine,Supervisor,WorkerFailed,load_track
+from util.writer import TagWriter
+from commands.cmd_import import import_outcome
+from commands.cmd_export import export_outcome
+
+""" Settings of a `Session`; the defaults match those of the command line """
+@dataclass
+class Config:
+    """ Library roots; defaults to the current directory """
+    library_paths: List[str] = field(default_factory=list)
+    """ 'id3' or 'sidecar' (see `util.storage`) """
+    storage: str = 'id3'
+    sidecar_db: Optional[str] = None
+    """ Tracks read ahead while loading (see `util.prefetch`) """
+    prefetch: int = PREFETCH_WINDOW
+    """ Tracks written at the same time (see `util.writer`) """
+    write_jobs: int = 4
+    fsync: bool = True
+    """ Parse and write tracks in supervised worker processes (see `util.supervise`) """
+    isolate: bool = False
+    isolate_jobs: int = os.cpu_count()
+    file_timeout: float = FILE_TIMEOUT
+    file_memory: int = FILE_MEMORY
+    """ Quarantine list to honour and add to, if any """
+    quarantine: Optional[str] = None
+    tolerance: Tolerance = field(default_factory=Tolerance)
+    """ Options of each adapter by their command line name without dashes, e.g. {'rekordbox-xml': {'rekordbox_xml': 'rb.xml'}} """
+    adapters: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+"""
+    Outcome of one track: 'loaded', 'saved', 'changed', 'planned', 'unchanged', 'missing',
+    'unknown-format', 'quarantined' or 'error'. `info` is the loaded track for `load_many` and
+    `save_many`, and `error` the exception behind a failure.
+"""
+@dataclass
+class TrackResult:
+    path: str
+    outcome: str
+    info: Optional[TrackInfo] = None
+    error: Optional[Exception] = None
+
+def outcome_of(e):
+    if isinstance(e, FileNotFoundError): return 'missing'
+    if isinstance(e, UnknownFormatError): return 'unknown-format'
+    if isinstance(e, WorkerFailed): return 'quarantined'
+    return 'error'
+
+""" Command line namespace of an adapter's options: their defaults, overridden by `options`. """
+def adapter_args(adapter, options):
+    parser = argparse.ArgumentParser()
+    ADAPTERS[adapter].setup_args(parser)
+    matcher_cmdline_opt(parser)
+    args = parser.parse_args([])
+    for (k, v) in options.items():
+        if not hasattr(args, k): raise ValueError(f"Unknown option '{k}' for adapter {adapter}")
+        setattr(args, k, v)
+    return args
+
+def merge_mode(mode): return MergeOverwriteMode[mode.upper()] if isinstance(mode, str) else mode
+
+class Session:
+    def __init__(self, config = None):
+        self.config = Config() if config is None else config
+    def __enter__(self):
+        c = self.config
+        quarantine = None if c.quarantine is None else Quarantine(c.quarantine)
+        self.library = Library(paths=c.library_paths, prefetch=c.prefetch, quarantine=quarantine)
+        self.library.storage = storage_from_args(c, self.library.paths, c.storage)
+        if c.isolate: self.library.supervisor = Supervisor(c.isolate_jobs, c.file_timeout, c.file_memory, quarantine)
+        self.library.storage.__enter__()
+        self.connections = {}
+        return self
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        try:
+            for con in self.connections.values(): con.__exit__(exc_type, exc_value, exc_tb)
+        finally:
+            self.library.storage.__exit__(exc_type, exc_value, exc_tb)
+            if not self.library.supervisor is None: self.library.supervisor.close()
+
+    """ The tracks `paths` of the library, or all of it if None """
+    def subset(self, paths = None):
+        return Library(
+            paths=self.library.paths, tracks=paths, storage=self.library.storage, prefetch=self.library.prefetch,
+            quarantine=self.library.quarantine, supervisor=self.library.supervisor
+        )
+    def connection(self, adapter):
+        if not adapter in ADAPTERS: raise ValueError(f'Unknown adapter {adapter}')
+        if not adapter in self.connections:
+            args = adapter_args(adapter, self.config.adapters.get(adapter, {}))
+            self.connections[adapter] = ADAPTERS[adapter].Connection(args).__enter__()
+        return self.connections[adapter]
+    def writer(self):
+        supervisor = self.library.supervisor if self.library.isolated() else None
+        return TagWriter(self.config.write_jobs, self.config.fsync, supervisor)
+
+    def load_results(self, library, lazy = False):
+        quarantined = [] if library.tracks is None else [p for p in library.tracks if library.quarantined(p)]
+        for p in quarantined: yield TrackResult(p, 'quarantined')
+        if library.isolated():
+            for (path, info, e) in library.supervisor.map(load_track, library.track_paths(), library.storage):
+                yield TrackResult(path, 'loaded', info) if e is None else TrackResult(path, outcome_of(e), error=e)
+            return
+        for (path, fileobj) in library.prefetched_track_paths():
+            try:
+                yield TrackResult(path, 'loaded', library.storage.load(path, fileobj, lazy))
+            except Exception as e:
+                yield TrackResult(path, outcome_of(e), error=e)
+            finally:
+                if not fileobj is None: fileobj.close()
+
+    """ Loads the tracks `paths` (all of the library if None). `lazy` is as for `TrackInfo.load`. """
+    def load_many(self, paths = None, lazy = False):
+        return list(self.load_results(self.subset(paths), lazy))
+
+    """ Saves the tracks `infos` through a background writer (see `util.writer`). """
+    def save_many(self, infos):
+        infos = list(infos)
+        with self.writer() as writer:
+            for info in infos: writer.submit(info)
+        results = []
+        for info in infos:
+            e = writer.results.get(info.track_location)
+            results.append(TrackResult(info.track_location, 'saved' if e is None else outcome_of(e), info, e))
+        return results
+
+    """
+        Imports the data of `adapter` into the tracks `paths` (all of the library if None). `mode`
+        is a `MergeOverwriteMode` or its name. Only tracks the adapter knows of get a result.
+    """
+    def import_from(self, adapter, paths = None, mode = MergeOverwriteMode.NEVER):
+        (library, con, mode) = (self.subset(paths), self.connection(adapter), merge_mode(mode))
+        results = []
+        with self.writer() as writer:
+            for info in con.read_tracks(library):
+                if library.quarantined(info.track_location):
+                    results.append(TrackResult(info.track_location, 'quarantined'))
+                    continue
+                (outcome, e) = import_outcome(
+                    library.storage, info, mode, self.config.tolerance, writer=writer, load=library.load
+                )
+                results.append(TrackResult(info.track_location, outcome if e is None else outcome_of(e), error=e))
+        for r in results:
+            e = writer.results.get(r.path) if r.outcome == 'changed' else None
+            if not e is None: (r.outcome, r.error) = (outcome_of(e), e)
+        return results
+
+    """
+        Exports the tracks `paths` (all of the library if None) to `adapter` and writes out its
+        changes. `mode` is a `MergeOverwriteMode` or its name. With `known_only`, only the tracks
+        the adapter already knows are read and exported, and no new ones are added.
+    """
+    def export_to(self, adapter, paths = None, mode = MergeOverwriteMode.NEVER, known_only = False):
+        (library, con, mode) = (self.subset(paths), self.connection(adapter), merge_mode(mode))
+        if known_only: library = library.restrict(con.known_tracks(library))
+        results = []
+        for r in self.load_results(library, lazy=True):
+            if r.info is None:
+                results.append(r)
+                continue
+            (outcome, e) = export_outcome(con, r.info, mode, self.config.tolerance, keys=ADAPTERS[adapter].KEYS)
+            results.append(TrackResult(r.path, outcome, error=e))
+        con.flush()
+        return results
+
+def load_many(paths, config = None, lazy = False):
+    with Session(config) as s: return s.load_many(paths, lazy)
+def save_many(infos, config = None):
+    with Session(config) as s: return s.save_many(infos)
+def import_from(adapter, paths = None, mode = MergeOverwriteMode.NEVER, config = None):
+    with Session(config) as s: return s.import_from(adapter, paths, mode)
+def export_to(adapter, paths = None, mode = MergeOverwriteMode.NEVER, config = None, known_only = False):
+    with Session(config) as s: return s.export_to(adapter, paths, mode, known_only)
+
+if __name__ == "__main__":
+    import tempfile
+    from udlf.marker import Beatgrid,BeatgridRegion
+
+    with tempfile.TemporaryDirectory() as d:
+        tracks = [os.path.join(d, name) for name in ('a.mp3', 'b.mp3')]
+        for path in tracks:
+            with open(path, 'wb') as f: f.write((b'\xff\xfb\x90\x64' + b'\x00' * 413) * 10)
+        xmlpath = os.path.join(d, 'rekordbox.xml')
+        config = Config(
+            library_paths=[d], fsync=False,
+            adapters={'rekordbox-xml': {'rekordbox_xml': xmlpath, 'no_rekordbox_cache': True}}
+        )
+        with Session(config) as s:
+            results = s.load_many(tracks + [os.path.join(d, 'missing.mp3'), os.path.join(d, 'c.txt')])
+            assert([r.outcome for r in results] == ['loaded', 'loaded', 'missing', 'unknown-format'])
+            for r in results[:2]: r.info.setbeatgrid(Beatgrid(0.5, [BeatgridRegion(60.0, 128.0)]))
+            assert([r.outcome for r in s.save_many(r.info for r in results[:2])] == ['saved', 'saved'])
+            assert(all(r.info.getbeatgrid().regions[0].bpm == 128.0 for r in s.load_many(tracks)))
+
+            # Nothing is known to a new XML, so only a full export adds the tracks
+            assert(s.export_to('rekordbox-xml', known_only=True) == [])
+            assert([r.outcome for r in s.export_to('rekordbox-xml')] == ['changed', 'changed'])
+            assert(sorted(r.path for r in s.export_to('rekordbox-xml', known_only=True)) == tracks)
+        assert(len(load_many(tracks, config)) == 2)
+        print('API ok')
@@ -1,6 +1,24 @@
 from . import cmd_import
 from . import cmd_export
+from . import cmd_index
+from . import cmd_query
+from . import cmd_sync
+from . import cmd_apply
+from . import cmd_watch
+from . import cmd_serve
+from . import cmd_snapshot
+from . import cmd_merge
+from . import cmd_verify
 COMMANDS = {
     'import': cmd_import,
-    'export': cmd_export
+    'export': cmd_export,
+    'index': cmd_index,
+    'query': cmd_query,
+    'sync': cmd_sync,
+    'apply': cmd_apply,
+    'watch': cmd_watch,
+    'serve': cmd_serve,
+    'snapshot': cmd_snapshot,
+    'merge': cmd_merge,
+    'verify': cmd_verify
 }
\ No newline at end of file
@@ -0,0 +1,91 @@
+import logging
+
+from adapters import ADAPTERS
+from util.plan import read_plan,is_stale,locality_key
+from util.storage import storage_from_args
+from util.writer import TagWriter,file_stamp
+from util.events import events
+from udlf.trackinfo import UnknownFormatError
+
+logger = logging.getLogger(__name__)
+
+def setup_args(parser):
+    parser.add_argument('plan', help="Plan file written by 'import' or 'export' with --plan")
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=8,
+        help="Number of tracks written in parallel (default 8)"
+    )
+    parser.add_argument(
+        '--no-fsync',
+        action='store_true',
+        help="Don't wait for written tracks to reach the disk"
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help="Also apply changes to tracks which were modified after the plan was made"
+    )
+    parser.add_argument(
+        '--sidecar-db',
+        metavar='FILE',
+        help="Sidecar database to use if the plan was made with '--sidecar-db'"
+    )
+    for (n,a) in ADAPTERS.items():
+        a.setup_args(parser.add_argument_group(f"{a.NAME} Adapter ('{n}')", a.DESC))
+
+def apply_to_storage(storage, entry, writer):
+    stamp = file_stamp(entry['path'])
+    info = storage.load(entry['path'])
+    info.applyraw(entry['changes'])
+    writer.submit(info, entry['changes'], stamp)
+
+def apply_import(args, header, entries):
+    storage = storage_from_args(args, header['library_paths'], header['storage'])
+    writer = TagWriter(args.jobs, sync=not args.no_fsync)
+    submitted = []
+    # The writer is left before the storage so its last saves still have the storage open
+    with storage, writer:
+        for entry in entries:
+            try:
+                apply_to_storage(storage, entry, writer)
+                submitted.append(entry['path'])
+            except FileNotFoundError:
+                logger.warning(f"Could not find {entry['path']}")
+                events.track(entry['path'], 'missing')
+            except UnknownFormatError:
+                logger.error(f"Unknown file format for {entry['path']}")
+                events.track(entry['path'], 'unknown-format')
+            except Exception as e:
+                logger.exception(f"Could not process track {entry['path']}")
+                events.track(entry['path'], 'error', error=str(e))
+    for path in submitted:
+        e = writer.results.get(path)
+        if e is None: events.track(path, 'changed')
+        else: events.track(path, 'error', error=str(e))
+
+def apply_export(args, header, entries):
+    with ADAPTERS[header['adapter']].Connection(args) as con:
+        for entry in entries:
+            try:
+                with con.open_track(entry['path']) as tosave_info:
+                    tosave_info.applyraw(entry['changes'])
+                    logger.info("Wrote to %s", entry['path'])
+            except Exception:
+                logger.exception(f"Could not process track {entry['path']}")
+
+def run(args, library):
+    (header, entries) = read_plan(args.plan)
+    
+    if not args.force:
+        fresh = []
+        for e in entries:
+            if is_stale(e): logger.warning(f"{e['path']} changed since the plan was made; Skipping...")
+            else: fresh.append(e)
+        entries = fresh
+    entries.sort(key=locality_key)
+    
+    if header['command'] == 'import': apply_import(args, header, entries)
+    elif header['command'] == 'export': apply_export(args, header, entries)
+    else: raise ValueError(f"Unknown plan command {header['command']}")
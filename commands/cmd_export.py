@@ -1,9 +1,16 @@
+import copy
 import logging
+from contextlib import nullcontext
 
 from adapters import ADAPTERS
-from util.library import library_cmdline_opt,MergeOverwriteMode
-from udlf.trackinfo import TrackInfo,UnknownFormatError
+from util.library import library_cmdline_opt,tolerance_cmdline_opt,tolerance_from_args,MergeOverwriteMode
+from util.library import merge_track_info
+from util.plan import PlanWriter,plan_cmdline_opt
+from util.index import matcher_cmdline_opt
+from util.shard import shard_cmdline_opt
+from udlf.trackinfo import UnknownFormatError
 from util.library import Cancel
+from util.events import events
 
 logger = logging.getLogger(__name__)
 
@@ -25,29 +32,70 @@ def setup_args(parser):
     for (n,a) in ADAPTERS.items():
         a.setup_args(parser.add_argument_group(f"{a.NAME} Adapter ('{n}')", a.DESC))
     
+    parser.add_argument(
+        '--known-only',
+        action='store_true',
+        help="Only export tracks the adapter already knows, which are looked up instead of " \
+            "searching and reading the whole library. New tracks are not added"
+    )
+    plan_cmdline_opt(parser)
+    tolerance_cmdline_opt(parser)
+    matcher_cmdline_opt(parser)
+    shard_cmdline_opt(parser)
     library_cmdline_opt(parser)
 
+""" Outcomes of `export_outcome` for which the track changed """
+CHANGED = ('changed', 'planned')
+
+"""
+    Merges the UDL data of `info` (read from the library) into the adapter's copy of the track, or
+    adds the changes to `plan` if given. Only `keys` (the adapter's `KEYS`) are merged if given.
+    Returns the outcome ('changed', 'planned', 'unchanged' or 'error') and the exception that
+    caused it, if any.
+"""
+def export_outcome(con, info, mode, tolerance, plan=None, keys=None):
+    (outcome, error) = ('error', None)
+    try:
+        with con.open_track(info.track_location) as tosave_info:
+            changes = merge_track_info(tosave_info, info, mode, tolerance, keys)
+
+            if not len(changes):
+                logger.debug('No changes made to %s; Skipping write...', info.track_location)
+                outcome = 'unchanged'
+                raise Cancel()
+            elif not plan is None:
+                plan.add(info.track_location, changes)
+                logger.debug('Planned changes to %s', info.track_location)
+                outcome = 'planned'
+                raise Cancel()
+            else:
+                logger.info('Wrote to %s', info.track_location)
+                outcome = 'changed'
+    except Exception as e:
+        logger.exception(f'Could not process track {info.track_location}')
+        (outcome, error) = ('error', e)
+    if outcome == 'error': events.track(info.track_location, outcome, error=str(error))
+    else: events.track(info.track_location, outcome)
+    return (outcome, error)
+
+""" Like `export_outcome`, but only returns whether the track changed. """
+def export_track(con, info, mode, tolerance, plan=None, keys=None):
+    return export_outcome(con, info, mode, tolerance, plan, keys)[0] in CHANGED
+
 def run(args, library):
     adapter = ADAPTERS[args.adapter]
     mode = MergeOverwriteMode[args.overwrite.upper()]
-    with adapter.Connection(args) as con:
+    tolerance = tolerance_from_args(args)
+    plan = PlanWriter(
+        args.plan, command='export', adapter=args.adapter,
+        storage=library.storage.NAME, library_paths=library.paths
+    ) if args.plan else None
+    # Keys the adapter doesn't use are never read
+    library = copy.copy(library)
+    library.lazy = True
+    with library.storage, adapter.Connection(args) as con, plan or nullcontext():
+        if args.known_only:
+            library = library.restrict(con.known_tracks(library))
+            logger.info('Exporting the %d library tracks known to %s', len(library.tracks), adapter.NAME)
         for info in library:
-            try:
-                with con.open_track(info.track_location) as tosave_info:
-                    # Keep a reference copy around
-                    _original_info = TrackInfo(info.track_location)
-                    _original_info.assign(tosave_info)
-
-                    if mode == MergeOverwriteMode.CLEAR:
-                        logger.debug(f'Clearing info on {info.track_location}')
-                        tosave_info.clear()
-                    
-                    tosave_info.assign(info, overwrite=mode == MergeOverwriteMode.REPLACE)
-
-                    if _original_info == tosave_info:
-                        logger.debug(f'No changes made to {info.track_location}; Skipping write...')
-                        raise Cancel()
-                    else:
-                        logger.info(f'Wrote to {info.track_location}')
-            except Exception as e:
-                logger.exception(f'Could not process track {info.track_location}')
+            export_track(con, info, mode, tolerance, plan, adapter.KEYS)
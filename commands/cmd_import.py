@@ -1,8 +1,16 @@
 import logging
+from contextlib import nullcontext
 
 from adapters import ADAPTERS
-from util.library import library_cmdline_opt,MergeOverwriteMode
-from udlf.trackinfo import TrackInfo,UnknownFormatError
+from util.library import library_cmdline_opt,tolerance_cmdline_opt,tolerance_from_args,MergeOverwriteMode
+from util.library import merge_track_info
+from util.plan import PlanWriter,plan_cmdline_opt
+from util.index import matcher_cmdline_opt
+from util.shard import shard_cmdline_opt
+from util.writer import TagWriter,writer_cmdline_opt,file_stamp
+from util.events import events
+from util.lock import track_lock
+from udlf.trackinfo import UnknownFormatError
 
 logger = logging.getLogger(__name__)
 
@@ -24,36 +32,80 @@ def setup_args(parser):
     for (n,a) in ADAPTERS.items():
         a.setup_args(parser.add_argument_group(f"{a.NAME} Adapter ('{n}')", a.DESC))
     
+    plan_cmdline_opt(parser)
+    tolerance_cmdline_opt(parser)
+    matcher_cmdline_opt(parser)
+    shard_cmdline_opt(parser)
+    writer_cmdline_opt(parser)
     library_cmdline_opt(parser)
 
+""" Outcomes of `import_outcome` for which the track changed """
+CHANGED = ('changed', 'planned')
+
+"""
+    Merges the UDL data of `info` (read from an adapter) into the track it belongs to and saves
+    it, or adds the changes to `plan` if given. The track's lock is held from loading it until it
+    is saved. With a `writer`, the changes are only submitted to it and written in the
+    background, under the lock as well. `load` loads the track instead of `storage.load` (see `Library.load`). Returns
+    the outcome ('changed', 'planned', 'unchanged', 'missing', 'unknown-format' or 'error') and
+    the exception that caused it, if any.
+"""
+def import_outcome(storage, info, mode, tolerance, plan=None, writer=None, load=None):
+    (outcome, error) = ('error', None)
+    try:
+        # Nobody else may write the track between loading and saving it
+        with track_lock(info.track_location) if storage.IN_FILE and plan is None else nullcontext():
+            stamp = None if writer is None else file_stamp(info.track_location)
+            tosave_info = (storage.load if load is None else load)(info.track_location)
+            changes = merge_track_info(tosave_info, info, mode, tolerance)
+
+            if not len(changes):
+                logger.debug('No changes made to %s; Skipping write...', info.track_location)
+                outcome = 'unchanged'
+            elif not plan is None:
+                plan.add(info.track_location, changes)
+                logger.debug('Planned changes to %s', info.track_location)
+                outcome = 'planned'
+            elif writer is None:
+                tosave_info.save()
+                logger.info('Wrote to %s', info.track_location)
+                outcome = 'changed'
+            else:
+                outcome = 'changed'
+        # The writer takes the lock itself, and loads the track again if it changed since `stamp`
+        if outcome == 'changed' and not writer is None: writer.submit(tosave_info, changes, stamp)
+    except FileNotFoundError as e:
+        # This is only a warning since Mixxx seems to leave deleted or moved files
+        # hanging around
+        logger.warn(f'Could not find {info.track_location}')
+        (outcome, error) = ('missing', e)
+    except UnknownFormatError as e:
+        logger.error(f'Unknown file format for {info.track_location}')
+        (outcome, error) = ('unknown-format', e)
+    except Exception as e:
+        logger.exception(f'Could not process track {info.track_location}')
+        error = e
+    if outcome == 'error': events.track(info.track_location, outcome, error=str(error))
+    else: events.track(info.track_location, outcome)
+    return (outcome, error)
+
+""" Like `import_outcome`, but only returns whether the track changed. """
+def import_track(storage, info, mode, tolerance, plan=None, writer=None, load=None):
+    return import_outcome(storage, info, mode, tolerance, plan, writer, load)[0] in CHANGED
+
 def run(args, library):
     adapter = ADAPTERS[args.adapter]
     mode = MergeOverwriteMode[args.overwrite.upper()]
-    with adapter.Connection(args) as con:
+    tolerance = tolerance_from_args(args)
+    plan = PlanWriter(
+        args.plan, command='import', adapter=args.adapter,
+        storage=library.storage.NAME, library_paths=library.paths
+    ) if args.plan else None
+    supervisor = library.supervisor if library.isolated() else None
+    writer = TagWriter(args.write_jobs, sync=not args.no_fsync, supervisor=supervisor)
+    # The writer is left before the storage so its last saves still have the storage open
+    with library.storage, adapter.Connection(args) as con, plan or nullcontext(), writer:
         for info in con.read_tracks(library):
-            try:
-                tosave_info = TrackInfo.load(info.track_location)
-
-                # Keep a reference copy around
-                _original_info = TrackInfo(info.track_location)
-                _original_info.assign(tosave_info)
-
-                if mode == MergeOverwriteMode.CLEAR:
-                    logger.debug(f'Clearing info on {info.track_location}')
-                    tosave_info.clear()
-                
-                tosave_info.assign(info, overwrite=mode == MergeOverwriteMode.REPLACE)
-
-                if _original_info == tosave_info:
-                    logger.debug(f'No changes made to {info.track_location}; Skipping write...')
-                else:
-                    tosave_info.save()
-                    logger.info(f'Wrote to {info.track_location}')
-            except FileNotFoundError:
-                # This is only a warning since Mixxx seems to leave deleted or moved files
-                # hanging around
-                logger.warn(f'Could not find {info.track_location}')
-            except UnknownFormatError:
-                logger.error(f'Unknown file format for {info.track_location}')
-            except Exception as e:
-                logger.exception(f'Could not process track {info.track_location}')
+            # Adapters are not required to filter by shard
+            if not library.in_shard(info.track_location) or library.quarantined(info.track_location): continue
+            import_track(library.storage, info, mode, tolerance, plan, writer, library.load)
@@ -0,0 +1,15 @@
+import logging
+
+from util.library import library_cmdline_opt
+from util.index import TagIndex,index_cmdline_opt
+
+logger = logging.getLogger(__name__)
+
+def setup_args(parser):
+    index_cmdline_opt(parser)
+    library_cmdline_opt(parser)
+
+def run(args, library):
+    with TagIndex(args.index) as index:
+        (updated, unchanged, removed) = index.update(library)
+    logger.info(f'Indexed {updated} tracks ({unchanged} unchanged, {removed} removed)')
@@ -0,0 +1,30 @@
+import logging
+
+from adapters import ADAPTERS
+
+logger = logging.getLogger(__name__)
+
+""" Adapters that write a single output file and therefore need their shards merged """
+MERGEABLE = {n: a for (n, a) in ADAPTERS.items() if hasattr(a, 'merge_shards')}
+
+def setup_args(parser):
+    parser.add_argument(
+        'adapter',
+        choices=MERGEABLE,
+        help="Adapter whose partial results to merge. See options below.",
+        metavar='adapter'
+    )
+    parser.add_argument(
+        '--shards',
+        type=int,
+        required=True,
+        metavar='N',
+        help="Number of shards the export was split into (the N of --shard K/N). All N partial " \
+            "results must exist"
+    )
+    for (n,a) in MERGEABLE.items():
+        a.setup_args(parser.add_argument_group(f"{a.NAME} Adapter ('{n}')", a.DESC))
+
+def run(args, library):
+    if args.shards < 1: raise ValueError('--shards must be at least 1')
+    MERGEABLE[args.adapter].merge_shards(args, args.shards)
@@ -0,0 +1,81 @@
+import sys
+import logging
+
+from util.library import library_cmdline_opt
+from util.index import TagIndex,index_cmdline_opt
+
+logger = logging.getLogger(__name__)
+
+"""
+    Parses a range of the form `MIN..MAX`, where either side may be left out, or a single value.
+    Returns a (min, max) tuple where a missing bound is None.
+"""
+def parse_range(s, conv=float):
+    if '..' in s:
+        (lo, hi) = s.split('..', 1)
+        return (conv(lo) if lo else None, conv(hi) if hi else None)
+    return (conv(s), conv(s))
+
+def parse_kind_range(s, conv=float):
+    if not ':' in s: raise ValueError(f"Expected KIND:RANGE, got '{s}'")
+    (kind, r) = s.split(':', 1)
+    return (kind, parse_range(r, conv))
+
+def range_sql(column, r, column_params=[]):
+    (lo, hi) = r
+    conds = []
+    if not lo is None: conds.append((f'{column} >= ?', [*column_params, lo]))
+    if not hi is None: conds.append((f'{column} <= ?', [*column_params, hi]))
+    return conds
+
+def setup_args(parser):
+    parser.add_argument('--has-beatgrid', action='store_true', help="Only tracks with a beatgrid")
+    parser.add_argument('--no-beatgrid', action='store_true', help="Only tracks without a beatgrid")
+    parser.add_argument('--bpm', type=parse_range, metavar='RANGE',
+        help="Dominant tempo in MIN..MAX (either side may be left out)")
+    parser.add_argument('--start', type=parse_range, metavar='RANGE',
+        help="Beatgrid start position in seconds in MIN..MAX")
+    parser.add_argument('--regions', type=lambda s: parse_range(s, int), metavar='RANGE',
+        help="Number of beatgrid regions in MIN..MAX")
+    parser.add_argument('--markers', type=lambda s: parse_kind_range(s, int), action='append',
+        default=[], metavar='KIND:RANGE',
+        help="Number of markers of a kind (cue, hotcue, loop, ...) in MIN..MAX, e.g. 'hotcue:..3'")
+    parser.add_argument('--marker-at', type=parse_kind_range, action='append', default=[],
+        metavar='KIND:RANGE', help="Has a marker of a kind positioned within MIN..MAX seconds")
+    parser.add_argument('--marker-color', type=lambda s: int(s.lstrip('#'), 16), metavar='RRGGBB',
+        help="Has a marker with this color")
+    parser.add_argument('-0', '--null', action='store_true',
+        help="Separate paths with NUL instead of newline")
+    parser.add_argument('-c', '--count', action='store_true', help="Only print the number of matches")
+    index_cmdline_opt(parser)
+    library_cmdline_opt(parser)
+
+def build_where(args):
+    where = []
+    if args.has_beatgrid: where.append(('has_beatgrid = 1', []))
+    if args.no_beatgrid: where.append(('has_beatgrid = 0', []))
+    if args.bpm: where += range_sql('bpm', args.bpm)
+    if args.start: where += range_sql('start', args.start)
+    if args.regions: where += range_sql('n_regions', args.regions)
+    for (kind, r) in args.markers:
+        count = '(SELECT COUNT(*) FROM markers m WHERE m.path = tracks.path AND m.kind = ?)'
+        where += range_sql(count, r, [kind])
+    for (kind, r) in args.marker_at:
+        conds = range_sql('m.position', r)
+        sql = 'EXISTS (SELECT 1 FROM markers m WHERE m.path = tracks.path AND m.kind = ?'
+        sql += ''.join(f' AND {w}' for (w, p) in conds) + ')'
+        where.append((sql, [kind, *[v for (w, p) in conds for v in p]]))
+    if not args.marker_color is None:
+        where.append(('EXISTS (SELECT 1 FROM markers m WHERE m.path = tracks.path AND m.color = ?)', [args.marker_color]))
+    return where
+
+def run(args, library):
+    # Only restrict to the library if one was given explicitly
+    if not args.library_path and not args.track_list and not args.track_list0: library = None
+    with TagIndex(args.index) as index:
+        paths = index.select(build_where(args), library)
+        if args.count:
+            print(sum(1 for p in paths))
+            return
+        sep = '\0' if args.null else '\n'
+        for path in paths: sys.stdout.write(path + sep)
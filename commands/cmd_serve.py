@@ -0,0 +1,241 @@
+import os
+import json
+import logging
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List,Optional
+
+from adapters import ADAPTERS
+from util.library import library_cmdline_opt,tolerance_cmdline_opt,tolerance_from_args,MergeOverwriteMode
+from util.library import Library
+from util.index import matcher_cmdline_opt
+from util.lock import track_lock
+from udlf.dictify import dictify,undictify
+from udlf.marker import Beatgrid,Marker,resolve_markers
+from udlf.trackinfo import track_format,file_stamp
+from .cmd_import import import_track
+from .cmd_export import export_track
+
+logger = logging.getLogger(__name__)
+
+def default_socket_path(): return os.path.join(os.path.expanduser('~'), '.udltool', 'udltool.sock')
+
+def setup_args(parser):
+    parser.add_argument(
+        '--socket',
+        default=default_socket_path(),
+        metavar='PATH',
+        help=f"Unix socket to listen on (default {default_socket_path()})"
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=10000,
+        metavar='N',
+        help="Number of decoded tracks to keep in memory (default 10000)"
+    )
+    parser.add_argument(
+        '-o', '--overwrite',
+        choices=('never', 'replace', 'clear'),
+        help="Default merge mode of 'sync' requests; see the 'import' and 'export' subcommands",
+        default="never"
+    )
+    for (n,a) in ADAPTERS.items():
+        a.setup_args(parser.add_argument_group(f"{a.NAME} Adapter ('{n}')", a.DESC))
+
+    tolerance_cmdline_opt(parser)
+    matcher_cmdline_opt(parser)
+    library_cmdline_opt(parser)
+
+class RequestError(Exception): pass
+
+"""
+    Answers requests about the library while keeping the library, adapter connections and
+    decoded tracks in memory. All requests are run on a single thread, one at a time, so the
+    storages and adapters (which hold SQLite connections) never see concurrent use.
+"""
+class Server:
+    def __init__(self, args, library):
+        self.args = args
+        self.library = library
+        self.mode = MergeOverwriteMode[args.overwrite.upper()]
+        self.tolerance = tolerance_from_args(args)
+        self.tracks = OrderedDict() # Path -> (file stamp, TrackInfo); least recently used first
+        self.connections = {} # Adapter name -> open Connection
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.methods = {
+            'ping': self.ping,
+            'get_beatgrid': self.get_beatgrid,
+            'set_beatgrid': self.set_beatgrid,
+            'get_markers': self.get_markers,
+            'set_markers': self.set_markers,
+            'resolve_markers': self.resolve_markers,
+            'sync': self.sync,
+            'invalidate': self.invalidate
+        }
+
+    def close(self):
+        self.executor.submit(self.close_all).result()
+        self.executor.shutdown()
+    def close_all(self):
+        for con in self.connections.values(): con.__exit__(None, None, None)
+        self.connections = {}
+        # Closes any databases opened by the storage
+        self.library.storage.__exit__(None, None, None)
+
+    """ Handles one decoded request, returning the response. """
+    def handle(self, request):
+        rid = request.get('id') if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict) or not request.get('method') in self.methods:
+                raise RequestError('Unknown method')
+            params = request.get('params', {})
+            if not isinstance(params, dict): raise RequestError('Params must be an object')
+            result = self.executor.submit(self.methods[request['method']], **params).result()
+            return {'id': rid, 'result': result}
+        except (RequestError, TypeError, ValueError, FileNotFoundError) as e:
+            return {'id': rid, 'error': str(e)}
+        except Exception as e:
+            logger.exception(f'Could not handle request {request}')
+            return {'id': rid, 'error': str(e)}
+
+    def track_path(self, path):
+        path = os.path.abspath(path)
+        if not path in self.library: raise RequestError(f'{path} is not in the library')
+        track_format(path)
+        return path
+    def track(self, path):
+        path = self.track_path(path)
+        stamp = file_stamp(path)
+        if path in self.tracks:
+            (cached_stamp, info) = self.tracks[path]
+            if cached_stamp == stamp:
+                self.tracks.move_to_end(path)
+                return info
+        info = self.library.storage.load(path)
+        self.cache(path, stamp, info)
+        return info
+    def cache(self, path, stamp, info):
+        self.tracks[path] = (stamp, info)
+        self.tracks.move_to_end(path)
+        while len(self.tracks) > self.args.cache_size: self.tracks.popitem(last=False)
+    def save(self, info):
+        info.save()
+        self.cache(info.track_location, file_stamp(info.track_location), info)
+        logger.debug('Wrote to %s', info.track_location)
+    """
+        Yields the track's info to be changed, then saves it. The track stays locked from checking
+        the cached info until it is saved, so writes by other processes aren't overwritten. If
+        changing or saving it fails, the info is dropped from the cache as it no longer matches
+        the track.
+    """
+    @contextmanager
+    def edit(self, path):
+        path = self.track_path(path)
+        with track_lock(path):
+            info = self.track(path)
+            try:
+                yield info
+                self.save(info)
+            except BaseException:
+                self.tracks.pop(path, None)
+                raise
+
+    def connection(self, adapter):
+        if not adapter in ADAPTERS: raise RequestError(f'Unknown adapter {adapter}')
+        if not adapter in self.connections:
+            self.connections[adapter] = ADAPTERS[adapter].Connection(self.args).__enter__()
+        return self.connections[adapter]
+
+    def ping(self): return 'pong'
+
+    def get_beatgrid(self, path):
+        beatgrid = self.track(path).getbeatgrid()
+        return None if beatgrid is None else dictify(beatgrid)
+    """ Returns how far (in seconds) normalizing the grid moved any beat. """
+    def set_beatgrid(self, path, beatgrid, normalize=True):
+        error = 0.0
+        with self.edit(path) as info:
+            if beatgrid is None: del info['beatgrid']
+            else: error = info.setbeatgrid(undictify(Beatgrid, beatgrid), self.tolerance, normalize)
+        return error
+
+    def get_markers(self, path, name):
+        return dictify(self.track(path).getmarkers(name))
+    def set_markers(self, path, name, markers):
+        with self.edit(path) as info:
+            if markers is None: del info[f'markers/{name}']
+            else: info.setmarkers(name, undictify(List[Optional[Marker]], markers))
+
+    """ Returns the [start, end] position in seconds of each marker, or None if it can't be resolved. """
+    def resolve_markers(self, path, name):
+        info = self.track(path)
+        return resolve_markers(info.getmarkers(name), info.getbeatgrid())
+
+    """ Imports or exports the given tracks, returning the paths that were changed. """
+    def sync(self, direction, adapter, paths, overwrite=None):
+        mode = self.mode if overwrite is None else MergeOverwriteMode[overwrite.upper()]
+        con = self.connection(adapter)
+        paths = [p for p in map(os.path.abspath, paths) if p in self.library]
+        changed = []
+        if direction == 'import':
+            subset = Library(paths=self.library.paths, tracks=paths, storage=self.library.storage)
+            for info in con.read_tracks(subset):
+                if import_track(self.library.storage, info, mode, self.tolerance):
+                    self.tracks.pop(info.track_location, None)
+                    changed.append(info.track_location)
+        elif direction == 'export':
+            for path in paths:
+                if export_track(con, self.track(path), mode, self.tolerance, keys=ADAPTERS[adapter].KEYS): changed.append(path)
+            con.flush()
+        else:
+            raise RequestError(f'Unknown direction {direction}')
+        return changed
+
+    """
+        Drops cached tracks (all of them if `paths` is None) and closes the adapter connections.
+        Changes made to the sidecar database or the adapters' data by other programs are only
+        seen after this.
+    """
+    def invalidate(self, paths=None):
+        if paths is None:
+            self.tracks.clear()
+        else:
+            for p in paths: self.tracks.pop(os.path.abspath(p), None)
+        for con in self.connections.values(): con.__exit__(None, None, None)
+        self.connections = {}
+
+""" Reads newline-delimited JSON requests and writes one JSON response line for each. """
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip(): continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'id': None, 'error': f'Invalid JSON: {e}'}
+            else:
+                response = self.server.udl.handle(request)
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def run(args, library):
+    os.makedirs(os.path.dirname(os.path.abspath(args.socket)), exist_ok=True)
+    if os.path.exists(args.socket): os.unlink(args.socket)
+    server = Server(args, library)
+    try:
+        with UnixServer(args.socket, RequestHandler) as unix_server:
+            unix_server.udl = server
+            logger.info(f'Listening on {args.socket}')
+            try:
+                unix_server.serve_forever()
+            except KeyboardInterrupt:
+                logger.info('Stopped serving')
+    finally:
+        server.close()
+        if os.path.exists(args.socket): os.unlink(args.socket)
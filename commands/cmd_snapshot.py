@@ -0,0 +1,36 @@
+import sys
+import json
+import logging
+
+from util.library import library_cmdline_opt
+
+logger = logging.getLogger(__name__)
+
+def setup_args(parser):
+    parser.add_argument('snapshot', help="Directory the snapshot is written to (or read from with --load)")
+    parser.add_argument(
+        '--load',
+        action='store_true',
+        help="Don't scan the library; only read the existing snapshot (use with --stats)"
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help="Print library-wide statistics computed from the snapshot as JSON"
+    )
+    library_cmdline_opt(parser)
+
+def run(args, library):
+    # NumPy is only needed for snapshots
+    from util.snapshot import Snapshot
+
+    if args.load:
+        snapshot = Snapshot.load(args.snapshot)
+    else:
+        with library.storage:
+            snapshot = Snapshot.build(library)
+        snapshot.save(args.snapshot)
+        logger.info(f'Wrote snapshot of {len(snapshot)} tracks to {args.snapshot}')
+    if args.stats:
+        json.dump(snapshot.stats(), sys.stdout, indent=2)
+        sys.stdout.write('\n')
@@ -0,0 +1,62 @@
+import logging
+
+from util.library import library_cmdline_opt
+from util.storage import STORAGES,storage_from_args
+from util.writer import TagWriter,writer_cmdline_opt
+from util.events import events
+from udlf.trackinfo import UnknownFormatError
+
+logger = logging.getLogger(__name__)
+
+def setup_args(parser):
+    parser.add_argument(
+        'source',
+        choices=STORAGES,
+        help="Storage to copy UDL data from",
+        metavar='source'
+    )
+    parser.add_argument(
+        'target',
+        choices=STORAGES,
+        help="Storage to copy UDL data to",
+        metavar='target'
+    )
+    parser.add_argument(
+        '--move',
+        action='store_true',
+        help="Remove the UDL data from the source storage once it was copied"
+    )
+    writer_cmdline_opt(parser)
+    library_cmdline_opt(parser)
+
+def run(args, library):
+    if args.source == args.target: raise ValueError('Source and target storage are the same')
+    source = storage_from_args(args, library.paths, args.source)
+    target = storage_from_args(args, library.paths, args.target)
+    writer = TagWriter(args.write_jobs, sync=not args.no_fsync)
+    # When moving, the source is only cleared once the copy was written
+    save = (lambda info: info.save()) if args.move else writer.submit
+    with source, target, writer:
+        for track_path in library.track_paths():
+            try:
+                src_info = source.load(track_path)
+                dst_info = target.load(track_path)
+                
+                if dst_info != src_info:
+                    dst_info.clear()
+                    dst_info.assign(src_info, overwrite=True)
+                    save(dst_info)
+                    logger.info('Copied %s to %s', track_path, args.target)
+                    events.track(track_path, 'changed')
+                else:
+                    logger.debug('%s already in sync', track_path)
+                    events.track(track_path, 'unchanged')
+                
+                if args.move and len(list(src_info.keys())):
+                    src_info.clear()
+                    src_info.save()
+            except UnknownFormatError:
+                logger.debug('Unknown file format for %s', track_path)
+            except Exception as e:
+                logger.exception(f'Could not sync track {track_path}')
+                events.track(track_path, 'error', error=str(e))
@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+import logging
+
+from util.library import library_cmdline_opt,tolerance_cmdline_opt,tolerance_from_args
+from util.verify import verify_library,ERROR
+
+logger = logging.getLogger(__name__)
+
+def setup_args(parser):
+    parser.add_argument(
+        '--report',
+        default='-',
+        metavar='FILE',
+        help="Write the report to FILE as JSON lines, one per track with issues (default stdout)"
+    )
+    parser.add_argument(
+        '--all',
+        action='store_true',
+        help="Also report tracks without issues"
+    )
+    parser.add_argument(
+        '--repair',
+        action='store_true',
+        help="Rewrite the UDL data of tracks in canonical form: normalized beatgrids, re-encoded " \
+            "markers and one frame per key. Data that can't be decoded is left alone"
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        metavar='N',
+        help=f"Number of worker processes (default {os.cpu_count()})"
+    )
+    tolerance_cmdline_opt(parser)
+    library_cmdline_opt(parser)
+
+def run(args, library):
+    tolerance = tolerance_from_args(args)
+    f = sys.stdout if args.report == '-' else open(args.report, 'w', encoding='utf-8')
+    (errors, warnings, failed, repaired) = (0, 0, 0, 0)
+    try:
+        with library.storage:
+            for entry in verify_library(library, args.jobs, args.repair, tolerance, args.all):
+                f.write(json.dumps(entry) + '\n')
+                if 'error' in entry:
+                    failed += 1
+                    continue
+                if 'repaired' in entry: repaired += 1
+                if any(i['severity'] == ERROR for i in entry['issues']): errors += 1
+                elif len(entry['issues']): warnings += 1
+    finally:
+        if not f is sys.stdout: f.close()
+    summary = f'{errors} tracks with errors, {warnings} with warnings, {failed} unreadable, {repaired} repaired'
+    if errors or failed: logger.warning(summary)
+    else: logger.info(summary)
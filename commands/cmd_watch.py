@@ -0,0 +1,203 @@
+import os
+import copy
+import time
+import logging
+
+from adapters import ADAPTERS
+from util.library import library_cmdline_opt,tolerance_cmdline_opt,tolerance_from_args,MergeOverwriteMode
+from util.library import Library
+from util.walk import is_ignored_file,is_ignored_dir,has_track_extension
+from util.index import matcher_cmdline_opt
+from util.inotify import Inotify,IN_CLOSE_WRITE,IN_MODIFY,IN_MOVED_TO,IN_MOVED_FROM,IN_CREATE,IN_DELETE,IN_ISDIR
+from udlf.trackinfo import file_stamp
+from .cmd_import import import_track
+from .cmd_export import export_outcome
+
+logger = logging.getLogger(__name__)
+
+LIBRARY_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE
+ADAPTER_MASK = IN_CLOSE_WRITE | IN_MODIFY | IN_MOVED_TO | IN_CREATE
+
+def setup_args(parser):
+    parser.add_argument(
+        'direction',
+        choices=('import', 'export'),
+        help="Keep importing from the adapter into the library, or exporting the library to it",
+        metavar='direction'
+    )
+    parser.add_argument(
+        'adapter',
+        choices=ADAPTERS,
+        help="Adapter to sync with. See options below.",
+        metavar='adapter'
+    )
+    parser.add_argument(
+        '-o', '--overwrite',
+        choices=('never', 'replace', 'clear'),
+        help="How to merge tags; see the 'import' and 'export' subcommands",
+        default="never"
+    )
+    parser.add_argument(
+        '--debounce',
+        type=float,
+        default=1.0,
+        metavar='SECONDS',
+        help="Wait until there were no changes for this long before syncing (default 1.0)"
+    )
+    for (n,a) in ADAPTERS.items():
+        a.setup_args(parser.add_argument_group(f"{a.NAME} Adapter ('{n}')", a.DESC))
+
+    tolerance_cmdline_opt(parser)
+    matcher_cmdline_opt(parser)
+    library_cmdline_opt(parser)
+
+"""
+    Keeps the library and an adapter in sync. Runs a full pass once, then only pushes tracks
+    affected by filesystem events through the import/export merge logic. The adapter connection
+    and the adapter-side data seen so far are kept between events.
+"""
+class Watcher:
+    def __init__(self, args, library):
+        self.args = args
+        self.library = library
+        if args.direction == 'export':
+            # Exporting only needs the UDL frames; don't change the caller's library
+            self.library = copy.copy(library)
+            self.library.lazy = True
+        self.adapter = ADAPTERS[args.adapter]
+        self.mode = MergeOverwriteMode[args.overwrite.upper()]
+        self.tolerance = tolerance_from_args(args)
+        self.seen = {} # Track path -> raw adapter-side data last imported
+        self.own = {} # Path -> file stamp after our own last write to it
+        self.pushed = {} # Track path -> digest of the UDL data last exported
+        self.adapter_files = {os.path.abspath(p) for p in self.adapter.watch_paths(args)}
+        self.watched_dirs = set()
+
+    def run(self):
+        with Inotify() as self.inotify, self.library.storage:
+            self.con = self.adapter.Connection(self.args).__enter__()
+            try:
+                for d in {os.path.dirname(p) for p in self.adapter_files}:
+                    self.inotify.add_watch(d, ADAPTER_MASK)
+                self.watch_library()
+                self.full_sync()
+                logger.info('Watching for changes...')
+                while True: self.handle(self.wait())
+            finally:
+                self.con.__exit__(None, None, None)
+
+    def watch_library(self):
+        if not self.library.tracks is None:
+            for d in {os.path.dirname(p) for p in self.library.tracks}: self.watch_dir(d)
+            return
+        for path in self.library.paths:
+            if os.path.isdir(path): self.watch_tree(path)
+            else: self.watch_dir(os.path.dirname(path))
+    def watch_dir(self, d):
+        if d in self.watched_dirs: return
+        self.inotify.add_watch(d, LIBRARY_MASK)
+        self.watched_dirs.add(d)
+    """ Watches a directory tree, returning the files already inside it. """
+    def watch_tree(self, root):
+        files = []
+        for (d, dirs, names) in os.walk(root):
+            dirs[:] = [n for n in dirs if not is_ignored_dir(n)]
+            self.watch_dir(d)
+            files += [os.path.join(d, n) for n in names if not is_ignored_file(n)]
+        return files
+
+    """ Blocks until there are events, then collects more until none arrive for the debounce time. """
+    def wait(self):
+        events = self.inotify.read(None)
+        deadline = time.monotonic() + self.args.debounce
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return events
+            more = self.inotify.read(remaining)
+            if len(more):
+                events += more
+                deadline = time.monotonic() + self.args.debounce
+
+    def handle(self, events):
+        changed = set()
+        adapter_changed = False
+        for (d, name, mask) in events:
+            if d is None: # Events were lost
+                self.full_sync(reopen=True)
+                return
+            path = os.path.join(d, name)
+            if path in self.adapter_files:
+                adapter_changed = adapter_changed or file_stamp(path, missing_ok=True) != self.own.get(path)
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not is_ignored_dir(name):
+                    changed.update(self.watch_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and not is_ignored_file(name):
+                changed.add(path)
+
+        # Skip our own writes and files which are already gone again
+        changed = [
+            p for p in changed
+            if p in self.library and has_track_extension(p) and not file_stamp(p, missing_ok=True) in (None, self.own.get(p))
+        ]
+        if adapter_changed:
+            logger.debug('Adapter data changed')
+            self.full_sync(reopen=self.args.direction == 'export')
+        if len(changed):
+            logger.debug(f'{len(changed)} library tracks changed')
+            self.sync_tracks(changed)
+
+    def full_sync(self, reopen=False):
+        if reopen:
+            # Our view of the adapter's data is stale
+            self.con.__exit__(None, None, None)
+            self.con = self.adapter.Connection(self.args).__enter__()
+        if self.args.direction == 'import':
+            for info in self.con.read_tracks(self.library):
+                raw = info.tags_sorted_tuples()
+                if self.seen.get(info.track_location) == raw: continue
+                self.seen[info.track_location] = raw
+                self.imported(info)
+        else:
+            for info in self.library: self.exported(info)
+            self.flushed()
+
+    def sync_tracks(self, paths):
+        if self.args.direction == 'import':
+            subset = Library(paths=self.library.paths, tracks=paths, storage=self.library.storage)
+            for info in self.con.read_tracks(subset): self.imported(info)
+        else:
+            subset = Library(paths=self.library.paths, tracks=paths, storage=self.library.storage)
+            for (path, digest) in subset.track_digests():
+                # Changes to other tags than the UDL data don't need to be exported
+                if not digest is None and self.pushed.get(path) == digest:
+                    logger.debug('UDL data of %s is unchanged; Skipping...', path)
+                    continue
+                try:
+                    info = self.library.storage.load(path, lazy=True)
+                except Exception:
+                    logger.exception(f'Could not process track {path}')
+                    continue
+                self.exported(info)
+            self.flushed()
+
+    def imported(self, info):
+        if import_track(self.library.storage, info, self.mode, self.tolerance):
+            self.own[info.track_location] = file_stamp(info.track_location, missing_ok=True)
+    def exported(self, info):
+        if export_outcome(self.con, info, self.mode, self.tolerance, keys=self.adapter.KEYS)[0] == 'error': return
+        try:
+            # Only a digest that matches the data can be trusted to detect changes
+            digest = info.stored_digest()
+            self.pushed[info.track_location] = digest if digest == info.digest() else None
+        except ValueError:
+            # The track changed since it was loaded; its next event exports it again
+            self.pushed.pop(info.track_location, None)
+    def flushed(self):
+        self.con.flush()
+        for p in self.adapter_files: self.own[p] = file_stamp(p, missing_ok=True)
+
+def run(args, library):
+    try:
+        Watcher(args, library).run()
+    except KeyboardInterrupt:
+        logger.info('Stopped watching')
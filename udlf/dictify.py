@@ -76,6 +76,7 @@ def undictify(type_tgt, data, undictifiers=None):
     return defKey(undictifiers,get_clean_origin(type_tgt))(type_tgt, data, undictifiers)
 
 class AutoDictify:
+    __slots__ = ()
     def dictify(self, dictifiers=None):
         hints = get_type_hints(self)
         res = {k: dictify(getattr(self, k), dictifiers) for k in hints.keys() if hasattr(self, k)}
@@ -84,7 +85,8 @@ class AutoDictify:
     def undictify(cls, v, undictifiers=None):
         hints = get_type_hints(cls)
         instance = cls.__new__(cls)
-        for k, t in hints.items(): setattr(instance, k, undictify(t, v[k] if k in v else None))
+        # Bypasses frozen dataclasses' __setattr__
+        for k, t in hints.items(): object.__setattr__(instance, k, undictify(t, v[k] if k in v else None))
         return instance
 
 def undictifyDictUnion(v, key, elements, undictifiers=None):
@@ -0,0 +1,618 @@
+import io
+import os
+import struct
+from mutagen.id3 import ID3,TXXX,Encoding
+from mutagen.id3._util import ID3NoHeaderError
+
+from .id3 import PREFIX
+
+"""
+    Backends storing UDL data in the native tags of each container. Every backend reads the UDL
+    data into an in-memory ID3 tag of TXXX frames, so `UDL_ID3` works the same for all formats.
+    Loading only walks the container's block headers to find the tag data and reads that; the
+    audio is never parsed. Saving goes through Mutagen, which rewrites the container properly.
+"""
+
+class UnknownFormatError(ValueError): pass
+
+def syncsafe(b):
+    size = 0
+    for c in b: size = (size << 7) | (c & 0x7f)
+    return size
+
+def id3v2_size(buf):
+    if len(buf) < 10 or buf[:3] != b'ID3': return 0
+    size = syncsafe(buf[6:10])
+    # Footer present
+    if buf[5] & 0x10: size += 10
+    return 10 + size
+
+def file_size(f):
+    return f.seek(0, io.SEEK_END)
+
+def read_at(f, offset, n):
+    f.seek(offset)
+    data = f.read(n)
+    if len(data) < n: raise ValueError('Unexpected end of file')
+    return data
+
+def txxx(key, text):
+    return TXXX(desc=f'{PREFIX}{key}', encoding=Encoding.UTF8, text=list(text))
+
+class NeedsDecoding(Exception): pass
+
+ID3_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+
+""" Splits the text of a frame at the terminators of its encoding. """
+def split_text(data, encoding):
+    if encoding in (1, 2):
+        (parts, start) = ([], 0)
+        for i in range(0, len(data) - 1, 2):
+            if data[i:i+2] == b'\0\0':
+                parts.append(data[start:i])
+                start = i + 2
+        parts.append(data[start:])
+    else:
+        parts = data.split(b'\0')
+    return [p.decode(ID3_ENCODINGS[encoding]) for p in parts]
+
+""" Bytes read from the start of a frame to find the end of its description """
+DESC_BYTES = 256
+
+""" Splits the text of a TXXX frame (after its encoding byte) into its values. """
+def txxx_values(data, encoding):
+    text = split_text(data, encoding)
+    # A trailing terminator ends the last string instead of starting another
+    if len(text) > 1 and text[-1] == '': text.pop()
+    return text
+
+""" Offset of the first terminator of `encoding` in `data`, or -1. """
+def find_terminator(data, encoding):
+    if not encoding in (1, 2): return data.find(b'\0')
+    for i in range(0, len(data) - 1, 2):
+        if data[i:i+2] == b'\0\0': return i
+    return -1
+
+"""
+    Yields (description, encoding, offset, size) of the text of every TXXX frame of the ID3v2 tag
+    at `offset`. Only frame headers and descriptions are read. Raises `NeedsDecoding` for tags
+    whose frames can't be read as they are (unsynchronised, compressed or encrypted).
+"""
+def id3_txxx_frames(f, offset):
+    f.seek(offset)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3': return
+    (major, flags) = (header[3], header[5])
+    if flags & 0x80 or not major in (2, 3, 4): raise NeedsDecoding()
+    pos = offset + 10
+    end = pos + syncsafe(header[6:10])
+    if flags & 0x40 and major > 2:
+        ext = read_at(f, pos, 4)
+        pos += syncsafe(ext) if major == 4 else 4 + int.from_bytes(ext, 'big')
+    (hsize, tid) = (6, b'TXX') if major == 2 else (10, b'TXXX')
+    while pos + hsize <= end:
+        fh = read_at(f, pos, hsize)
+        if fh[0] == 0: break # Padding
+        if major == 2: (fid, size, bad) = (fh[:3], int.from_bytes(fh[3:6], 'big'), 0)
+        elif major == 3: (fid, size, bad) = (fh[:4], int.from_bytes(fh[4:8], 'big'), fh[9] & 0xc0)
+        else: (fid, size, bad) = (fh[:4], syncsafe(fh[4:8]), fh[9] & 0x0f)
+        if fid == tid and size > 0:
+            if bad: raise NeedsDecoding()
+            start = pos + hsize
+            data = read_at(f, start, min(size, DESC_BYTES))
+            encoding = data[0]
+            if encoding < len(ID3_ENCODINGS):
+                i = find_terminator(data[1:], encoding)
+                if i < 0 and size > len(data):
+                    data = read_at(f, start, size)
+                    i = find_terminator(data[1:], encoding)
+                term = 2 if encoding in (1, 2) else 1
+                if i < 0: (i, term) = (size - 1, 0)
+                desc = data[1:1+i].decode(ID3_ENCODINGS[encoding])
+                yield (desc, encoding, start + 1 + i + term, size - 1 - i - term)
+        pos += hsize + size
+
+"""
+    Returns the text of the TXXX frame `desc` of the ID3v2 tag at `offset`, or None if there is
+    none. Only frame headers are read until the frame is found.
+"""
+def id3_txxx(f, offset, desc):
+    for (d, encoding, start, size) in id3_txxx_frames(f, offset):
+        if d == desc: return txxx_values(read_at(f, start, size), encoding)
+    return None
+
+""" Text of the first TXXX frame `desc` in `tags`, or None. """
+def txxx_text(tags, desc):
+    frames = tags.getall(f'TXXX:{desc}')
+    return list(frames[0].text) if len(frames) else None
+
+""" The UDL frames of `tags` as (key, text) pairs. """
+def udl_frames(tags):
+    return [
+        (frame.desc[len(PREFIX):], list(frame.text)) for frame in tags.getall('TXXX')
+        if frame.desc.startswith(PREFIX)
+    ]
+
+"""
+    A TXXX frame whose text is only read from the track when it is first accessed. It can be moved
+    between tags (see `UDL_ID3.assign`) without reading it.
+"""
+class LazyTXXX(TXXX):
+    def __init__(self, *args, load = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._load = load
+    # Mutagen keys frames by their class name
+    @property
+    def FrameID(self): return 'TXXX'
+    @property
+    def text(self):
+        if not self._load is None: (self._text, self._load) = (self._load(), None)
+        return self._text
+    @text.setter
+    def text(self, text): (self._text, self._load) = (text, None)
+
+""" Replaces the `LazyTXXX` frames of `tags` with plain ones, which Mutagen can write. """
+def materialize(tags):
+    for frame in tags.getall('TXXX'):
+        if isinstance(frame, LazyTXXX):
+            tags[frame.HashKey] = TXXX(encoding=frame.encoding, desc=frame.desc, text=frame.text)
+
+""" Changes whenever a file is written or replaced """
+def stat_stamp(st): return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+""" The `stat_stamp` of a file. With `missing_ok`, a missing file has the stamp None. """
+def file_stamp(path, missing_ok=False):
+    try:
+        return stat_stamp(os.stat(path))
+    except FileNotFoundError:
+        if missing_ok: return None
+        raise
+
+""" Reads the text of lazily loaded frames, failing if the track changed since it was loaded. """
+class TrackReader:
+    def __init__(self, track_location, backend):
+        self.track_location = track_location
+        self.backend = backend
+        self.stamp = file_stamp(track_location)
+    def read(self, locations):
+        with open(self.track_location, 'rb') as f:
+            if stat_stamp(os.fstat(f.fileno())) != self.stamp:
+                raise ValueError(f'{self.track_location} changed since it was loaded')
+            return self.backend.read_text(f, locations)
+
+"""
+    Loads the UDL frames of a track as `LazyTXXX` frames, recording only where their text is. Frames
+    of the same key are joined like Mutagen does. Tags that can't be indexed are loaded in full.
+"""
+def load_lazy(backend, track_location, f):
+    try:
+        frames = list(backend.index(f))
+    except NeedsDecoding:
+        return backend.load(f)
+    reader = TrackReader(track_location, backend)
+    keys = {}
+    for (key, location) in frames: keys.setdefault(key, []).append(location)
+    t = ID3()
+    for (key, locations) in keys.items():
+        t.add(LazyTXXX(desc=f'{PREFIX}{key}', encoding=Encoding.UTF8, load=lambda locations=locations: reader.read(locations)))
+    return t
+
+""" Index of the UDL frames of the ID3v2 tag at `offset` as (key, (offset, size, encoding)). """
+def id3_index(f, offset):
+    for (desc, encoding, start, size) in id3_txxx_frames(f, offset):
+        if desc.startswith(PREFIX): yield (desc[len(PREFIX):], (start, size, encoding))
+def id3_read_text(f, locations):
+    return [t for (start, size, encoding) in locations for t in txxx_values(read_at(f, start, size), encoding)]
+
+""" Reads UTF-8 values, one per location. """
+def utf8_read_text(f, locations):
+    return [read_at(f, start, size).decode('utf-8') for (start, size) in locations]
+
+"""
+    Trailing tags of an MP3 that are rewritten when the track's metadata changes (APEv2 and ID3v1).
+    Returns where the audio ends.
+"""
+def trailing_tags_start(f, start, end):
+    if end - start >= 128 and read_at(f, end - 128, 3) == b'TAG': end -= 128
+    if end - start >= 32 and read_at(f, end - 32, 8) == b'APETAGEX':
+        (size, flags) = struct.unpack('<II', read_at(f, end - 20, 8))
+        end -= size + (32 if flags & 0x80000000 else 0)
+    return max(start, end)
+
+class MP3Format:
+    EXTENSIONS = ('mp3',)
+    @staticmethod
+    def load(f):
+        t = ID3()
+        try: t.load(f)
+        except ID3NoHeaderError: pass # We may not have a header yet
+        return t
+    """ Text of the TXXX frame `desc`, or None. Reads only what is needed to find it. """
+    @staticmethod
+    def load_txxx(f, desc):
+        try:
+            return id3_txxx(f, 0, desc)
+        except NeedsDecoding:
+            return txxx_text(MP3Format.load(f), desc)
+    @staticmethod
+    def index(f): return id3_index(f, 0)
+    read_text = staticmethod(id3_read_text)
+    @staticmethod
+    def save(track_location, tags): tags.save(track_location)
+    """
+        Tests if saving `tags` keeps the size of the track's ID3v2 tag, so that `save` only
+        overwrites the tag and never moves the audio. This renders the tag like Mutagen's save does.
+    """
+    @staticmethod
+    def fits_in_place(track_location, tags):
+        from mutagen.id3._tags import ID3Header
+        with open(track_location, 'rb') as f:
+            try:
+                old_size = ID3Header(f).size
+            except ID3NoHeaderError:
+                return False
+            return len(tags._prepare_data(f, 0, old_size, 4, '/', None)) == old_size
+    """ Returns the (start, end) byte range of the audio data, skipping all tags. """
+    @staticmethod
+    def audio_range(f):
+        end = file_size(f)
+        start = min(end, id3v2_size(read_at(f, 0, min(10, end))))
+        return (start, trailing_tags_start(f, start, end))
+
+"""
+    FLAC stores UDL data as Vorbis comments named `UDLF:<key>`, one comment per text entry.
+    Field names are case-insensitive, so they are matched ignoring case.
+"""
+class FLACFormat:
+    EXTENSIONS = ('flac',)
+    VORBIS_COMMENT = 4
+
+    """ Returns the offset of the 'fLaC' marker, skipping an ID3v2 tag some encoders put in front. """
+    @staticmethod
+    def find_stream(f):
+        offset = id3v2_size(read_at(f, 0, 10))
+        if read_at(f, offset, 4) != b'fLaC': raise ValueError('Not a FLAC file')
+        return offset
+    """ Yields (type, offset, size) of each metadata block from its header alone. """
+    @staticmethod
+    def blocks(f):
+        pos = FLACFormat.find_stream(f) + 4
+        while True:
+            header = read_at(f, pos, 4)
+            size = int.from_bytes(header[1:4], 'big')
+            yield (header[0] & 0x7f, pos + 4, size)
+            pos += 4 + size
+            if header[0] & 0x80: return
+
+    @staticmethod
+    def load(f):
+        t = ID3()
+        comments = None
+        for (btype, offset, size) in FLACFormat.blocks(f):
+            if btype == FLACFormat.VORBIS_COMMENT:
+                comments = read_at(f, offset, size)
+                break
+        if comments is None: return t
+        (vendor_len,) = struct.unpack_from('<I', comments, 0)
+        pos = 4 + vendor_len
+        (count,) = struct.unpack_from('<I', comments, pos)
+        pos += 4
+        values = {}
+        for _ in range(count):
+            (n,) = struct.unpack_from('<I', comments, pos)
+            comment = comments[pos+4:pos+4+n]
+            pos += 4 + n
+            if comment[:len(PREFIX)].upper() != PREFIX.encode('ascii').upper(): continue
+            (name, _, value) = comment.partition(b'=')
+            values.setdefault(name[len(PREFIX):].decode('ascii').lower(), []).append(value.decode('utf-8'))
+        for (key, text) in values.items(): t.add(txxx(key, text))
+        return t
+    @staticmethod
+    def load_txxx(f, desc): return txxx_text(FLACFormat.load(f), desc)
+    """ Walks the Vorbis comments reading only their lengths and names. """
+    @staticmethod
+    def index(f):
+        for (btype, offset, size) in FLACFormat.blocks(f):
+            if btype != FLACFormat.VORBIS_COMMENT: continue
+            (vendor_len,) = struct.unpack('<I', read_at(f, offset, 4))
+            pos = offset + 4 + vendor_len
+            (count,) = struct.unpack('<I', read_at(f, pos, 4))
+            pos += 4
+            for _ in range(count):
+                (n,) = struct.unpack('<I', read_at(f, pos, 4))
+                head = read_at(f, pos + 4, min(n, DESC_BYTES))
+                if head[:len(PREFIX)].upper() == PREFIX.encode('ascii').upper():
+                    i = head.find(b'=')
+                    if i < 0 and n > len(head):
+                        head = read_at(f, pos + 4, n)
+                        i = head.find(b'=')
+                    if i < 0: i = n
+                    key = head[len(PREFIX):i].decode('ascii').lower()
+                    yield (key, (pos + 4 + i + 1, max(0, n - i - 1)))
+                pos += 4 + n
+            return
+    read_text = staticmethod(utf8_read_text)
+    @staticmethod
+    def save(track_location, tags):
+        from mutagen.flac import FLAC
+        f = FLAC(track_location)
+        if f.tags is None: f.add_tags()
+        for k in list(f.tags.keys()):
+            if k.upper().startswith(PREFIX.upper()): del f.tags[k]
+        for (key, text) in udl_frames(tags): f.tags[f'{PREFIX}{key}'] = text
+        f.save()
+    """ The audio frames follow the last metadata block. """
+    @staticmethod
+    def audio_range(f):
+        end = file_size(f)
+        for (_, offset, size) in FLACFormat.blocks(f): start = offset + size
+        return (start, trailing_tags_start(f, start, end))
+
+"""
+    MP4 stores UDL data in freeform atoms `----:com.apple.iTunes:UDLF:<key>` with one UTF-8 data
+    atom per text entry. Only atom headers are read on the way down to moov.udta.meta.ilst, so
+    the sample tables and the media data are skipped.
+"""
+class MP4Format:
+    EXTENSIONS = ('m4a', 'mp4')
+    MEAN = 'com.apple.iTunes'
+
+    """ Yields (name, data offset, end offset) of each atom between `start` and `end`. """
+    @staticmethod
+    def atoms(f, start, end):
+        pos = start
+        while pos + 8 <= end:
+            (size, name) = struct.unpack('>I4s', read_at(f, pos, 8))
+            header = 8
+            if size == 1:
+                (size,) = struct.unpack('>Q', read_at(f, pos + 8, 8))
+                header = 16
+            elif size == 0:
+                size = end - pos
+            if size < header: raise ValueError(f'Invalid MP4 atom {name!r}')
+            yield (name, pos + header, min(pos + size, end))
+            pos += size
+    @staticmethod
+    def find(f, start, end, name):
+        for (n, data, atom_end) in MP4Format.atoms(f, start, end):
+            if n == name: return (data, atom_end)
+        return None
+    """ Returns the (start, end) range of the children of moov.udta.meta.ilst, or None. """
+    @staticmethod
+    def find_ilst(f):
+        r = (0, file_size(f))
+        for name in (b'moov', b'udta', b'meta', b'ilst'):
+            r = MP4Format.find(f, *r, name)
+            if r is None: return None
+            # meta is a full box with version and flags, except in some QuickTime files
+            if name == b'meta' and read_at(f, r[0] + 4, 4) != b'hdlr': r = (r[0] + 4, r[1])
+        return r
+
+    @staticmethod
+    def load(f):
+        t = ID3()
+        ilst = MP4Format.find_ilst(f)
+        if ilst is None: return t
+        for (name, start, end) in MP4Format.atoms(f, *ilst):
+            if name != b'----': continue
+            item = read_at(f, start, end - start)
+            (mean, key, text) = (None, None, [])
+            for (child, cstart, cend) in MP4Format.atoms(io.BytesIO(item), 0, len(item)):
+                # mean and name have version and flags; data has a type and a locale
+                if child == b'mean': mean = item[cstart+4:cend].decode('utf-8')
+                elif child == b'name': key = item[cstart+4:cend].decode('utf-8')
+                elif child == b'data': text.append(item[cstart+8:cend].decode('utf-8'))
+            if mean == MP4Format.MEAN and not key is None and key.startswith(PREFIX):
+                t.add(txxx(key[len(PREFIX):], text))
+        return t
+    @staticmethod
+    def load_txxx(f, desc): return txxx_text(MP4Format.load(f), desc)
+    """ Walks the freeform atoms reading only their mean and name. """
+    @staticmethod
+    def index(f):
+        ilst = MP4Format.find_ilst(f)
+        if ilst is None: return
+        for (name, start, end) in MP4Format.atoms(f, *ilst):
+            if name != b'----': continue
+            (mean, key, data) = (None, None, [])
+            for (child, cstart, cend) in MP4Format.atoms(f, start, end):
+                if child == b'mean': mean = read_at(f, cstart + 4, cend - cstart - 4).decode('utf-8')
+                elif child == b'name': key = read_at(f, cstart + 4, cend - cstart - 4).decode('utf-8')
+                elif child == b'data': data.append((cstart + 8, cend - cstart - 8))
+            if mean == MP4Format.MEAN and not key is None and key.startswith(PREFIX):
+                for location in data: yield (key[len(PREFIX):], location)
+    read_text = staticmethod(utf8_read_text)
+    @staticmethod
+    def save(track_location, tags):
+        from mutagen.mp4 import MP4,MP4FreeForm,AtomDataType
+        f = MP4(track_location)
+        if f.tags is None: f.add_tags()
+        prefix = f'----:{MP4Format.MEAN}:{PREFIX}'
+        for k in list(f.tags.keys()):
+            if k.startswith(prefix): del f.tags[k]
+        for (key, text) in udl_frames(tags):
+            f.tags[f'{prefix}{key}'] = [MP4FreeForm(s.encode('utf-8'), AtomDataType.UTF8) for s in text]
+        f.save()
+    """ The audio is the media data; the moov atom may move when tags are rewritten. """
+    @staticmethod
+    def audio_range(f):
+        r = MP4Format.find(f, 0, file_size(f), b'mdat')
+        if r is None: raise ValueError('No media data')
+        return r
+
+"""
+    AIFF and WAV store a complete ID3 tag in a chunk of the IFF/RIFF container. The chunk
+    headers are walked to find it, and only the tag itself is read.
+"""
+class IFFFormat:
+    @classmethod
+    def chunks(cls, f):
+        (form, size, kind) = struct.unpack(cls.HEADER, read_at(f, 0, 12))
+        if form != cls.FORM or not kind in cls.KINDS: raise ValueError(f'Not a {cls.NAME} file')
+        end = min(8 + size, file_size(f))
+        pos = 12
+        while pos + 8 <= end:
+            (cid, csize) = struct.unpack(cls.CHUNK, read_at(f, pos, 8))
+            yield (cid, pos + 8, csize)
+            # Chunks are padded to an even size
+            pos += 8 + csize + (csize & 1)
+
+    @classmethod
+    def load(cls, f):
+        t = ID3()
+        for (cid, offset, size) in cls.chunks(f):
+            if cid.upper() == b'ID3 ':
+                try: t.load(io.BytesIO(read_at(f, offset, size)), load_v1=False)
+                except ID3NoHeaderError: pass
+                break
+        return t
+    @classmethod
+    def load_txxx(cls, f, desc):
+        for (cid, offset, size) in cls.chunks(f):
+            if cid.upper() == b'ID3 ':
+                try:
+                    return id3_txxx(f, offset, desc)
+                except NeedsDecoding:
+                    return txxx_text(cls.load(f), desc)
+        return None
+    @classmethod
+    def index(cls, f):
+        for (cid, offset, size) in cls.chunks(f):
+            if cid.upper() == b'ID3 ': return id3_index(f, offset)
+        return iter(())
+    read_text = staticmethod(id3_read_text)
+    @classmethod
+    def save(cls, track_location, tags):
+        f = cls.mutagen_file(track_location)
+        if f.tags is None: f.add_tags()
+        f.tags.clear()
+        for frame in tags.values(): f.tags.add(frame)
+        f.save()
+    @classmethod
+    def audio_range(cls, f):
+        for (cid, offset, size) in cls.chunks(f):
+            if cid == cls.AUDIO: return (offset, offset + size)
+        raise ValueError('No audio data')
+
+class AIFFFormat(IFFFormat):
+    NAME = 'AIFF'
+    EXTENSIONS = ('aiff', 'aif')
+    HEADER = '>4sI4s'
+    CHUNK = '>4sI'
+    FORM = b'FORM'
+    KINDS = (b'AIFF', b'AIFC')
+    AUDIO = b'SSND'
+    @staticmethod
+    def mutagen_file(track_location):
+        from mutagen.aiff import AIFF
+        return AIFF(track_location)
+
+class WAVFormat(IFFFormat):
+    NAME = 'WAV'
+    EXTENSIONS = ('wav',)
+    HEADER = '<4sI4s'
+    CHUNK = '<4sI'
+    FORM = b'RIFF'
+    KINDS = (b'WAVE',)
+    AUDIO = b'data'
+    @staticmethod
+    def mutagen_file(track_location):
+        from mutagen.wave import WAVE
+        return WAVE(track_location)
+
+""" File extension -> backend """
+FORMAT_BACKENDS = {
+    ext: backend
+    for backend in (MP3Format, FLACFormat, MP4Format, AIFFFormat, WAVFormat)
+    for ext in backend.EXTENSIONS
+}
+FORMATS = tuple(FORMAT_BACKENDS)
+
+""" Returns the format of a track from its file name, raising `UnknownFormatError` if unsupported. """
+def track_format(track_location):
+    fmt = track_location.split('.')[-1].lower()
+    if not fmt in FORMATS: raise UnknownFormatError(f'Unknown file format {fmt}')
+    return fmt
+
+def format_backend(track_location): return FORMAT_BACKENDS[track_format(track_location)]
+
+if __name__ == "__main__":
+    import wave
+    import tempfile
+
+    # Minimal silent tracks of each format, as Mutagen needs them to save
+    def box(name, data): return struct.pack('>I4s', 8 + len(data), name) + data
+    def full_box(name, data): return box(name, b'\x00' * 4 + data)
+    def chunk(name, data): return struct.pack('>4sI', name, len(data)) + data
+    def make_mp3(): return (b'\xff\xfb\x90\x64' + b'\x00' * 413) * 10
+    def make_flac():
+        info = struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+        info += ((44100 << 44) | (1 << 41) | (15 << 36)).to_bytes(8, 'big') + b'\x00' * 16
+        return b'fLaC' + bytes([0x80, 0, 0, len(info)]) + info
+    def make_m4a():
+        entry = box(b'mp4a', b'\x00' * 6 + struct.pack('>H', 1) + b'\x00' * 8 + struct.pack('>HHHHI', 1, 16, 0, 0, 44100 << 16) + box(b'free', b''))
+        stbl = box(b'stbl', full_box(b'stsd', struct.pack('>I', 1) + entry) + full_box(b'stts', b'\x00' * 4) + \
+            full_box(b'stsc', b'\x00' * 4) + full_box(b'stsz', b'\x00' * 8) + full_box(b'stco', b'\x00' * 4))
+        mdia = box(b'mdia', full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, 44100, 441, 0, 0)) + \
+            full_box(b'hdlr', b'\x00' * 4 + b'soun' + b'\x00' * 13) + box(b'minf', stbl))
+        moov = box(b'moov', full_box(b'mvhd', struct.pack('>IIII', 0, 0, 44100, 441) + b'\x00' * 80) + box(b'trak', mdia))
+        return box(b'ftyp', b'M4A \x00\x00\x00\x00M4A isom') + moov + box(b'mdat', b'\x00' * 16)
+    def make_aiff():
+        rate = bytes([0x40, 0x0E, 0xAC, 0x44]) + b'\x00' * 6
+        comm = chunk(b'COMM', struct.pack('>hIh', 1, 441, 16) + rate)
+        return chunk(b'FORM', b'AIFF' + comm + chunk(b'SSND', b'\x00' * 8 + b'\x00\x00' * 441))
+    def make_wav():
+        b = io.BytesIO()
+        with wave.open(b, 'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            w.writeframes(b'\x00\x00' * 441)
+        return b.getvalue()
+    TRACKS = {'mp3': make_mp3, 'flac': make_flac, 'm4a': make_m4a, 'aiff': make_aiff, 'wav': make_wav}
+    assert(set(FORMAT_BACKENDS[ext] for ext in TRACKS) == set(FORMAT_BACKENDS.values()))
+
+    def audio(backend, f):
+        (start, end) = backend.audio_range(f)
+        return read_at(f, start, end - start)
+    EXPECTED = [('beatgrid', ['{"bpm": 120}']), ('comment', ['a', 'ünïcödé'])]
+
+    with tempfile.TemporaryDirectory() as d:
+        for (ext, make) in TRACKS.items():
+            path = os.path.join(d, f'track.{ext}')
+            with open(path, 'wb') as f: f.write(make())
+            backend = format_backend(path)
+            with open(path, 'rb') as f: (tags, original_audio) = (backend.load(f), audio(backend, f))
+            assert(udl_frames(tags) == [])
+            for (key, text) in EXPECTED: tags.add(txxx(key, text))
+            backend.save(path, tags)
+
+            with open(path, 'rb') as f:
+                assert(sorted(udl_frames(backend.load(f))) == EXPECTED)
+                assert(backend.load_txxx(f, f'{PREFIX}comment') == ['a', 'ünïcödé'])
+                assert(backend.load_txxx(f, f'{PREFIX}missing') is None)
+                assert(audio(backend, f) == original_audio)
+                lazy = load_lazy(backend, path, f)
+            assert(sorted((frame.desc[len(PREFIX):], list(frame.text)) for frame in lazy.getall('TXXX')) == EXPECTED)
+
+            # Removing a key removes it from the track
+            tags.delall(f'TXXX:{PREFIX}beatgrid')
+            backend.save(path, tags)
+            with open(path, 'rb') as f: assert(udl_frames(backend.load(f)) == EXPECTED[1:])
+            print(f'{ext}: round trip ok')
+
+        # MP3 tags are overwritten in place while they fit into the old tag's padding
+        path = os.path.join(d, 'track.mp3')
+        with open(path, 'wb') as f: f.write(make_mp3())
+        tags = ID3()
+        tags.add(txxx('beatgrid', ['{"bpm": 120}']))
+        assert(not MP3Format.fits_in_place(path, tags)) # There's no tag yet
+        MP3Format.save(path, tags)
+        size = os.path.getsize(path)
+        tags.add(txxx('beatgrid', ['{"bpm": 121.5}']))
+        assert(MP3Format.fits_in_place(path, tags))
+        MP3Format.save(path, tags)
+        assert(os.path.getsize(path) == size)
+        tags.add(txxx('comment', ['x' * 100000]))
+        assert(not MP3Format.fits_in_place(path, tags))
+        print('mp3: fits_in_place ok')
@@ -1,7 +1,10 @@
 import json
+import hashlib
 from mutagen.id3 import ID3,TXXX,Encoding
 
 PREFIX = "UDLF:"
+""" Key of the frame holding the digest of all other UDL frames. It is not one of the `keys()`. """
+DIGEST_KEY = "_digest"
 
 def tagDump(obj):
     if isinstance(obj, list):
@@ -31,6 +34,26 @@ class UDL_ID3:
             res = safeTagParse(tags[0])
             if not res is None: return res
         return None
+    """ Returns the raw text of all frames of a key without decoding it. """
+    def getraw(self, key):
+        return [list(t.text) for t in self.id3tags.getall(f'TXXX:{PREFIX}{key}')]
+    """ Replaces all frames of a key with frames holding the raw text in `raw`, or removes them if None. """
+    def setraw(self, key, raw):
+        if raw is None:
+            self.__delitem__(key)
+        else:
+            self.id3tags.setall(f'TXXX:{PREFIX}{key}', [
+                TXXX(desc=f'{PREFIX}{key}', encoding=Encoding.UTF8, text=text) for text in raw
+            ])
+    """ Returns the changes that turn this into `other` as a dict of key to raw text (None to delete). """
+    def rawdiff(self, other):
+        keys = set(self.keys()) | set(other.keys())
+        return {
+            k: (other.getraw(k) if k in other else None)
+            for k in sorted(keys) if self.getraw(k) != other.getraw(k)
+        }
+    def applyraw(self, changes):
+        for (k, raw) in changes.items(): self.setraw(k, raw)
     def __contains__(self, key):
         tags = self.id3tags.getall(f'TXXX:{PREFIX}{key}')
         return len(tags) > 0
@@ -49,9 +72,14 @@ class UDL_ID3:
     def __delitem__(self, key):
         self.id3tags.delall(f'TXXX:{PREFIX}{key}')
     
-    def assign(self, other, overwrite=False):
+    """
+        Copies the frames of `other` (only those of `keys` if given) without decoding them. Keys
+        already present are kept unless `overwrite` is set.
+    """
+    def assign(self, other, overwrite=False, keys=None):
         if not isinstance(other, UDL_ID3): raise ValueError('Not UDF ID3')
         for k in other:
+            if not keys is None and not k in keys: continue
             if overwrite or (not k in self):
                 tn = f'TXXX:{PREFIX}{k}'
                 self.id3tags.setall(tn, other.id3tags.getall(tn))
@@ -60,7 +88,7 @@ class UDL_ID3:
     
     def tags(self):
         tags = self.id3tags.getall(f'TXXX')
-        return filter(lambda t: t.desc.startswith(PREFIX), tags)
+        return filter(lambda t: t.desc.startswith(PREFIX) and t.desc != f'{PREFIX}{DIGEST_KEY}', tags)
     def tags_sorted_tuples(self): return sorted(map(lambda t: (t.desc, t.text), self.tags()))
     def items(self):
         return map(
@@ -76,6 +104,27 @@ class UDL_ID3:
     def __iter__(self): return set(self.keys()).__iter__()
     def __eq__(self, other): return self.tags_sorted_tuples() == other.tags_sorted_tuples()
 
+    """
+        Digest of the canonical encoding (sorted keys and their raw text) of all UDL frames.
+        Whoever keeps state about a track can store this and later compare it with
+        `stored_digest()` instead of decoding the data again.
+    """
+    def digest(self):
+        canonical = json.dumps([[d, list(t)] for (d, t) in self.tags_sorted_tuples()], separators=(',', ':'))
+        return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+    """ The digest as last saved, or None if the data has none (e.g. it was written by older versions). """
+    def stored_digest(self):
+        tags = self.id3tags.getall(f'TXXX:{PREFIX}{DIGEST_KEY}')
+        return tags[0].text[0] if len(tags) and len(tags[0].text) else None
+    """ Sets the digest frame to match the data; data without UDL keys gets no digest frame. """
+    def update_digest(self):
+        if not any(True for _ in self.tags()):
+            self.id3tags.delall(f'TXXX:{PREFIX}{DIGEST_KEY}')
+            return
+        self.id3tags.setall(f'TXXX:{PREFIX}{DIGEST_KEY}', [
+            TXXX(desc=f'{PREFIX}{DIGEST_KEY}', encoding=Encoding.UTF8, text=[self.digest()])
+        ])
+
     def __str__(self): return '\n'.join('='.join([str(o) for o in v]) for v in self.items())
 
 if __name__ == '__main__':
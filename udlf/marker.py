@@ -1,14 +1,27 @@
 import math
+from bisect import bisect_left,bisect_right
+from itertools import zip_longest
 from typing import Optional,List,Tuple,Union
-from dataclasses import dataclass
+from dataclasses import dataclass,replace
 from enum import Enum
 from abc import ABC,abstractmethod
-from .dictify import AutoDictify, undictify, undictifyDictUnion
+from .dictify import AutoDictify, dictify, undictify, undictifyDictUnion
 
 from .utiltypes import Color
 
-""" Region of constant tempo. """
+""" Tolerances for comparing UDL data semantically, e.g. after a round trip through other software. """
 @dataclass
+class Tolerance:
+    time: float = 1e-4 # Seconds
+    bpm: float = 1e-4
+
+""" Compares two optional values within a tolerance. """
+def approx(a, b, tol):
+    if a is None or b is None: return a is None and b is None
+    return abs(a - b) <= tol
+
+""" Region of constant tempo. """
+@dataclass(frozen=True, slots=True)
 class BeatgridRegion:
     length: float
     bpm: float
@@ -24,6 +37,10 @@ class BeatgridRegion:
         elif self.bpb != 4: return [self.length, self.bpm, self.bpb]
         else: return [self.length, self.bpm]
     
+    def approx_eq(self, other, tol):
+        return self.bpb == other.bpb and self.dbs == other.dbs and \
+            approx(self.length, other.length, tol.time) and approx(self.bpm, other.bpm, tol.bpm)
+    
     """ Number of beats (can be non-integer) in this region. """
     def beat_length(self): return self.beatindex(self.length)
     """ Returns a tuple of (length, beat_length) """
@@ -38,7 +55,7 @@ class BeatgridRegion:
         return index / (self.bpm / 60.0)
 
 """ Utility class for a single beat """
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Beat:
     index: int
     position: float
@@ -77,52 +94,93 @@ class Beat:
 
 """ Iterator over beats """
 class Beats:
-    beatgrid = None
-    pos: float # Position of current region
-    index: int = 0 # Beat index of iterator
-    index_sum: float = 0 # Beat index of current region
-    region_i: int = 0 # Index of current region
-    dbi: int = 0 # Downbeat index
+    __slots__ = (
+        'beatgrid',
+        'pos', # Position of current region
+        'index', # Beat index of iterator
+        'index_sum', # Beat index of current region
+        'region_i', # Index of current region
+        'dbi', # Downbeat index
+        # Cached properties of the current region
+        'region', 'el', 'eb', 'bps', 'is_last'
+    )
     def __init__(self, g):
         self.beatgrid = g
         self.pos = g.start
+        self.index = 0
+        self.index_sum = 0
+        self.region_i = 0
+        self.dbi = 0
         if len(g.regions) and not g.regions[0].dbs is None:
             self.dbi = g.regions[0].dbs
+        self.enter_region()
+    def enter_region(self):
+        if self.region_i >= len(self.beatgrid.regions):
+            self.region = None
+            return
+        self.region = self.beatgrid.regions[self.region_i]
+        (self.el, self.eb) = self.region.elapsed()
+        self.bps = self.region.bpm / 60.0
+        self.is_last = self.region_i == (len(self.beatgrid.regions) - 1)
     def __iter__(self): return Beats(self.beatgrid)
-    def __next__(self):
+    def __next__(self): return Beat(*self.next_tuple())
+    """ Advances the iterator, returning the next beat as an (index, position, is_downbeat) tuple. """
+    def next_tuple(self):
         while True:
-            region = self.beatgrid.regions[self.region_i]
-            (el, eb) = region.elapsed()
-            
-            is_in_region = self.index - self.index_sum < eb
-            is_on_border = self.index - self.index_sum == eb
-            is_last = self.region_i == (len(self.beatgrid.regions) - 1)
-            if is_in_region or (is_on_border and is_last): # We're still in this region
-                beat = Beat.create(
-                    self.index,
-                    region.bpb,
-                    self.dbi,
-                    self.pos + region.beatpos(self.index - self.index_sum)
-                )
+            if self.region is None: raise StopIteration
+            offset = self.index - self.index_sum
+            if offset < self.eb or (offset == self.eb and self.is_last): # We're still in this region
+                index = self.index
                 self.index += 1
-                return beat
-            
-            self.pos += el
-            self.index_sum += eb
+                return (index, self.pos + offset / self.bps, (index - self.dbi) % self.region.bpb == 0)
             
-            self.region_i += 1
-            if self.region_i >= len(self.beatgrid.regions): raise StopIteration
-            
-            # Set the downbeat index to shift into the current region
-            # If switching time signatures, this is necessary to ensure the time signature is done
-            # relative to the shift, and not relative to the start of the track
-            # Alignment is done to the LAST downbeat, so if the switch is done on an off beat, expect
-            # beat alignment to be with respect to the last downbeat of the previous region
-            self.dbi = self.index - ((self.index - self.dbi) % region.bpb) # Calculates LAST downbeat
-            self.dbi -= self.beatgrid.regions[self.region_i].dbs
+            if not self.next_region(): raise StopIteration
+    """ Moves on to the next region once `index` is past the current one. Returns False at the end of the grid. """
+    def next_region(self):
+        self.pos += self.el
+        self.index_sum += self.eb
+        
+        self.region_i += 1
+        if self.region_i >= len(self.beatgrid.regions):
+            self.region = None
+            return False
+        
+        # Set the downbeat index to shift into the current region
+        # If switching time signatures, this is necessary to ensure the time signature is done
+        # relative to the shift, and not relative to the start of the track
+        # Alignment is done to the LAST downbeat, so if the switch is done on an off beat, expect
+        # beat alignment to be with respect to the last downbeat of the previous region
+        self.dbi = self.index - ((self.index - self.dbi) % self.region.bpb) # Calculates LAST downbeat
+        self.enter_region()
+        self.dbi -= self.region.dbs
+        return True
+    """ Index of the first beat after the current region, as reached by iterating. """
+    def region_end_index(self):
+        end = max(self.index, math.ceil(self.index_sum + self.eb) - 1)
+        while end - self.index_sum < self.eb or (end - self.index_sum == self.eb and self.is_last): end += 1
+        return end
+    """
+        Moves the iterator forward to the first beat at or after `position`, skipping whole regions
+        and the beats before it without visiting them. Positions are computed exactly as when iterating.
+    """
+    def seek(self, position):
+        while not self.region is None and not self.is_last and self.pos + self.el < position:
+            self.index = self.region_end_index()
+            self.next_region()
+        if self.region is None: return self
+        index = max(self.index, math.ceil(self.index_sum + (position - self.pos) * self.bps))
+        while index > self.index and self.pos + (index - 1 - self.index_sum) / self.bps >= position: index -= 1
+        while self.pos + (index - self.index_sum) / self.bps < position: index += 1
+        self.index = index if self.is_last else min(index, self.region_end_index())
+        return self
+""" Iterator over beats as plain (index, position, is_downbeat) tuples, without creating `Beat` objects """
+class BeatTuples(Beats):
+    __slots__ = ()
+    def __iter__(self): return BeatTuples(self.beatgrid)
+    def __next__(self): return self.next_tuple()
 
 """ Information about a beatgrid region """
-@dataclass
+@dataclass(frozen=True, slots=True)
 class BeatgridRegionMeta(object):
     """ Start position of beatgrid """
     start: float
@@ -140,13 +198,19 @@ class BeatgridRegionMeta(object):
         return not self.empty() and beat >= self.firstbeat and beat <= self.lastbeat
 """ Iterator over beatgrid regions """
 class BeatgridRegions:
-    region_i: int = 0 # Index of current region
-    pos: float = 0.0 # Position of current region
-    index: float = 0.0 # Beat index of current region
-    dbi: int = 0 # Downbeat index
+    __slots__ = (
+        'beatgrid',
+        'region_i', # Index of current region
+        'pos', # Position of current region
+        'index', # Beat index of current region
+        'dbi' # Downbeat index
+    )
     def __init__(self, g):
         self.beatgrid = g
+        self.region_i = 0
         self.pos = g.start
+        self.index = 0.0
+        self.dbi = 0
         if len(g.regions) and not g.regions[0].dbs is None:
             self.dbi = g.regions[0].dbs
     def __iter__(self): return BeatgridRegions(self.beatgrid)
@@ -189,11 +253,95 @@ class BeatgridRegions:
         return (BeatgridRegionMeta(start, end, firstbeat, lastbeat, dbi), region)
 
 """ A beatgrid of one or more regions of constant tempo. """
-@dataclass
+@dataclass(slots=True)
 class Beatgrid(AutoDictify):
     start: float
     regions: List[BeatgridRegion]
     
+    def approx_eq(self, other, tol):
+        return approx(self.start, other.start, tol.time) and len(self.regions) == len(other.regions) and \
+            all(a.approx_eq(b, tol) for (a, b) in zip(self.regions, other.regions))
+    
+    """ Downbeat index (as used by `Beats`) in effect at the start of each region. """
+    def downbeat_phases(self):
+        phases = []
+        dbi = 0
+        index_sum = 0.0
+        for (i, region) in enumerate(self.regions):
+            if i == 0:
+                if not region.dbs is None: dbi = region.dbs
+            else:
+                t = math.ceil(index_sum) # First beat of this region
+                dbi = t - ((t - dbi) % self.regions[i-1].bpb) - region.dbs
+            phases.append(dbi)
+            index_sum += region.beat_length()
+        return phases
+    
+    """
+        Returns a simplified copy of this grid and the largest distance (in seconds) any beat was
+        moved by. Adjacent regions which continue the same bar and whose tempo differs by at most
+        `tol.bpm` are merged as long as no region border moves by more than `tol.time`; zero-length
+        regions are dropped, and `dbs` is recomputed so downbeats stay on the same beats. If the
+        result would not have the same beats, the grid is returned unchanged.
+    """
+    def normalize(self, tol=Tolerance()):
+        if not len(self.regions): return (self, 0.0)
+        phases = self.downbeat_phases()
+        
+        # Runs of regions to merge. Region borders inside a run are kept as (elapsed, elapsed beats)
+        # to measure how far merging moves them.
+        class Run:
+            def __init__(self, i): (self.first, self.length, self.beats, self.bpms, self.borders) = (i, 0.0, 0.0, set(), [])
+            def bpm(self):
+                return next(iter(self.bpms)) if len(self.bpms) == 1 else 60.0 * self.beats / self.length
+            def error(self, bpm):
+                return max((abs(el - eb * 60.0 / bpm) for (el, eb) in self.borders), default=0.0)
+            def add(self, i, region):
+                if region.length <= 0: return
+                if len(self.bpms): self.borders.append((self.length, self.beats))
+                else: self.first = i
+                self.length += region.length
+                self.beats += region.beat_length()
+                self.bpms.add(region.bpm)
+        def can_merge(run, i, region):
+            if region.length <= 0 or not len(run.bpms): return True
+            main = self.regions[run.first]
+            if region.bpb != main.bpb or (phases[i] - phases[run.first]) % main.bpb != 0: return False
+            if run.bpms == {region.bpm}: return True
+            if abs(region.bpm - run.bpm()) > tol.bpm: return False
+            bpm = 60.0 * (run.beats + region.beat_length()) / (run.length + region.length)
+            return max(run.error(bpm), abs(run.length - run.beats * 60.0 / bpm)) <= tol.time
+        
+        runs = []
+        for (i, region) in enumerate(self.regions):
+            if not len(runs) or not can_merge(runs[-1], i, region): runs.append(Run(i))
+            runs[-1].add(i, region)
+        
+        regions = []
+        (index_sum, dbi) = (0.0, 0)
+        for run in runs:
+            if not len(run.bpms): continue # Only zero-length regions
+            bpb = self.regions[run.first].bpb
+            target = phases[run.first]
+            if not len(regions):
+                dbs = target % bpb
+                dbi = dbs
+            else:
+                t = math.ceil(index_sum)
+                last_downbeat = t - ((t - dbi) % regions[-1].bpb)
+                dbs = (last_downbeat - target) % bpb
+                dbi = last_downbeat - dbs
+            regions.append(BeatgridRegion(run.length, run.bpm(), bpb, dbs))
+            index_sum += regions[-1].beat_length()
+        if not len(regions): return (self, 0.0)
+        
+        grid = Beatgrid(self.start, regions)
+        error = 0.0
+        for (a, b) in zip_longest(self.beat_tuples(), grid.beat_tuples()):
+            if a is None or b is None or a[0] != b[0] or a[2] != b[2]: return (self, 0.0)
+            error = max(error, abs(a[1] - b[1]))
+        return (grid, error)
+    
     """ Index of beat at a position. Returns None if outside. """
     def beatindex(self, pos):
         beat = self.beat(position=pos)
@@ -219,14 +367,130 @@ class Beatgrid(AutoDictify):
         return None
     
     def beats(self): return Beats(self)
+    def beat_tuples(self): return BeatTuples(self)
+    """ Beats positioned between `t0` and `t1` (inclusive), found without iterating the beats before `t0`. """
+    def beats_between(self, t0, t1):
+        beats = Beats(self).seek(t0)
+        while True:
+            try:
+                (index, position, is_downbeat) = beats.next_tuple()
+            except StopIteration:
+                return
+            if position > t1: return
+            yield Beat(index, position, is_downbeat)
     def regions_meta(self): return BeatgridRegions(self)
+    
+    """
+        Positions of many beat indices at once (see `beatpos`), in a single sweep over the regions.
+        Returns a list matching `indices`, with None for indices outside the grid.
+    """
+    def beatpositions(self, indices):
+        res = [None] * len(indices)
+        metas = [(meta, region) for (meta, region) in self.regions_meta() if not meta.empty()]
+        if not len(metas): return res
+        r = 0
+        for i in sorted(range(len(indices)), key=lambda i: indices[i]):
+            index = indices[i]
+            while r < len(metas) - 1 and index > metas[r][0].lastbeat.index: r += 1
+            (meta, region) = metas[r]
+            if index < meta.firstbeat.index or index > meta.lastbeat.index: continue
+            pos = region.beatpos(index - meta.firstbeat.index)
+            if not pos is None: res[i] = pos + meta.firstbeat.position
+        return res
+    
+    """
+        Resolves a list of markers (see `Marker.resolve`) at once, in a single sweep over the
+        regions. None entries stay None.
+    """
+    def resolve_markers(self, markers):
+        indices = []
+        for marker in markers:
+            if isinstance(marker, BeatgridMarker):
+                indices.append(marker.beat)
+                if marker.beats: indices.append(marker.beat + marker.beats)
+        positions = iter(self.beatpositions(indices))
+        res = []
+        for marker in markers:
+            if isinstance(marker, BeatgridMarker):
+                start = next(positions)
+                end = next(positions) if marker.beats else None
+                res.append(None if start is None else (start, end))
+            else:
+                res.append(None if marker is None else marker.resolve(self))
+        return res
+    
+    """
+        Moves each position to the nearest beat (or downbeat if `downbeats`), in a single sweep over
+        the regions. Returns a list matching `positions`; positions stay unchanged if the grid has
+        no beats to snap to.
+    """
+    def snap_positions(self, positions, downbeats=False):
+        # Snap targets in each region are at beat indices k0, k0 + step, ..., k0 + count * step
+        # relative to its first beat
+        metas = []
+        spans = []
+        for (meta, region) in self.regions_meta():
+            metas.append(meta)
+            if meta.empty():
+                spans.append(None)
+                continue
+            nb = meta.lastbeat.index - meta.firstbeat.index
+            (k0, step) = (meta.dbi, region.bpb) if downbeats else (0, 1)
+            spans.append(None if k0 > nb else (meta.firstbeat.position, region.bpm / 60.0, k0, step, (nb - k0) // step))
+        def target(span, j):
+            (first, bps, k0, step, count) = span
+            return first + (k0 + j * step) / bps
+        def nearest(span, p):
+            (first, bps, k0, step, count) = span
+            j = round(((p - first) * bps - k0) / step)
+            return target(span, min(max(j, 0), count))
+        
+        # Closest targets in earlier and later regions, for positions near region borders
+        prev_last = []
+        last = None
+        for span in spans:
+            if not span is None: last = target(span, span[4])
+            prev_last.append(last)
+        next_first = [None] * len(spans)
+        first = None
+        for r in range(len(spans) - 1, -1, -1):
+            if not spans[r] is None: first = target(spans[r], 0)
+            next_first[r] = first
+        
+        res = list(positions)
+        if not len(metas): return res
+        r = 0
+        for i in sorted(range(len(res)), key=lambda i: res[i]):
+            p = res[i]
+            while r < len(metas) - 1 and p >= metas[r].end: r += 1
+            candidates = [
+                nearest(spans[r], p) if not spans[r] is None else None,
+                prev_last[r-1] if r > 0 else None,
+                next_first[r+1] if r + 1 < len(spans) else None
+            ]
+            candidates = [c for c in candidates if not c is None]
+            if len(candidates): res[i] = min(candidates, key=lambda c: abs(c - p))
+        return res
+    
+    """
+        Quantizes a list of markers to the nearest beat (or downbeat if `downbeats`). Timed markers
+        are moved, keeping their length; other markers and None entries are returned unchanged.
+    """
+    def quantize(self, markers, downbeats=False):
+        timed = [m.position for m in markers if isinstance(m, TimedMarker)]
+        snapped = iter(self.snap_positions(timed, downbeats))
+        return [replace(m, position=next(snapped)) if isinstance(m, TimedMarker) else m for m in markers]
 
 """ A point or region within a song. """
 class Marker(ABC):
+    __slots__ = ()
     name: Optional[str] = None
     color: Optional[Color] = None
     @abstractmethod
     def absolute(self): pass
+    """ Compares two markers, allowing positions to differ within `tol`. """
+    def approx_eq(self, other, tol):
+        return type(self) == type(other) and self.name == other.name and self.color == other.color
     @staticmethod
     def undictify(v, undictifiers=None): return undictifyDictUnion(v, "type", {
         "timed": TimedMarker, "beatgrid": BeatgridMarker
@@ -240,7 +504,7 @@ class Marker(ABC):
     def resolve(self, beatgrid): pass
 
 """ A marker tied to a particular time value. """
-@dataclass
+@dataclass(frozen=True, slots=True)
 class TimedMarker(AutoDictify, Marker):
     position: float
     length: Optional[float] = None
@@ -249,12 +513,16 @@ class TimedMarker(AutoDictify, Marker):
     color: Optional[Color] = None
     
     def absolute(self): return True
-    def dictify(self, dictifiers=None): return {"type": "timed", **super().dictify(dictifiers)}
+    # Zero-argument super() does not work in slotted dataclasses
+    def approx_eq(self, other, tol):
+        return Marker.approx_eq(self, other, tol) and approx(self.position, other.position, tol.time) and \
+            approx(self.length, other.length, tol.time)
+    def dictify(self, dictifiers=None): return {"type": "timed", **AutoDictify.dictify(self, dictifiers)}
     def resolve(self, beatgrid):
         return (self.position, self.position + self.length if self.length else None)
 
 """ A marker tied to a particular beat on the beatgrid. """
-@dataclass
+@dataclass(frozen=True, slots=True)
 class BeatgridMarker(AutoDictify, Marker):
     beat: int
     beats: Optional[int] = None
@@ -263,10 +531,90 @@ class BeatgridMarker(AutoDictify, Marker):
     color: Optional[Color] = None
     
     def absolute(self): return False
-    def dictify(self, dictifiers=None): return {"type": "beatgrid", **super().dictify(dictifiers)}
+    def approx_eq(self, other, tol):
+        return Marker.approx_eq(self, other, tol) and self.beat == other.beat and self.beats == other.beats
+    def dictify(self, dictifiers=None): return {"type": "beatgrid", **AutoDictify.dictify(self, dictifiers)}
     def resolve(self, beatgrid):
-        if not beatgrid is None: return None
-        return (beatgrid.beatpos(self.beat), beatgrid.beatpos(self.beat + self.beats) if self.beats else None)
+        if beatgrid is None: return None
+        start = beatgrid.beatpos(self.beat)
+        if start is None: return None
+        return (start, beatgrid.beatpos(self.beat + self.beats) if self.beats else None)
+
+""" Resolves a list of markers at once (see `Beatgrid.resolve_markers`). `beatgrid` may be None. """
+def resolve_markers(markers, beatgrid):
+    if beatgrid is None: return [None if m is None else m.resolve(None) for m in markers]
+    return beatgrid.resolve_markers(markers)
+
+"""
+    Markers of one kind (e.g. hotcues), stored sparsely by slot, with an index of their positions
+    for range and neighbour queries in O(log n). The index is built from `beatgrid` when the set
+    is created, and again on the first query after a change; markers that can't be resolved
+    (see `Marker.resolve`) are left out of it. Queries return (slot, marker, (start, end)) tuples.
+"""
+class MarkerSet:
+    __slots__ = ('slots', 'beatgrid', '_index', '_starts')
+    def __init__(self, markers = {}, beatgrid = None):
+        if isinstance(markers, dict): self.slots = {s: m for (s, m) in markers.items() if not m is None}
+        else: self.slots = {s: m for (s, m) in enumerate(markers) if not m is None}
+        self.beatgrid = beatgrid
+        self.build_index()
+    """ Decodes a stored marker list without creating entries for its empty slots. """
+    @staticmethod
+    def undictify(v, beatgrid=None, undictifiers=None):
+        if not isinstance(v, list): raise ValueError('Not a list')
+        return MarkerSet({s: undictify(Marker, m, undictifiers) for (s, m) in enumerate(v) if not m is None}, beatgrid)
+    def dictify(self, dictifiers=None): return dictify(self.to_list(), dictifiers)
+    """ The markers as a list indexed by slot, with None for empty slots. """
+    def to_list(self):
+        if not len(self.slots): return []
+        return [self.slots.get(s) for s in range(max(self.slots) + 1)]
+    
+    def build_index(self):
+        slots = sorted(self.slots)
+        resolved = resolve_markers([self.slots[s] for s in slots], self.beatgrid)
+        self._index = sorted((r[0], s, r[1]) for (s, r) in zip(slots, resolved) if not r is None)
+        self._starts = [e[0] for e in self._index]
+    def starts(self):
+        if self._index is None: self.build_index()
+        return self._starts
+    def entry(self, i):
+        (start, slot, end) = self._index[i]
+        return (slot, self.slots[slot], (start, end))
+    
+    def __len__(self): return len(self.slots)
+    def __contains__(self, slot): return slot in self.slots
+    def __getitem__(self, slot): return self.slots.get(slot)
+    def __setitem__(self, slot, marker):
+        if not isinstance(marker, Marker) and not marker is None: raise ValueError('Not a marker')
+        if marker is None: self.slots.pop(slot, None)
+        else: self.slots[slot] = marker
+        self._index = None
+    def __delitem__(self, slot):
+        del self.slots[slot]
+        self._index = None
+    """ (slot, marker) pairs ordered by slot """
+    def items(self): return sorted(self.slots.items())
+    
+    """ Markers starting between `t0` and `t1` (inclusive), ordered by position. """
+    def between(self, t0, t1):
+        starts = self.starts()
+        return [self.entry(i) for i in range(bisect_left(starts, t0), bisect_right(starts, t1))]
+    """ The first marker starting after `t`, or None. """
+    def next_after(self, t):
+        starts = self.starts()
+        i = bisect_right(starts, t)
+        return self.entry(i) if i < len(starts) else None
+    """ The last marker starting before `t`, or None. """
+    def prev_before(self, t):
+        i = bisect_left(self.starts(), t)
+        return self.entry(i - 1) if i > 0 else None
+    """ The marker starting closest to `t`, or None if no marker could be resolved. """
+    def nearest(self, t):
+        starts = self.starts()
+        i = bisect_left(starts, t)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(starts)]
+        if not len(candidates): return None
+        return self.entry(min(candidates, key=lambda j: abs(starts[j] - t)))
 
 if __name__ == "__main__":
     d1 = TimedMarker(1.0, name='Hotcue 1', color=Color(255,0,0)).dictify()
@@ -362,6 +710,75 @@ if __name__ == "__main__":
             lastbeat=Beat(index=4, position=6.0, is_downbeat=True))
     ])
     
+    tol = Tolerance()
+    assert(grid.approx_eq(Beatgrid(4.0 + 1e-6, [BeatgridRegion(1.0, 120.0 - 1e-6), *grid.regions[1:]]), tol))
+    assert(not grid.approx_eq(Beatgrid(4.01, grid.regions), tol))
+    assert(not grid.approx_eq(Beatgrid(4.0, grid.regions[1:]), tol))
+    assert(TimedMarker(1.0, 0.5).approx_eq(TimedMarker(1.0 + 1e-9, 0.5), tol))
+    assert(not TimedMarker(1.0).approx_eq(TimedMarker(1.0, 0.5), tol))
+    assert(not TimedMarker(1.0).approx_eq(BeatgridMarker(1), tol))
+    assert(not TimedMarker(1.0, name='a').approx_eq(TimedMarker(1.0, name='b'), tol))
+    
+    assert([*grid.beat_tuples()] == [(b.index, b.position, b.is_downbeat) for b in grid.beats()])
+    assert([*Beatgrid(0.0, []).beats()] == [])
+    
+    # Value types are compact and hashable
+    m = TimedMarker(1.0, name='Hotcue 1', color=Color(255,0,0))
+    assert(not hasattr(m, '__dict__') and not hasattr(grid.regions[0], '__dict__'))
+    assert(len({m, TimedMarker(1.0, name='Hotcue 1', color=Color(255,0,0)), BeatgridMarker(1)}) == 2)
+    assert(Marker.undictify(m.dictify()) == m)
+    assert(Marker.undictify(BeatgridMarker(1, 4).dictify()) == BeatgridMarker(1, 4))
+    
+    # Batch resolution and quantization agree with the per-beat lookups
+    for g in (grid, Beatgrid(4.0, [BeatgridRegion(2.0, 120.0), BeatgridRegion(1.5, 120.0, 3), BeatgridRegion(2.0, 120.0, 3, 1)])):
+        indices = [7, -1, 0, 3, 100, 2, 4, 11, 5]
+        assert(g.beatpositions(indices) == [g.beatpos(i) for i in indices])
+        markers = [BeatgridMarker(2, 2), None, TimedMarker(4.2, 1.0), BeatgridMarker(50), BeatgridMarker(1)]
+        assert(g.resolve_markers(markers) == [None if m is None else m.resolve(g) for m in markers])
+        assert(resolve_markers(markers, None) == [None, None, (4.2, 5.2), None, None])
+        beats = [*g.beats()]
+        for downbeats in (False, True):
+            targets = [b.position for b in beats if b.is_downbeat or not downbeats]
+            positions = [3.0, 4.3, 5.74, 5.9, 7.2, 9.0, 12.0, 6.1]
+            assert(g.snap_positions(positions, downbeats) == [min(targets, key=lambda t: abs(t - p)) for p in positions])
+        assert(g.quantize([TimedMarker(4.3, 0.5), None]) == [TimedMarker(4.5, 0.5), None])
+    
+    # Normalization merges compatible regions and keeps beats and downbeats in place
+    per_bar = Beatgrid(0.5, [BeatgridRegion(2.0, 120.0) for i in range(8)] + [BeatgridRegion(0.0, 90.0, 3)] + \
+        [BeatgridRegion(2.0, 120.0 + 1e-5, 4, 4), BeatgridRegion(1.5, 120.0, 3, 1), BeatgridRegion(1.5, 120.0, 3)])
+    (normalized, error) = per_bar.normalize()
+    print(normalized, error)
+    assert([(r.length, r.bpb) for r in normalized.regions] == [(18.0, 4), (3.0, 3)])
+    assert(error < 1e-4 and normalized.normalize()[1] == 0.0)
+    assert([(i, d) for (i, p, d) in normalized.beat_tuples()] == [(i, d) for (i, p, d) in per_bar.beat_tuples()])
+    (normalized, error) = per_bar.normalize(Tolerance(time=0.0, bpm=0.0))
+    assert(len(normalized.regions) == 3 and error == 0.0)
+    (normalized, error) = grid.normalize()
+    assert([*normalized.beat_tuples()] == [*grid.beat_tuples()] and len(normalized.regions) == 1)
+    
+    # Range lookups agree with iterating the whole grid
+    for g in (grid, per_bar, Beatgrid(4.0, [BeatgridRegion(2.0, 120.0), BeatgridRegion(1.5, 120.0, 3), BeatgridRegion(2.0, 120.0, 3, 1)]),
+              Beatgrid(0.3, [BeatgridRegion(7.1, 128.0), BeatgridRegion(0.0, 90.0), BeatgridRegion(3.3, 97.5, 3, 2)])):
+        beats = [*g.beats()]
+        for t0 in [-1.0, 0.0, 0.3, 4.0, 4.1, 5.875, 6.0, 7.5, 7.4, 9.5, 10.0, 18.0] + [b.position for b in beats]:
+            for t1 in (t0, t0 + 0.5, t0 + 3.0, 100.0):
+                assert([*g.beats_between(t0, t1)] == [b for b in beats if t0 <= b.position <= t1])
+    
+    # Sparse marker sets
+    markers = [None, TimedMarker(30.0), None, None, BeatgridMarker(8), TimedMarker(1.0, 2.0), BeatgridMarker(1000)]
+    ms = MarkerSet(markers, grid)
+    assert(len(ms) == 4 and ms.to_list() == markers and ms[2] is None and ms[1] == TimedMarker(30.0))
+    assert(MarkerSet.undictify(dictify(markers), grid).to_list() == markers and ms.dictify() == dictify(markers))
+    assert([e[0] for e in ms.between(0.0, 100.0)] == [5, 1]) # Slot 4 is outside the grid, 6 can't be resolved
+    assert(ms.between(1.0, 1.0) == [(5, TimedMarker(1.0, 2.0), (1.0, 3.0))])
+    assert(ms.next_after(1.0)[0] == 1 and ms.next_after(30.0) is None)
+    assert(ms.prev_before(30.0)[0] == 5 and ms.prev_before(1.0) is None)
+    assert(ms.nearest(10.0)[0] == 5 and ms.nearest(20.0)[0] == 1)
+    ms[4] = TimedMarker(10.0)
+    del ms[1]
+    assert([e[0] for e in ms.between(0.0, 100.0)] == [5, 4] and ms.to_list()[1] is None and ms.nearest(100.0)[0] == 4)
+    assert(MarkerSet().nearest(1.0) is None and MarkerSet().to_list() == [])
+    
     print()
     print(grid.dictify())
     assert(grid.dictify() == {'start': 4.0, 'regions': [[1.0, 120.0], [0.75, 120.0], [0.125, 120.0], [0.375, 120.0]]})
@@ -3,58 +3,137 @@ import os
 from typing import List,Optional
 from mutagen import MutagenError
 from mutagen.id3 import ID3
-from mutagen.id3._util import ID3NoHeaderError
 
-from .id3 import UDL_ID3
+from .id3 import UDL_ID3,PREFIX,DIGEST_KEY
 from .dictify import dictify,undictify
-from .marker import Beatgrid,Marker
-
-class UnknownFormatError(ValueError): pass
+from .marker import Beatgrid,Marker,MarkerSet,Tolerance
+from .formats import UnknownFormatError,FORMATS,track_format,format_backend,file_stamp,load_lazy,materialize
 
 class TrackInfo(UDL_ID3):
-    def __init__(self, track_location, tags = None):
+    """
+        `storage` is the backend the info was loaded from and is saved to. If it is None, the
+        info is stored in the track's own tags. `lazy` is set if `tags` only hold the UDL frames
+        of the track, as loaded by `load(lazy=True)`.
+    """
+    def __init__(self, track_location, tags = None, storage = None, lazy = False):
         if tags is None: tags = ID3()
         super().__init__(tags)
         self.track_location = track_location
+        self.storage = storage
+        self.lazy = lazy
+    """
+        Loads the info from a track. `fileobj` may be given to read the tags from instead of the file itself.
+        With `lazy`, only the keys of the UDL data and where it is stored are read; each value is
+        read when it is first accessed, and values that are only moved to other infos (see
+        `assign`) are read when those are saved.
+    """
     @staticmethod
-    def load(track_location):
-        fmt = track_location.split('.')[-1].lower()
-        if fmt == 'mp3':
-            t = ID3()
-
+    def load(track_location, fileobj = None, lazy = False):
+        backend = format_backend(track_location)
+        load = (lambda f: load_lazy(backend, track_location, f)) if lazy else backend.load
+        try:
+            if fileobj is None:
+                with open(track_location, 'rb') as f: t = load(f)
+            else:
+                t = load(fileobj)
+        except MutagenError as e:
+            # Mutagen does not properly set __cause__
+            # I don't want to throw MutagenErrors out because the outside code
+            # should be independent of Mutagen
+            # Mutagen also sometimes encapsulates its own errors inside MutagenErrors
+            raise e.args[0] if e.args and isinstance(e.args[0], Exception) else e
+        return TrackInfo(track_location, t, lazy=lazy)
+    """
+        Reads only the digest saved with the track's UDL data (see `UDL_ID3.digest`), without
+        decoding anything else. Returns None if there is none.
+    """
+    @staticmethod
+    def load_digest(track_location, fileobj = None):
+        backend = format_backend(track_location)
+        try:
+            if fileobj is None:
+                with open(track_location, 'rb') as f: text = backend.load_txxx(f, f'{PREFIX}{DIGEST_KEY}')
+            else:
+                text = backend.load_txxx(fileobj, f'{PREFIX}{DIGEST_KEY}')
+        except MutagenError as e:
+            raise e.args[0] if e.args and isinstance(e.args[0], Exception) else e
+        return text[0] if not text is None and len(text) else None
+    """
+        `write(track_location, tags)` writes the tags to the track instead of the format's own save
+        (see `util.writer`). It is not used by storages that keep the data elsewhere.
+    """
+    def save(self, write = None):
+        if not self.storage is None: return self.storage.save(self, write)
+        self.write_tags(write)
+    """ Writes the info to the track's own tags, bypassing its storage """
+    def write_tags(self, write = None):
+        if self.lazy:
+            # The other tags of the track have to be written back as well
+            full = TrackInfo.load(self.track_location)
+            full.clear()
+            full.assign(self, overwrite=True)
+            (self.id3tags, self.lazy) = (full.id3tags, False)
+        self.update_digest()
+        materialize(self.id3tags)
+        if write is None: write = format_backend(self.track_location).save
+        write(self.track_location, self.id3tags)
+    
+    """
+        Tests if this holds the same UDL data as `other`. Beatgrids and markers are compared
+        semantically, allowing positions and tempos to differ within `tol`; all other keys must
+        be identical.
+    """
+    def equivalent(self, other, tol = Tolerance()):
+        keys = set(self.keys())
+        if keys != set(other.keys()): return False
+        for key in keys:
+            if self.getraw(key) == other.getraw(key): continue
             try:
-                try: t.load(track_location)
-                except MutagenError as e:
-                    # Mutagen does not properly set __cause__
-                    # I don't want to throw MutagenErrors out because the outside code
-                    # should be independent of Mutagen
-                    # Mutagen also sometimes encapsulates its own errors inside MutagenErrors
-                    # So I need to first break the encapsulation with the outer try
-                    raise e.args[0] if e.args and isinstance(e.args[0], Exception) else e
-            except ID3NoHeaderError: pass # We may not have a header yet
-
-            return TrackInfo(track_location, t)
-        else:
-            raise UnknownFormatError(f'Unknown file format {fmt}')
-    def save(self):
-        fmt = self.track_location.split('.')[-1].lower()
-        if fmt == 'mp3':
-            self.id3tags.save(self.track_location)
-        else:
-            raise UnknownFormatError(f'Unknown file format {fmt}')
+                if key == 'beatgrid':
+                    if not self.getbeatgrid().approx_eq(other.getbeatgrid(), tol): return False
+                elif key.startswith('markers/'):
+                    name = key[len('markers/'):]
+                    (a, b) = (self.getmarkers(name), other.getmarkers(name))
+                    if len(a) != len(b): return False
+                    for (ma, mb) in zip(a, b):
+                        if ma is None or mb is None:
+                            if not (ma is None and mb is None): return False
+                        elif not ma.approx_eq(mb, tol): return False
+                else:
+                    return False
+            except Exception:
+                # Undecodable data is only equivalent if it is identical
+                return False
+        return True
     
     def getbeatgrid(self):
         beatgrid = self["beatgrid"]
         if beatgrid is None: return None
         return undictify(Beatgrid, beatgrid)
-    def setbeatgrid(self, beatgrid):
+    """
+        Stores a beatgrid, normalizing it first (see `Beatgrid.normalize`) unless `normalize` is
+        False. Returns the largest distance in seconds a beat was moved by normalizing.
+    """
+    def setbeatgrid(self, beatgrid, tol = Tolerance(), normalize = True):
         if type(beatgrid) != Beatgrid: raise ValueError('Not a beatgrid')
+        error = 0.0
+        if normalize: (beatgrid, error) = beatgrid.normalize(tol)
         self["beatgrid"] = dictify(beatgrid)
+        return error
     
     def getmarkers(self, name):
         markers = self[f"markers/{name}"]
         return [] if markers is None else undictify(List[Optional[Marker]], markers)
+    """
+        Markers of a kind as a `MarkerSet`, for position queries. They are placed on `beatgrid`,
+        which defaults to the track's own.
+    """
+    def getmarkerset(self, name, beatgrid = None):
+        markers = self[f"markers/{name}"]
+        if beatgrid is None: beatgrid = self.getbeatgrid()
+        return MarkerSet({}, beatgrid) if markers is None else MarkerSet.undictify(markers, beatgrid)
     def setmarkers(self, name, markers):
+        if isinstance(markers, MarkerSet): markers = markers.to_list()
         if not isinstance(markers, list): raise ValueError('Not a list')
         for marker in markers:
             if not isinstance(marker, Marker) and not marker is None:
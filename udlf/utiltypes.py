@@ -3,7 +3,7 @@ from typing import Tuple
 
 from .dictify import undictify
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Color:
     R: int
     G: int
@@ -19,3 +19,5 @@ if __name__ == "__main__":
     
     assert(Color(255, 0, 0) == Color.undictify([255,0,0]))
     assert(Color(255, 0, 0).dictify() == [255,0,0])
+    assert(len({Color(255, 0, 0), Color(255, 0, 0)}) == 1)
+    assert(not hasattr(Color(255, 0, 0), '__dict__'))
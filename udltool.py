@@ -2,8 +2,9 @@ import sys
 import argparse
 import logging
 from commands import COMMANDS
-from util.library import Library
+from util.library import library_from_args
 from util.info import NAME,DESC,VERSION
+from util.events import events,events_cmdline_opt
 
 class CustomFormatter(logging.Formatter):
     cyan = "\x1b[36;20m"
@@ -23,31 +24,52 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset
     }
 
+    def __init__(self):
+        super().__init__()
+        self.formatters = {level: logging.Formatter(fmt) for (level, fmt) in self.FORMATS.items()}
+        self.default_formatter = logging.Formatter()
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self.formatters.get(record.levelno, self.default_formatter).format(record)
 
 logger = logging.getLogger(__name__)
-log_handler = logging.StreamHandler(sys.stdout)
-log_handler.setFormatter(CustomFormatter())
-logging.getLogger().addHandler(log_handler)
 
-parser = argparse.ArgumentParser(prog=NAME, description=DESC, epilog=f'Version {VERSION}')
+def build_parser():
+    parser = argparse.ArgumentParser(prog=NAME, description=DESC, epilog=f'Version {VERSION}')
+
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    events_cmdline_opt(parser)
+
+    subparsers = parser.add_subparsers(
+        dest="subcommand",
+        help="Subcommand to run. Pass '-h' to a subcommand for more information."
+    )
 
-parser.add_argument('-v', '--verbose', action='count', default=0)
+    for (k, v) in COMMANDS.items():
+        v.setup_args(subparsers.add_parser(k))
+    return parser
 
-subparsers = parser.add_subparsers(
-    dest="subcommand",
-    help="Subcommand to run. Pass '-h' to a subcommand for more information."
-)
+"""
+    Runs the command line `argv` (default `sys.argv`). Importing this module has no side effects;
+    see `api` for calling the tool from other programs.
+"""
+def main(argv = None):
+    log_handler = logging.StreamHandler(sys.stdout)
+    log_handler.setFormatter(CustomFormatter())
+    logging.getLogger().addHandler(log_handler)
 
-for (k, v) in COMMANDS.items():
-    v.setup_args(subparsers.add_parser(k))
+    args = build_parser().parse_args(argv)
+    logging.getLogger().setLevel(logging.INFO - args.verbose * 10)
 
-args = parser.parse_args()
-logging.getLogger().setLevel(logging.INFO - args.verbose * 10)
+    assert(args.subcommand)
+    library = library_from_args(args) if 'library_path' in args else None
+    events.open(args.events, args.progress_interval, args.progress)
+    try:
+        events.begin(args.subcommand, None if library is None or library.tracks is None else len(library.tracks))
+        COMMANDS[args.subcommand].run(args, library)
+        events.end()
+    finally:
+        events.close()
 
-assert(args.subcommand)
-library = Library(paths=args.library_path) if 'library_path' in args else None
-COMMANDS[args.subcommand].run(args, library)
+if __name__ == "__main__":
+    main()
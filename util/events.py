@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 5.0
+
+def events_cmdline_opt(parser):
+    parser.add_argument(
+        '--events',
+        metavar='TARGET',
+        help="Write a JSON line for every track outcome and progress update to TARGET: a file, " \
+            "'fd:N' for an open file descriptor, or '-' for stdout"
+    )
+    parser.add_argument(
+        '--progress',
+        action='store_true',
+        help="Log the number of tracks done, throughput and time left while running"
+    )
+    parser.add_argument(
+        '--progress-interval',
+        type=float,
+        default=PROGRESS_INTERVAL,
+        metavar='SECONDS',
+        help=f"Time between progress updates (default {PROGRESS_INTERVAL})"
+    )
+
+def open_target(target):
+    if target == '-': return sys.stdout
+    if target.startswith('fd:'): return os.fdopen(int(target[3:]), 'w', encoding='utf-8', closefd=False)
+    return open(target, 'w', encoding='utf-8')
+
+"""
+    Channel for structured events of a run: an outcome per track (`track`), other events (`emit`),
+    and progress with throughput and ETA at most every `interval` seconds. Events are written as
+    JSON lines if a target was opened, and progress is logged if requested. While neither is the
+    case, every call returns right away, so commands can report unconditionally.
+"""
+class EventStream:
+    def __init__(self):
+        self.enabled = False
+        self.f = None
+        self.log_progress = False
+        self.interval = PROGRESS_INTERVAL
+        self.lock = threading.Lock()
+
+    def open(self, target = None, interval = PROGRESS_INTERVAL, log_progress = False):
+        self.f = None if target is None else open_target(target)
+        self.interval = interval
+        self.log_progress = log_progress
+        self.enabled = not self.f is None or log_progress
+    def close(self):
+        if not self.f is None:
+            if self.f is sys.stdout: self.f.flush()
+            else: self.f.close()
+        self.f = None
+        self.enabled = False
+
+    """ Starts counting tracks for `command`. `total` is the number of tracks expected, if known. """
+    def begin(self, command, total = None):
+        if not self.enabled: return
+        self.command = command
+        self.total = total
+        self.done = 0
+        self.counts = Counter()
+        self.started = time.monotonic()
+        self.next_progress = self.started + self.interval
+        self.emit('begin', command=command, total=total)
+    def end(self):
+        if not self.enabled: return
+        self.report_progress(time.monotonic(), 'end')
+
+    def emit(self, event, **fields):
+        if self.f is None: return
+        line = json.dumps({'time': round(time.time(), 3), 'event': event, **fields}, separators=(',', ':'))
+        with self.lock: self.f.write(line + '\n')
+
+    """ Records the `outcome` of a track, e.g. 'changed', 'unchanged' or 'error'. """
+    def track(self, path, outcome, **fields):
+        if not self.enabled: return
+        with self.lock:
+            self.done += 1
+            self.counts[outcome] += 1
+        self.emit('track', path=path, outcome=outcome, **fields)
+        now = time.monotonic()
+        if now >= self.next_progress:
+            self.next_progress = now + self.interval
+            self.report_progress(now)
+
+    def report_progress(self, now, event = 'progress'):
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else None
+        remaining = None if self.total is None else max(0, self.total - self.done)
+        eta = None if remaining is None or not rate else remaining / rate
+        self.emit(
+            event, done=self.done, total=self.total, elapsed=round(elapsed, 3),
+            rate=None if rate is None else round(rate, 3), eta=None if eta is None else round(eta, 1),
+            counts=dict(self.counts)
+        )
+        if self.f is sys.stdout: self.f.flush()
+        if not self.log_progress: return
+        counts = ', '.join(f'{n} {o}' for (o, n) in sorted(self.counts.items()))
+        of = '' if self.total is None else f'/{self.total}'
+        left = '' if eta is None else f', {eta:.0f}s left'
+        logger.info('%s: %d%s tracks (%s) at %.1f/s%s', self.command, self.done, of, counts or 'none', rate or 0.0, left)
+
+""" The event stream of this process """
+events = EventStream()
+
+if __name__ == "__main__":
+    import tempfile
+
+    # Nothing is counted or written until the stream is opened
+    stream = EventStream()
+    stream.begin('import', 3)
+    stream.track('/music/a.mp3', 'changed')
+    stream.end()
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'events.jsonl')
+        stream.open(path, interval=0)
+        stream.begin('import', 3)
+        stream.track('/music/a.mp3', 'changed')
+        stream.track('/music/b.mp3', 'error', error='Broken')
+        stream.emit('write', path='/music/a.mp3', outcome='in-place')
+        stream.end()
+        stream.close()
+        with open(path, 'r', encoding='utf-8') as f: lines = [json.loads(line) for line in f]
+
+    assert([line['event'] for line in lines] == ['begin', 'track', 'progress', 'track', 'progress', 'write', 'end'])
+    assert(lines[3] == {**lines[3], 'path': '/music/b.mp3', 'outcome': 'error', 'error': 'Broken'})
+    end = lines[-1]
+    assert((end['done'], end['total'], end['counts']) == (2, 3, {'changed': 1, 'error': 1}))
+    assert(not stream.enabled)
+    print('Events ok')
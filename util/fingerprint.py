@@ -0,0 +1,57 @@
+import os
+import mmap
+import struct
+import hashlib
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from udlf.formats import format_backend
+
+logger = logging.getLogger(__name__)
+
+""" Number of bytes hashed from each end of the audio data """
+FINGERPRINT_BYTES = 64 * 1024
+FINGERPRINT_WORKERS = 16
+
+"""
+    Computes a content fingerprint of a track that does not change when its tags change. Only
+    the audio data is hashed; the format backend finds where it lies between the tags.
+"""
+def fingerprint(track_location, nbytes=FINGERPRINT_BYTES):
+    h = hashlib.blake2b(digest_size=16)
+    backend = format_backend(track_location)
+    with open(track_location, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0: return h.hexdigest()
+        (start, end) = backend.audio_range(f)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as mv:
+            h.update(struct.pack('<Q', end - start))
+            if end - start <= 2 * nbytes:
+                h.update(mv[start:end])
+            else:
+                h.update(mv[start:start+nbytes])
+                h.update(mv[end-nbytes:end])
+    return h.hexdigest()
+
+def try_fingerprint(track_location):
+    try:
+        return fingerprint(track_location)
+    except Exception:
+        logger.exception(f'Could not fingerprint {track_location}')
+        return None
+
+"""
+    Fingerprints many tracks in parallel, yielding (path, fingerprint) in order. The fingerprint
+    is None if the track could not be read. Hashing releases the GIL, so threads keep the disk busy.
+"""
+def fingerprint_many(paths, workers=FINGERPRINT_WORKERS):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        window = deque()
+        for path in paths:
+            window.append((path, pool.submit(try_fingerprint, path)))
+            if len(window) >= workers * 4:
+                (p, fut) = window.popleft()
+                yield (p, fut.result())
+        while len(window):
+            (p, fut) = window.popleft()
+            yield (p, fut.result())
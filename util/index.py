@@ -0,0 +1,316 @@
+import os
+import sqlite3
+import pathlib
+import logging
+
+from udlf.trackinfo import UnknownFormatError
+from udlf.marker import resolve_markers
+from util.fingerprint import fingerprint_many,try_fingerprint
+from util.events import events
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    has_beatgrid INTEGER NOT NULL,
+    start REAL,
+    bpm REAL,
+    min_bpm REAL,
+    max_bpm REAL,
+    n_regions INTEGER NOT NULL DEFAULT 0,
+    fingerprint TEXT,
+    digest TEXT
+);
+CREATE TABLE IF NOT EXISTS regions (
+    path TEXT NOT NULL,
+    i INTEGER NOT NULL,
+    start REAL,
+    length REAL,
+    bpm REAL,
+    bpb INTEGER,
+    dbs INTEGER
+);
+CREATE TABLE IF NOT EXISTS markers (
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    position REAL,
+    length REAL,
+    name TEXT,
+    color INTEGER
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_bpm ON tracks(bpm);
+CREATE INDEX IF NOT EXISTS fingerprints_fingerprint ON fingerprints(fingerprint);
+CREATE INDEX IF NOT EXISTS regions_path ON regions(path);
+CREATE INDEX IF NOT EXISTS markers_path ON markers(path, kind);
+'''
+
+def default_index_path():
+    return pathlib.Path.home() / ".udltool" / "index.sqlite"
+
+def index_cmdline_opt(parser):
+    parser.add_argument(
+        '--index',
+        type=pathlib.Path,
+        default=default_index_path(),
+        help="Override the location of the tag index database"
+    )
+
+def color_to_int(color): return None if color is None else (color.R << 16) | (color.G << 8) | color.B
+
+"""
+    Builds the rows describing one track in the index. Returns a tuple of
+    (track row, region rows, marker rows).
+"""
+def track_rows(info, st, fp):
+    beatgrid = info.getbeatgrid()
+    regions = []
+    if beatgrid is None:
+        track = (info.track_location, st.st_size, st.st_mtime_ns, 0, None, None, None, None, 0, fp)
+    else:
+        for i, (meta, region) in enumerate(beatgrid.regions_meta()):
+            regions.append((info.track_location, i, meta.start, region.length, region.bpm, region.bpb, region.dbs))
+        bpms = [r.bpm for r in beatgrid.regions]
+        # The dominant tempo is the one covering the most time
+        bpm = max(beatgrid.regions, key=lambda r: r.length).bpm if len(bpms) else None
+        track = (
+            info.track_location, st.st_size, st.st_mtime_ns, 1, beatgrid.start, bpm,
+            min(bpms) if len(bpms) else None, max(bpms) if len(bpms) else None, len(bpms), fp
+        )
+
+    markers = []
+    for key in info:
+        if not key.startswith('markers/'): continue
+        kind = key[len('markers/'):]
+        kind_markers = info.getmarkers(kind)
+        for slot, (marker, resolved) in enumerate(zip(kind_markers, resolve_markers(kind_markers, beatgrid))):
+            if marker is None: continue
+            (position, end) = (None, None) if resolved is None else resolved
+            markers.append((
+                info.track_location, kind, slot, position,
+                None if position is None or end is None else end - position,
+                marker.name, color_to_int(marker.color)
+            ))
+    return (track, regions, markers)
+
+""" A local SQLite index of the decoded UDL data of a library, keyed by path, size and mtime. """
+class TagIndex:
+    COMMIT_EVERY = 1000
+
+    def __init__(self, path): self.path = path
+    def __enter__(self):
+        pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        logger.debug(f'Opening tag index {self.path}')
+        self.con = sqlite3.connect(self.path)
+        self.con.executescript(SCHEMA)
+        columns = [c[1] for c in self.con.execute('PRAGMA table_info(tracks)')]
+        if not 'fingerprint' in columns:
+            # Indexes created before fingerprinting need all tracks decoded again
+            self.con.execute('ALTER TABLE tracks ADD COLUMN fingerprint TEXT')
+            self.con.execute('UPDATE tracks SET size = -1')
+            columns.append('fingerprint')
+        if not 'digest' in columns:
+            self.con.execute('ALTER TABLE tracks ADD COLUMN digest TEXT')
+        return self
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None: self.con.commit()
+        self.con.close()
+
+    def remove(self, path):
+        for table in ('tracks', 'regions', 'markers'):
+            self.con.execute(f'DELETE FROM {table} WHERE path = ?', (path,))
+
+    def put(self, info, st, fp = None):
+        (track, regions, markers) = track_rows(info, st, fp)
+        self.remove(info.track_location)
+        # Only a digest that matches the data can be trusted to detect changes
+        digest = info.stored_digest()
+        if digest != info.digest(): digest = None
+        self.con.execute('INSERT INTO tracks VALUES (?,?,?,?,?,?,?,?,?,?,?)', (*track, digest))
+        self.con.executemany('INSERT INTO regions VALUES (?,?,?,?,?,?,?)', regions)
+        self.con.executemany('INSERT INTO markers VALUES (?,?,?,?,?,?,?)', markers)
+        self.put_fingerprint(info.track_location, fp)
+    """ Records a new size, mtime and fingerprint of a track whose UDL data didn't change. """
+    def touch(self, path, st, fp = None):
+        self.con.execute(
+            'UPDATE tracks SET size = ?, mtime = ?, fingerprint = ? WHERE path = ?',
+            (st.st_size, st.st_mtime_ns, fp, path)
+        )
+        self.put_fingerprint(path, fp)
+    def put_fingerprint(self, path, fp):
+        # Fingerprints are kept after a track is gone so its new location can be found
+        if not fp is None:
+            self.con.execute('INSERT OR REPLACE INTO fingerprints VALUES (?,?)', (path, fp))
+
+    """
+        Brings the index up to date with `library`. Only tracks whose size or mtime changed are
+        looked at again; of those, tracks whose saved digest still matches the indexed one are
+        only fingerprinted again, all others are decoded too. Tracks below the library paths
+        which no longer exist are dropped. Returns a tuple of (updated, unchanged, removed) counts.
+    """
+    def update(self, library):
+        known = {
+            path: (size, mtime, digest)
+            for (path, size, mtime, digest) in self.con.execute('SELECT path,size,mtime,digest FROM tracks')
+        }
+        seen = set()
+        stats = {}
+        same_data = set()
+        counts = {'updated': 0, 'unchanged': 0}
+        def changed_tracks():
+            for track_path in library.track_paths():
+                try:
+                    st = os.stat(track_path)
+                except FileNotFoundError:
+                    continue
+                seen.add(track_path)
+                (size, mtime, digest) = known.get(track_path, (None, None, None))
+                same_stamp = (size, mtime) == (st.st_size, st.st_mtime_ns)
+                if library.storage.IN_FILE and same_stamp:
+                    counts['unchanged'] += 1
+                    events.track(track_path, 'unchanged')
+                    continue
+                if not digest is None and self.read_digest(library, track_path) == digest:
+                    if same_stamp:
+                        counts['unchanged'] += 1
+                        events.track(track_path, 'unchanged')
+                        continue
+                    same_data.add(track_path)
+                stats[track_path] = st
+                yield track_path
+
+        for (track_path, fp) in fingerprint_many(changed_tracks()):
+            st = stats.pop(track_path)
+            try:
+                if track_path in same_data:
+                    self.touch(track_path, st, fp)
+                    logger.debug('UDL data of %s unchanged', track_path)
+                    counts['unchanged'] += 1
+                    events.track(track_path, 'unchanged')
+                    continue
+                self.put(library.load(track_path), st, fp)
+                logger.debug('Indexed %s', track_path)
+                counts['updated'] += 1
+                events.track(track_path, 'changed')
+                if counts['updated'] % self.COMMIT_EVERY == 0: self.con.commit()
+            except UnknownFormatError:
+                logger.debug('Unknown file format for %s; Not indexing', track_path)
+                events.track(track_path, 'unknown-format')
+            except Exception as e:
+                logger.exception(f'Could not index track {track_path}')
+                events.track(track_path, 'error', error=str(e))
+
+        removed = 0
+        for track_path in known.keys() - seen:
+            if not track_path in library: continue
+            self.remove(track_path)
+            removed += 1
+        self.con.commit()
+        return (counts['updated'], counts['unchanged'], removed)
+
+    def read_digest(self, library, track_path):
+        try:
+            return library.storage.load_digest(track_path)
+        except Exception as e:
+            logger.debug('Could not read the digest of %s: %s', track_path, e)
+            return None
+
+    def fingerprint_of(self, path):
+        row = self.con.execute('SELECT fingerprint FROM fingerprints WHERE path = ?', (path,)).fetchone()
+        return None if row is None else row[0]
+    def paths_with_fingerprint(self, fp):
+        return [p for (p,) in self.con.execute('SELECT path FROM fingerprints WHERE fingerprint = ?', (fp,))]
+
+    """
+        Returns the paths of all tracks matching the given SQL condition on the `tracks` table.
+        `where` is a list of (sql, params) conditions which are combined with AND.
+    """
+    def select(self, where = [], library = None):
+        sql = 'SELECT path FROM tracks'
+        params = []
+        if len(where):
+            sql += ' WHERE ' + ' AND '.join(f'({w})' for (w, p) in where)
+            for (w, p) in where: params += p
+        sql += ' ORDER BY path;'
+        for (path,) in self.con.execute(sql, params):
+            if library is None or path in library: yield path
+
+def matcher_cmdline_opt(parser):
+    index_cmdline_opt(parser)
+    parser.add_argument(
+        '--match-moved',
+        action='store_true',
+        help="Match tracks whose path changed by their content fingerprint, as recorded by the " \
+            "'index' subcommand"
+    )
+
+"""
+    Matches tracks which were moved or renamed using the fingerprints recorded in the tag index.
+    The index remembers the fingerprints of paths which no longer exist, so an old path can be
+    mapped to the new one and vice versa.
+"""
+class TrackMatcher:
+    def __init__(self, index): self.index = index
+    def __enter__(self):
+        self.index.__enter__()
+        return self
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.index.__exit__(exc_type, exc_value, exc_tb)
+
+    """ Finds the current location of a track that used to be at `track_location`. """
+    def relocate(self, track_location):
+        if os.path.exists(track_location): return track_location
+        fp = self.index.fingerprint_of(track_location)
+        if fp is None: return None
+        candidates = [p for p in self.index.paths_with_fingerprint(fp) if os.path.exists(p)]
+        if len(candidates) != 1: return None
+        logger.info(f'Matched moved track {track_location} to {candidates[0]}')
+        return candidates[0]
+
+    """ Finds the previous locations of the track at `track_location`. """
+    def aliases(self, track_location):
+        fp = self.index.fingerprint_of(track_location)
+        if fp is None and os.path.exists(track_location): fp = try_fingerprint(track_location)
+        if fp is None: return []
+        return [p for p in self.index.paths_with_fingerprint(fp) if p != track_location]
+
+def matcher_from_args(args):
+    # Not every command that opens an adapter offers matching
+    if not getattr(args, 'match_moved', False): return None
+    return TrackMatcher(TagIndex(args.index))
+
+if __name__ == "__main__":
+    import tempfile
+    from udlf.marker import Beatgrid,BeatgridRegion
+    from util.library import Library
+
+    with tempfile.TemporaryDirectory() as d:
+        library = Library(paths=[d])
+        for (name, bpm, fill) in [('a.mp3', 120.0, b'\x00'), ('b.mp3', 128.0, b'\x01')]:
+            path = os.path.join(d, name)
+            with open(path, 'wb') as f: f.write((b'\xff\xfb\x90\x64' + fill * 413) * 10)
+            info = library.storage.load(path)
+            info.setbeatgrid(Beatgrid(0.5, [BeatgridRegion(60.0, bpm)]))
+            info.save()
+
+        with TagIndex(os.path.join(d, 'index', 'index.sqlite')) as index:
+            assert(index.update(library) == (2, 0, 0))
+            assert(list(index.select([('bpm > ?', [125])])) == [os.path.join(d, 'b.mp3')])
+            assert(index.update(library) == (0, 2, 0))
+
+            # Moved tracks are dropped from the index, and found again by their fingerprint
+            os.rename(os.path.join(d, 'a.mp3'), os.path.join(d, 'c.mp3'))
+            assert(index.update(Library(paths=[d])) == (1, 1, 1))
+            assert(list(index.select([('bpm < ?', [125])])) == [os.path.join(d, 'c.mp3')])
+            matcher = TrackMatcher(index)
+            assert(matcher.relocate(os.path.join(d, 'a.mp3')) == os.path.join(d, 'c.mp3'))
+            assert(matcher.aliases(os.path.join(d, 'c.mp3')) == [os.path.join(d, 'a.mp3')])
+            assert(matcher.relocate(os.path.join(d, 'unknown.mp3')) is None)
+        print('Index ok')
@@ -0,0 +1,81 @@
+import os
+import struct
+import select
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger(__name__)
+
+# See inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+def libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        if name is None: raise OSError('Could not find the C library; inotify is only available on Linux')
+        _libc = ctypes.CDLL(name, use_errno=True)
+    return _libc
+
+""" A minimal inotify(7) wrapper. Events are returned as (path, name, mask) tuples. """
+class Inotify:
+    def __init__(self):
+        self.fd = libc().inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {} # Watch descriptor -> path
+    def close(self): os.close(self.fd)
+    def __enter__(self): return self
+    def __exit__(self, exc_type, exc_value, exc_tb): self.close()
+
+    def add_watch(self, path, mask):
+        wd = libc().inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.watches[wd] = path
+        return wd
+
+    """
+        Waits up to `timeout` seconds (forever if None) for events. Returns a list of
+        (directory or watched path, name, mask); name is '' for events on the watched path itself.
+        If the kernel dropped events, an event with a path of None is returned.
+    """
+    def read(self, timeout=None):
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if not ready: return []
+        buf = os.read(self.fd, 64 * 1024)
+        events = []
+        i = 0
+        while i < len(buf):
+            (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(buf, i)
+            i += EVENT_HEADER.size
+            name = os.fsdecode(buf[i:i+length].rstrip(b'\0'))
+            i += length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify event queue overflowed; Some changes may have been missed')
+                events.append((None, '', mask))
+                continue
+            path = self.watches.get(wd)
+            if mask & IN_IGNORED: self.watches.pop(wd, None)
+            if path is None: continue
+            events.append((path, name, mask))
+        return events
@@ -1,15 +1,20 @@
 import os
+import sys
 import logging
-from typing import List
+from typing import List,Optional,Tuple
 from dataclasses import dataclass
 from enum import Enum, auto
 
 from udlf.trackinfo import TrackInfo,UnknownFormatError
+from udlf.marker import Tolerance
+from util.storage import ID3Storage,storage_cmdline_opt,storage_from_args
+from util.prefetch import PREFETCH_WINDOW,prefetch_many
+from util.walk import IGNORE_FILES,PathRules,accepts_path,parse_cutoff,walk_tracks
+from util.shard import shard_of
+from util.supervise import Quarantine,Supervisor,load_track,supervise_cmdline_opt,supervisor_from_args
 
 logger = logging.getLogger(__name__)
 
-IGNORE_FILES = ['System Volume Information', '$RECYCLE.BIN', 'thumbs.db', '.DS_Store', '.Spotlight-V100']
-
 """
     This is a workaround for argparser being rather limited in its capabilities.
     See https://stackoverflow.com/a/74492728. All subcommands that want to access the library
@@ -21,6 +26,87 @@ def library_cmdline_opt(parser):
         nargs='*',
         help="Paths to search for library files. Defaults to searching the current directory"
     )
+    parser.add_argument(
+        '--track-list',
+        metavar='FILE',
+        help="Read the tracks to process from FILE (one path per line, '-' for stdin) instead " \
+            "of searching the library paths, e.g. the output of the 'query' subcommand"
+    )
+    parser.add_argument(
+        '--track-list0',
+        metavar='FILE',
+        help="Like --track-list, but paths are separated by NUL characters (e.g. 'query -0' or 'find -print0')"
+    )
+    parser.add_argument(
+        '--include',
+        action='append',
+        default=[],
+        metavar='GLOB',
+        help="Only process files matching GLOB. Globs containing a '/' are matched against the path " \
+            "relative to the library path, others against the file name. May be given more than once"
+    )
+    parser.add_argument(
+        '--exclude',
+        action='append',
+        default=[],
+        metavar='GLOB',
+        help="Skip files and directories matching GLOB (see --include). May be given more than once"
+    )
+    parser.add_argument(
+        '--changed-since',
+        type=parse_cutoff,
+        metavar='TIME',
+        help="Only process tracks modified since TIME (Unix seconds, an ISO date/time, or a file " \
+            "whose modification time is used)"
+    )
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=PREFETCH_WINDOW,
+        metavar='N',
+        help=f"Read the tags of up to N upcoming tracks in the background while scanning; helps a " \
+            f"lot on network storage (default {PREFETCH_WINDOW}, 0 to disable)"
+    )
+    storage_cmdline_opt(parser)
+    supervise_cmdline_opt(parser)
+
+def read_track_list(filename, separator='\n'):
+    f = sys.stdin.buffer if filename == '-' else open(filename, 'rb')
+    try:
+        return [os.fsdecode(p) for p in f.read().split(os.fsencode(separator)) if p.strip(b'\r\n')]
+    finally:
+        if not f is sys.stdin.buffer: f.close()
+
+def library_from_args(args):
+    if args.track_list0: tracks = read_track_list(args.track_list0, '\0')
+    elif args.track_list: tracks = [p.rstrip('\r') for p in read_track_list(args.track_list)]
+    else: tracks = None
+    library = Library(
+        paths=args.library_path, tracks=tracks, prefetch=args.prefetch,
+        rules=PathRules(args.include, args.exclude), changed_since=args.changed_since,
+        shard=getattr(args, 'shard', None), quarantine=Quarantine(args.quarantine)
+    )
+    library.storage = storage_from_args(args, library.paths)
+    library.supervisor = supervisor_from_args(args, library.quarantine)
+    return library
+
+def tolerance_cmdline_opt(parser):
+    parser.add_argument(
+        '--time-tolerance',
+        type=float,
+        default=Tolerance.time,
+        metavar='SECONDS',
+        help=f"Positions differing by at most this much are considered unchanged (default {Tolerance.time})"
+    )
+    parser.add_argument(
+        '--bpm-tolerance',
+        type=float,
+        default=Tolerance.bpm,
+        metavar='BPM',
+        help=f"Tempos differing by at most this much are considered unchanged (default {Tolerance.bpm})"
+    )
+
+def tolerance_from_args(args): return Tolerance(time=args.time_tolerance, bpm=args.bpm_tolerance)
 
 class MergeOverwriteMode(Enum):
     NEVER = auto()
@@ -30,26 +116,161 @@ class MergeOverwriteMode(Enum):
 @dataclass
 class Library:
     paths: List[str]
+    """ Explicit list of tracks; if set, the library paths are not searched """
+    tracks: Optional[List[str]]
 
-    def __init__(self, paths = []):
+    """ Number of tracks read ahead while iterating, if the storage reads the tracks themselves """
+    prefetch: int
+    """ Include/exclude rules applied when searching the library paths """
+    rules: Optional[PathRules]
+    """ Only tracks modified at or after this time (Unix seconds) are iterated """
+    changed_since: Optional[float]
+    """ (k, n): only tracks in the k-th of n hash partitions (1-based) are part of the library """
+    shard: Optional[Tuple[int, int]]
+    """ Iterated tracks are loaded lazily (see `TrackInfo.load`), for consumers that only use some keys """
+    lazy: bool
+    """ Tracks that are always skipped because they broke a worker process before """
+    quarantine: Optional[Quarantine]
+    """ If set, tracks are parsed and written in its worker processes (see `util.supervise`) """
+    supervisor: Optional[Supervisor]
+
+    def __init__(self, paths = [], tracks = None, storage = None, prefetch = 0, rules = None, changed_since = None, shard = None, lazy = False, quarantine = None, supervisor = None):
         if len(paths) == 0: paths = ['.']
         self.paths = [os.path.abspath(p) for p in paths]
+        self.storage = ID3Storage(self.paths) if storage is None else storage
+        self.tracks = None if tracks is None else [os.path.abspath(p) for p in tracks]
+        self._track_set = None if tracks is None else set(self.tracks)
+        self.prefetch = prefetch
+        self.rules = rules
+        self.changed_since = changed_since
+        self.shard = shard
+        self.lazy = lazy
+        self.quarantine = quarantine
+        self.supervisor = supervisor
+    
+    """ Tests if a track path is part of this library (without touching the file). """
+    def __contains__(self, track_path):
+        if not self.in_shard(track_path) or self.quarantined(track_path): return False
+        if not self._track_set is None: return track_path in self._track_set
+        return any(track_path == p or track_path.startswith(os.path.join(p, '')) for p in self.paths)
     
+    """
+        Tests if a track belongs to this library's shard. Tracks are keyed by their path relative
+        to the library path containing them, so hosts mounting the library elsewhere agree.
+    """
+    def in_shard(self, track_path):
+        if self.shard is None: return True
+        key = track_path
+        for p in self.paths:
+            if track_path.startswith(os.path.join(p, '')):
+                key = os.path.relpath(track_path, p)
+                break
+        return shard_of(key, self.shard[1]) == self.shard[0]
+    
+    def quarantined(self, track_path):
+        return not self.quarantine is None and track_path in self.quarantine
+
+    """ Iterates over the paths of all candidate track files without loading them. """
+    def track_paths(self):
+        if self.tracks is None:
+            for track_path in walk_tracks(self.paths, self.rules, self.changed_since):
+                if self.in_shard(track_path) and not self.quarantined(track_path): yield track_path
+            return
+        for track_path in self.tracks:
+            if not self.in_shard(track_path) or self.quarantined(track_path): continue
+            if not self.changed_since is None:
+                try:
+                    if os.stat(track_path).st_mtime < self.changed_since: continue
+                except FileNotFoundError:
+                    pass # Reported when the track is loaded
+            yield track_path
+    
+    """
+        A copy of this library holding only those of `track_paths` (e.g. the tracks an adapter
+        knows) that it would iterate itself, so they can be processed without searching the
+        library paths. Tracks that don't exist are dropped.
+    """
+    def restrict(self, track_paths):
+        def accepted(track_path):
+            if not track_path in self: return False
+            if self.tracks is None:
+                root = next(p for p in self.paths if track_path == p or track_path.startswith(os.path.join(p, '')))
+                if not accepts_path(root, track_path, self.rules): return False
+            return os.path.isfile(track_path)
+        tracks = sorted(p for p in set(map(os.path.abspath, track_paths)) if accepted(p))
+        return Library(
+            self.paths, tracks, self.storage, self.prefetch, self.rules, self.changed_since,
+            self.shard, self.lazy, self.quarantine, self.supervisor
+        )
+
+    """ Iterates over (path, prefetched file or None) of all candidate track files. """
+    def prefetched_track_paths(self):
+        if self.prefetch > 0 and self.storage.IN_FILE:
+            yield from prefetch_many(self.track_paths(), self.prefetch)
+        else:
+            for track_path in self.track_paths(): yield (track_path, None)
+
+    """
+        Iterates over (path, digest) of all candidate track files, reading nothing but the digest
+        of their UDL data (see `UDL_ID3.digest`). The digest is None if the track has none or
+        could not be read; such tracks have to be loaded to find out whether they changed.
+    """
+    def track_digests(self):
+        for (track_path, fileobj) in self.prefetched_track_paths():
+            try:
+                yield (track_path, self.storage.load_digest(track_path, fileobj))
+            except UnknownFormatError:
+                logger.error(f'Unknown file format for {track_path}')
+            except Exception as e:
+                logger.debug('Could not read the digest of %s: %s', track_path, e)
+                yield (track_path, None)
+            finally:
+                if not fileobj is None: fileobj.close()
+
+    """ Whether tracks are loaded by the supervisor's worker processes """
+    def isolated(self): return not self.supervisor is None and self.storage.IN_FILE
+
+    """ Loads a single track, in a worker process if isolated. """
+    def load(self, track_path):
+        if self.isolated(): return self.supervisor.call(track_path, load_track, track_path, self.storage)
+        return self.storage.load(track_path)
+
     def __iter__(self):
-        for path in self.paths:
-            for root, dirs, files in os.walk(path):
-                if any(root.endswith(s) for s in IGNORE_FILES): continue
-                for file in files:
-                    if file.startswith('.'): continue
-                    if any(file.endswith(s) for s in IGNORE_FILES): continue
-
-                    track_path = os.path.join(root, file)
-                    try:
-                        yield TrackInfo.load(track_path)
-                    except UnknownFormatError:
-                        logger.error(f'Unknown file format for {track_path}')
-                    except Exception as e:
-                        logger.exception(f'Could not process track {track_path}')
+        if self.isolated():
+            for (track_path, info, e) in self.supervisor.map(load_track, self.track_paths(), self.storage):
+                if isinstance(e, UnknownFormatError): logger.error(f'Unknown file format for {track_path}')
+                elif not e is None: logger.error(f'Could not process track {track_path}: {e}')
+                else: yield info
+            return
+        for (track_path, fileobj) in self.prefetched_track_paths():
+            try:
+                yield self.storage.load(track_path, fileobj, self.lazy)
+            except UnknownFormatError:
+                logger.error(f'Unknown file format for {track_path}')
+            except Exception as e:
+                logger.exception(f'Could not process track {track_path}')
+            finally:
+                if not fileobj is None: fileobj.close()
+
+"""
+    Merges the UDL data of `info` into `tosave_info` according to the overwrite `mode`. Returns the
+    raw changes made to `tosave_info` (see `UDL_ID3.rawdiff`); these are empty if the result is
+    equivalent to what was there before within `tolerance`. If `keys` is given, only those keys
+    are merged; the others are not read at all.
+"""
+def merge_track_info(tosave_info, info, mode, tolerance, keys = None):
+    # Keep a reference copy around
+    _original_info = TrackInfo(info.track_location)
+    _original_info.assign(tosave_info)
+
+    if mode == MergeOverwriteMode.CLEAR:
+        logger.debug('Clearing info on %s', info.track_location)
+        tosave_info.clear()
+    
+    tosave_info.assign(info, overwrite=mode == MergeOverwriteMode.REPLACE, keys=keys)
+
+    if tosave_info.equivalent(_original_info, tolerance): return {}
+    return _original_info.rawdiff(tosave_info)
 
 class Cancel(Exception): pass
 class CancellableUpdate:
@@ -0,0 +1,105 @@
+import os
+import errno
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+"""
+    Holds an exclusive advisory lock on `path` while the block runs, so that other udltool
+    processes (on this host or, where the file system supports it, other hosts sharing the mount)
+    wait instead of writing the same file at the same time. The lock is taken on its own file
+    descriptor, so the file may be opened and closed freely while it is held. With `create` the
+    file is created if it doesn't exist, for lock files next to the actual data.
+    Without `fcntl` (Windows) nothing is locked.
+"""
+@contextmanager
+def file_lock(path, create=False):
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT if create else os.O_RDONLY)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug(f'Waiting for the lock on {path}')
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the descriptor releases the lock
+        os.close(fd)
+
+""" Lock file of a track; hidden, so it is never taken for a track itself """
+def track_lock_path(track_location):
+    (d, name) = os.path.split(track_location)
+    return os.path.join(d, f'.{name}.udl-lock')
+
+held = threading.local()
+
+"""
+    Holds the lock of a track while its tags are read, merged and written back. The lock is taken
+    on a file next to the track rather than the track itself, since rewritten tracks replace the
+    original file (see `util.writer`) and a lock on the old file keeps no one out of the new one.
+    Taking the lock again on a thread that already holds it does nothing, so callers can hold it
+    across a load and a save that locks as well. Raises FileNotFoundError if there's no track.
+"""
+@contextmanager
+def track_lock(track_location):
+    paths = held.__dict__.setdefault('paths', set())
+    if track_location in paths:
+        yield
+        return
+    if not os.path.exists(track_location):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), track_location)
+    paths.add(track_location)
+    try:
+        with file_lock(track_lock_path(track_location), create=True): yield
+    finally:
+        paths.discard(track_location)
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'track.mp3')
+        with open(path, 'wb'): pass
+        order = []
+        def other():
+            with track_lock(path): order.append('other')
+        with track_lock(path):
+            # Taken again by the same thread, e.g. by a save within an import
+            with track_lock(path): order.append('nested')
+            thread = threading.Thread(target=other)
+            thread.start()
+            time.sleep(0.1)
+            order.append('first')
+        thread.join()
+        assert(order == ['nested', 'first', 'other'] or fcntl is None)
+        assert(sorted(os.listdir(d)) == ['.track.mp3.udl-lock', 'track.mp3'] or fcntl is None)
+
+        # The track is replaced while another thread waits for its lock; the lock still holds
+        order.clear()
+        with track_lock(path):
+            thread = threading.Thread(target=other)
+            thread.start()
+            time.sleep(0.1)
+            with open(path + '.new', 'wb'): pass
+            os.replace(path + '.new', path)
+            order.append('first')
+        thread.join()
+        assert(order == ['first', 'other'] or fcntl is None)
+
+        try:
+            with track_lock(os.path.join(d, 'missing.mp3')): assert(False)
+        except FileNotFoundError:
+            pass
+        assert(not os.path.exists(track_lock_path(os.path.join(d, 'missing.mp3'))))
+        print('Locking ok')
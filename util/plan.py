@@ -0,0 +1,64 @@
+import os
+import json
+import logging
+
+from udlf.trackinfo import file_stamp
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+def plan_cmdline_opt(parser):
+    parser.add_argument(
+        '--plan',
+        metavar='FILE',
+        help="Don't write anything; instead write the changes that would be made to FILE so they " \
+            "can be reviewed and executed later with the 'apply' subcommand"
+    )
+
+"""
+    Writes a change plan: a JSON lines file whose first line is a header describing the command
+    that made it, followed by one line per track holding its raw UDL key changes.
+"""
+class PlanWriter:
+    def __init__(self, path, **header):
+        self.path = path
+        self.header = {'version': PLAN_VERSION, **header}
+        self.count = 0
+    def __enter__(self):
+        self.f = open(self.path, 'w', encoding='utf-8')
+        self.f.write(json.dumps(self.header) + '\n')
+        return self
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.f.close()
+        logger.info(f'Planned changes to {self.count} tracks in {self.path}')
+    
+    def add(self, track_location, changes):
+        entry = {'path': track_location, 'changes': changes}
+        # Used to detect tracks that changed before the plan is applied
+        stamp = file_stamp(track_location, missing_ok=True)
+        if not stamp is None: (entry['size'], entry['mtime']) = stamp[:2]
+        self.f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.count += 1
+
+""" Reads a change plan. Returns a tuple of (header, list of entries). """
+def read_plan(path):
+    with open(path, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('version') != PLAN_VERSION:
+            raise ValueError(f"Unsupported plan version {header.get('version')} in {path}")
+        return (header, [json.loads(line) for line in f if line.strip()])
+
+""" Tests if a track was modified since its plan entry was made. """
+def is_stale(entry):
+    if not 'size' in entry: return False
+    stamp = file_stamp(entry['path'], missing_ok=True)
+    return stamp is None or stamp[:2] != (entry['size'], entry['mtime'])
+
+""" Sort key placing tracks in the same directory next to each other, in on-disk order. """
+def locality_key(entry):
+    try:
+        inode = os.stat(entry['path']).st_ino
+    except FileNotFoundError:
+        inode = 0
+    return (os.path.dirname(entry['path']), inode)
@@ -0,0 +1,152 @@
+import io
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from udlf.formats import UnknownFormatError,track_format,id3v2_size
+
+logger = logging.getLogger(__name__)
+
+""" Bytes read from the start of a track in the first request; most ID3 tags fit inside """
+HEAD_BYTES = 64 * 1024
+""" Bytes read from the end of a track, enough for an ID3v1 tag behind an APEv2 footer """
+TAIL_BYTES = 256
+PREFETCH_WINDOW = 8
+
+"""
+    A read-only file whose tag regions have already been read into memory. Reads that fall
+    completely inside the head or tail are served from memory; anything else is read from the file.
+"""
+class PrefetchedFile(io.RawIOBase):
+    def __init__(self, name, size, head, tail):
+        self.name = name
+        self.size = size
+        self.head = head
+        self.tail = tail
+        self.tail_start = size - len(tail)
+        self.pos = 0
+        self.fd = None
+    def readable(self): return True
+    def seekable(self): return True
+    def tell(self): return self.pos
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR: offset += self.pos
+        elif whence == io.SEEK_END: offset += self.size
+        if offset < 0: raise OSError(22, 'Invalid argument')
+        self.pos = offset
+        return self.pos
+    def readinto(self, b):
+        n = max(0, min(len(b), self.size - self.pos))
+        end = self.pos + n
+        if end <= len(self.head):
+            b[:n] = self.head[self.pos:end]
+        elif self.pos >= self.tail_start:
+            b[:n] = self.tail[self.pos - self.tail_start:end - self.tail_start]
+        else:
+            if self.fd is None: self.fd = os.open(self.name, os.O_RDONLY)
+            data = os.pread(self.fd, n, self.pos)
+            n = len(data)
+            b[:n] = data
+        self.pos += n
+        return n
+    def close(self):
+        if not self.fd is None: os.close(self.fd)
+        self.fd = None
+        super().close()
+
+""" Reads the tag regions of a track with as few requests as possible. """
+def prefetch(track_location):
+    track_format(track_location)
+    fd = os.open(track_location, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        head = os.pread(fd, HEAD_BYTES, 0)
+        tagsize = id3v2_size(head)
+        if tagsize > len(head): head += os.pread(fd, tagsize - len(head), len(head))
+        tail = os.pread(fd, min(TAIL_BYTES, size), size - min(TAIL_BYTES, size))
+    finally:
+        os.close(fd)
+    return PrefetchedFile(track_location, size, head, tail)
+
+def try_prefetch(track_location):
+    try:
+        return prefetch(track_location)
+    except UnknownFormatError:
+        return None
+    except Exception as e:
+        # Loading the track normally reports the error
+        logger.debug('Could not prefetch %s: %s', track_location, e)
+        return None
+
+"""
+    Yields (path, file) for each path in order while keeping up to `window` upcoming tracks
+    being read in the background, so latency of network storage overlaps instead of adding
+    up. The file is None if the track could not be prefetched.
+"""
+def prefetch_many(paths, window=PREFETCH_WINDOW):
+    with ThreadPoolExecutor(max_workers=window) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(try_prefetch, path)))
+            if len(pending) > window:
+                (p, fut) = pending.popleft()
+                yield (p, fut.result())
+        while len(pending):
+            (p, fut) = pending.popleft()
+            yield (p, fut.result())
+
+if __name__ == "__main__":
+    import tempfile
+    from mutagen.id3 import ID3,TXXX,Encoding
+
+    FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+    """ Compares reads of the prefetched file around its head, tail and end with the real data. """
+    def check(path):
+        with open(path, 'rb') as f: data = f.read()
+        f = prefetch(path)
+        size = len(data)
+        for start in (0, 1, len(f.head) - 1, len(f.head), f.tail_start - 1, f.tail_start, size - 1, size, size + 10):
+            if start < 0: continue
+            for n in (0, 1, 10, TAIL_BYTES + 1, HEAD_BYTES + 1):
+                f.seek(start)
+                assert(f.read(n) == data[start:start + n])
+                assert(f.tell() == start + len(data[start:start + n]))
+        f.seek(-1, io.SEEK_END)
+        assert(f.read() == data[-1:])
+        f.seek(0)
+        assert(f.read() == data)
+        f.close()
+        return f
+
+    with tempfile.TemporaryDirectory() as d:
+        # Larger than the head, so reads cross from the head into the file
+        path = os.path.join(d, 'long.mp3')
+        with open(path, 'wb') as f: f.write(FRAME * 200)
+        tags = ID3()
+        tags.add(TXXX(desc='a', encoding=Encoding.UTF8, text=['one']))
+        tags.save(path)
+        prefetched = check(path)
+        assert(len(prefetched.head) == HEAD_BYTES)
+
+        # Smaller than the tail, so head and tail both hold the whole file
+        path = os.path.join(d, 'short.mp3')
+        with open(path, 'wb') as f: f.write(FRAME[:TAIL_BYTES // 2])
+        prefetched = check(path)
+        assert(prefetched.head == prefetched.tail)
+
+        # An ID3v2 tag larger than the head is read as a whole
+        path = os.path.join(d, 'big-tag.mp3')
+        with open(path, 'wb') as f: f.write(FRAME * 10)
+        tags = ID3()
+        tags.add(TXXX(desc='a', encoding=Encoding.UTF8, text=['x' * 2 * HEAD_BYTES]))
+        tags.save(path)
+        with open(path, 'rb') as f: tagsize = id3v2_size(f.read(10))
+        assert(tagsize > HEAD_BYTES)
+        prefetched = check(path)
+        assert(len(prefetched.head) == tagsize)
+
+        assert(try_prefetch(os.path.join(d, 'notes.txt')) is None)
+        assert(try_prefetch(os.path.join(d, 'missing.mp3')) is None)
+    print('PrefetchedFile ok')
@@ -0,0 +1,32 @@
+import os
+import hashlib
+import argparse
+
+def parse_shard(s):
+    try:
+        (k, n) = (int(v) for v in s.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{s}'; expected K/N, e.g. 1/4")
+    if n < 1 or not 1 <= k <= n: raise argparse.ArgumentTypeError(f"Invalid shard '{s}'; K must be between 1 and N")
+    return (k, n)
+
+def shard_cmdline_opt(parser):
+    parser.add_argument(
+        '--shard',
+        type=parse_shard,
+        metavar='K/N',
+        help="Only process the K-th of N parts of the library, so N processes or hosts can split " \
+            "the work. Tracks are assigned by a hash of their path relative to the library path, " \
+            "which stays the same across hosts that mount the library elsewhere. Adapters with a " \
+            "single output file write a partial result per shard; combine them with 'merge'"
+    )
+
+""" Number (1 to n) of the shard a track belongs to. `key` is its path relative to the library path. """
+def shard_of(key, n):
+    digest = hashlib.blake2b(os.fsencode(key.replace(os.sep, '/')), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % n + 1
+
+""" Where the shard `shard` = (k, n) of a single-file output at `path` writes its partial result. """
+def shard_path(path, shard):
+    (k, n) = shard
+    return f'{path}.shard-{k}-of-{n}'
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import logging
+import numpy as np
+
+from util.index import track_rows
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+TRACK_COLUMNS = {
+    'size': np.int64,
+    'mtime': np.int64, # Nanoseconds
+    'has_beatgrid': np.bool_,
+    'start': np.float64, # NaN without a beatgrid
+    'bpm': np.float64, # Tempo of the longest region
+    'min_bpm': np.float64,
+    'max_bpm': np.float64,
+    'n_regions': np.int32
+}
+REGION_COLUMNS = {
+    'region_start': np.float64,
+    'region_length': np.float64,
+    'region_bpm': np.float64,
+    'region_bpb': np.int16,
+    'region_dbs': np.int16
+}
+MARKER_COLUMNS = {
+    'marker_kind': np.int16, # Index into `kinds`
+    'marker_slot': np.int32,
+    'marker_position': np.float64, # NaN if the marker could not be resolved
+    'marker_length': np.float64, # NaN for point markers
+    'marker_color': np.int32 # 0xRRGGBB, -1 without a color
+}
+""" Offset arrays have one more entry than there are tracks; rows of track i are [offsets[i], offsets[i+1]) """
+OFFSET_COLUMNS = ('path_offsets', 'region_offsets', 'marker_offsets')
+
+def nan_if_none(v): return np.nan if v is None else v
+
+"""
+    The decoded UDL data of a whole library as NumPy arrays, one file per column. Per-track values
+    are indexed by track number; regions and markers are flattened tables where the rows of
+    track i are `offsets[i]:offsets[i+1]`. Paths are kept as one UTF-8 blob with offsets so that
+    every column can be memory-mapped.
+"""
+class Snapshot:
+    def __init__(self, columns, kinds, meta = None):
+        self.columns = columns
+        self.kinds = kinds
+        self.meta = meta or {}
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns', {})
+        if name in columns: return columns[name]
+        raise AttributeError(name)
+    def __len__(self): return len(self.size)
+
+    @staticmethod
+    def build(library):
+        tracks = {k: [] for k in TRACK_COLUMNS}
+        regions = {k: [] for k in REGION_COLUMNS}
+        markers = {k: [] for k in MARKER_COLUMNS}
+        paths = bytearray()
+        offsets = {k: [0] for k in OFFSET_COLUMNS}
+        kinds = {}
+        for info in library:
+            try:
+                st = os.stat(info.track_location)
+                (track, region_rows, marker_rows) = track_rows(info, st, None)
+            except Exception:
+                logger.exception(f'Could not process track {info.track_location}')
+                continue
+            (_, size, mtime, has_beatgrid, start, bpm, min_bpm, max_bpm, n_regions, _) = track
+            for (k, v) in zip(TRACK_COLUMNS, (size, mtime, has_beatgrid, start, bpm, min_bpm, max_bpm, n_regions)):
+                tracks[k].append(nan_if_none(v))
+            for (_, i, rstart, length, rbpm, bpb, dbs) in region_rows:
+                for (k, v) in zip(REGION_COLUMNS, (rstart, length, rbpm, bpb, dbs)):
+                    regions[k].append(nan_if_none(v))
+            for (_, kind, slot, position, length, name, color) in marker_rows:
+                kind = kinds.setdefault(kind, len(kinds))
+                for (k, v) in zip(MARKER_COLUMNS, (kind, slot, position, length, -1 if color is None else color)):
+                    markers[k].append(nan_if_none(v))
+            paths += os.fsencode(info.track_location)
+            offsets['path_offsets'].append(len(paths))
+            offsets['region_offsets'].append(len(regions['region_start']))
+            offsets['marker_offsets'].append(len(markers['marker_kind']))
+
+        columns = {'paths': np.frombuffer(bytes(paths), dtype=np.uint8)}
+        for (types, values) in ((TRACK_COLUMNS, tracks), (REGION_COLUMNS, regions), (MARKER_COLUMNS, markers)):
+            for (k, t) in types.items(): columns[k] = np.array(values[k], dtype=t)
+        for k in OFFSET_COLUMNS: columns[k] = np.array(offsets[k], dtype=np.int64)
+        return Snapshot(
+            columns, [k for (k, i) in sorted(kinds.items(), key=lambda e: e[1])],
+            {'created': time.time(), 'library_paths': library.paths}
+        )
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for (k, v) in self.columns.items(): np.save(os.path.join(directory, f'{k}.npy'), v)
+        with open(os.path.join(directory, 'snapshot.json'), 'w', encoding='utf-8') as f:
+            json.dump({**self.meta, 'version': SNAPSHOT_VERSION, 'kinds': self.kinds, 'tracks': len(self)}, f)
+
+    """ Loads a snapshot. The columns are memory-mapped unless `mmap` is False. """
+    @staticmethod
+    def load(directory, mmap = True):
+        with open(os.path.join(directory, 'snapshot.json'), encoding='utf-8') as f: meta = json.load(f)
+        if meta.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f'Unsupported snapshot version {meta.get("version")}')
+        names = ['paths', *TRACK_COLUMNS, *REGION_COLUMNS, *MARKER_COLUMNS, *OFFSET_COLUMNS]
+        columns = {
+            k: np.load(os.path.join(directory, f'{k}.npy'), mmap_mode='r' if mmap else None)
+            for k in names
+        }
+        return Snapshot(columns, meta.pop('kinds'), meta)
+
+    def path(self, i):
+        return os.fsdecode(bytes(self.paths[self.path_offsets[i]:self.path_offsets[i+1]]))
+    """ Returns the paths of the tracks selected by a boolean mask or index array. """
+    def paths_of(self, selection):
+        return [self.path(i) for i in np.arange(len(self))[selection]]
+
+    """ Track number of every region and marker row, for grouping them by track. """
+    def region_track(self): return np.repeat(np.arange(len(self)), np.diff(self.region_offsets))
+    def marker_track(self): return np.repeat(np.arange(len(self)), np.diff(self.marker_offsets))
+    """ Number of markers of a kind on each track. """
+    def marker_counts(self, kind):
+        if not kind in self.kinds: return np.zeros(len(self), dtype=np.int64)
+        mask = self.marker_kind == self.kinds.index(kind)
+        return np.bincount(self.marker_track()[mask], minlength=len(self))
+
+    """ Library-wide statistics. `start_tolerance` is how far from 0 a grid may start to count as starting at 0. """
+    def stats(self, start_tolerance = 1e-3):
+        gridded = self.has_beatgrid
+        bpm = self.bpm[gridded & ~np.isnan(self.bpm)]
+        stats = {
+            'tracks': len(self),
+            'with_beatgrid': int(np.count_nonzero(gridded)),
+            'variable_tempo': int(np.count_nonzero(self.n_regions > 1)),
+            'grid_start_off_zero': int(np.count_nonzero(gridded & (np.abs(self.start) > start_tolerance))),
+            'bpm': None if not len(bpm) else {
+                'min': float(bpm.min()), 'max': float(bpm.max()),
+                'mean': float(bpm.mean()), 'median': float(np.median(bpm)),
+                'histogram': {
+                    f'{int(lo)}-{int(lo) + 10}': int(n)
+                    for (lo, n) in zip(*np.unique(np.floor(bpm / 10) * 10, return_counts=True))
+                }
+            },
+            'markers': {}
+        }
+        for kind in self.kinds:
+            counts = self.marker_counts(kind)
+            stats['markers'][kind] = {
+                'total': int(counts.sum()),
+                'tracks_with': int(np.count_nonzero(counts)),
+                'mean_per_track': float(counts.mean()) if len(self) else 0.0,
+                'unresolved': int(np.count_nonzero(
+                    (self.marker_kind == self.kinds.index(kind)) & np.isnan(self.marker_position)
+                ))
+            }
+        return stats
@@ -0,0 +1,230 @@
+import os
+import json
+import sqlite3
+import logging
+from mutagen.id3 import ID3,TXXX,Encoding
+
+from udlf.id3 import PREFIX,DIGEST_KEY
+from udlf.trackinfo import TrackInfo,track_format
+from udlf.formats import LazyTXXX
+from util.fingerprint import fingerprint
+from util.lock import track_lock
+from util.writer import durable_write
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_NAME = ".udl.sqlite"
+
+SIDECAR_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    identity TEXT,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS tags (
+    path TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (path, key)
+);
+CREATE INDEX IF NOT EXISTS tracks_size ON tracks(size);
+'''
+
+""" Stores UDL data inside each track's own tags. This is the default. """
+class ID3Storage:
+    NAME = 'id3'
+    IN_FILE = True # Changes to the data show up in the track's size and mtime
+    def __init__(self, library_paths): pass
+    def __enter__(self): return self
+    def __exit__(self, exc_type, exc_value, exc_tb): pass
+
+    def load(self, track_location, fileobj = None, lazy = False):
+        info = TrackInfo.load(track_location, fileobj, lazy)
+        # Saved through `save` so that it holds the track's lock
+        info.storage = self
+        return info
+    def load_digest(self, track_location, fileobj = None): return TrackInfo.load_digest(track_location, fileobj)
+    def save(self, info, write = None):
+        # Saves made outside a TagWriter must not leave the track half rewritten either
+        if write is None: write = durable_write
+        # Other threads and processes (e.g. other shards) may be writing the same track
+        with track_lock(info.track_location):
+            if isinstance(info.storage, ID3Storage):
+                info.write_tags(write)
+                return
+            # Infos from other storages are written to the track itself
+            tags = TrackInfo.load(info.track_location)
+            tags.clear()
+            tags.assign(info, overwrite=True)
+            tags.write_tags(write)
+
+"""
+    A single sidecar database holding the UDL data of all tracks below its directory. Paths are
+    stored relative to that directory so the library can be moved as a whole.
+"""
+class SidecarDB:
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(path)
+        logger.debug(f'Opening sidecar database {path}')
+        self.con = sqlite3.connect(path)
+        columns = [c[1] for c in self.con.execute('PRAGMA table_info(tracks)')]
+        if len(columns) and not 'size' in columns:
+            self.con.execute('ALTER TABLE tracks ADD COLUMN size INTEGER')
+        self.con.executescript(SIDECAR_SCHEMA)
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+    def relpath(self, track_location): return os.path.relpath(track_location, self.root)
+
+    """
+        Finds the stored path of a track, falling back to a moved track with the same content.
+        Only tracks with a matching size are fingerprinted.
+    """
+    def find(self, track_location):
+        rel = self.relpath(track_location)
+        if not self.con.execute('SELECT 1 FROM tracks WHERE path = ?', (rel,)).fetchone() is None:
+            return rel
+        candidates = [
+            (p, identity) for (p, identity) in self.con.execute(
+                'SELECT path,identity FROM tracks WHERE size = ?', (os.stat(track_location).st_size,)
+            ) if not os.path.exists(os.path.join(self.root, p))
+        ]
+        if not len(candidates): return None
+        fp = fingerprint(track_location)
+        candidates = [p for (p, identity) in candidates if identity == fp]
+        if len(candidates) == 1:
+            logger.info(f'Found sidecar data of moved track {candidates[0]} for {track_location}')
+            return candidates[0]
+        return None
+
+    def read(self, track_location):
+        rel = self.find(track_location)
+        if rel is None: return {}
+        return {
+            key: json.loads(value)
+            for (key, value) in self.con.execute('SELECT key,value FROM tags WHERE path = ?', (rel,))
+        }
+    def read_keys(self, track_location):
+        rel = self.find(track_location)
+        if rel is None: return []
+        return [key for (key,) in self.con.execute('SELECT key FROM tags WHERE path = ?', (rel,))]
+    def read_key(self, track_location, key):
+        rel = self.find(track_location)
+        if rel is None: return None
+        row = self.con.execute('SELECT value FROM tags WHERE path = ? AND key = ?', (rel, key)).fetchone()
+        return None if row is None else json.loads(row[0])
+    def write(self, track_location, tags):
+        old = self.find(track_location)
+        if not old is None: self.delete(old)
+        rel = self.relpath(track_location)
+        if not len(tags): return
+        self.con.execute(
+            'INSERT INTO tracks VALUES (?,?,?)',
+            (rel, fingerprint(track_location), os.stat(track_location).st_size)
+        )
+        self.con.executemany(
+            'INSERT INTO tags VALUES (?,?,?)',
+            [(rel, key, json.dumps(value)) for (key, value) in tags.items()]
+        )
+    def delete(self, rel):
+        self.con.execute('DELETE FROM tracks WHERE path = ?', (rel,))
+        self.con.execute('DELETE FROM tags WHERE path = ?', (rel,))
+
+"""
+    Stores UDL data in a sidecar database per library root instead of in the tracks, so neither
+    reading nor writing has to open the audio files. The database of a track is the closest
+    existing one in its parent directories; if there is none, one is created in the library
+    path the track belongs to. Use as a context manager to make all writes a single transaction.
+"""
+class SidecarStorage:
+    NAME = 'sidecar'
+    IN_FILE = False
+    def __init__(self, library_paths, db_path = None):
+        self.library_paths = [os.path.abspath(p) for p in library_paths]
+        self.db_path = None if db_path is None else os.path.abspath(db_path)
+        self.dbs = {} # Database path -> SidecarDB
+        self.dir_dbs = {} # Directory -> database path
+        self.in_transaction = False
+    def __enter__(self):
+        self.in_transaction = True
+        return self
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.in_transaction = False
+        for db in self.dbs.values(): db.close()
+        self.dbs = {}
+
+    def db_for(self, track_location):
+        if not self.db_path is None: return self.open_db(self.db_path)
+        directory = os.path.dirname(track_location)
+        if not directory in self.dir_dbs:
+            self.dir_dbs[directory] = self.locate_db(directory, track_location)
+        return self.open_db(self.dir_dbs[directory])
+    def locate_db(self, directory, track_location):
+        d = directory
+        while True:
+            if os.path.exists(os.path.join(d, SIDECAR_NAME)): return os.path.join(d, SIDECAR_NAME)
+            parent = os.path.dirname(d)
+            if parent == d: break
+            d = parent
+        roots = [
+            p for p in self.library_paths
+            if os.path.isdir(p) and track_location.startswith(os.path.join(p, ''))
+        ]
+        return os.path.join(max(roots, key=len) if len(roots) else directory, SIDECAR_NAME)
+    def open_db(self, path):
+        if not path in self.dbs: self.dbs[path] = SidecarDB(path)
+        return self.dbs[path]
+
+    """ With `lazy`, only the keys are read; values are read when they are first accessed. """
+    def load(self, track_location, fileobj = None, lazy = False):
+        track_format(track_location)
+        if not os.path.exists(track_location): raise FileNotFoundError(track_location)
+        tags = ID3()
+        db = self.db_for(track_location)
+        if lazy:
+            for key in db.read_keys(track_location):
+                tags.add(LazyTXXX(
+                    desc=f'{PREFIX}{key}', encoding=Encoding.UTF8,
+                    load=lambda key=key: db.read_key(track_location, key) or []
+                ))
+        else:
+            for (key, text) in db.read(track_location).items():
+                tags.add(TXXX(desc=f'{PREFIX}{key}', encoding=Encoding.UTF8, text=text))
+        return TrackInfo(track_location, tags, storage=self)
+    def load_digest(self, track_location, fileobj = None):
+        track_format(track_location)
+        if not os.path.exists(track_location): raise FileNotFoundError(track_location)
+        text = self.db_for(track_location).read_key(track_location, DIGEST_KEY)
+        return text[0] if text else None
+    def save(self, info, write = None):
+        db = self.db_for(info.track_location)
+        tags = {t.desc[len(PREFIX):]: list(t.text) for t in info.tags()}
+        if len(tags): tags[DIGEST_KEY] = [info.digest()]
+        db.write(info.track_location, tags)
+        if not self.in_transaction: db.con.commit()
+
+STORAGES = {
+    'id3': ID3Storage,
+    'sidecar': SidecarStorage
+}
+
+def storage_cmdline_opt(parser):
+    parser.add_argument(
+        '--storage',
+        choices=STORAGES,
+        default='id3',
+        help=f"Where UDL data is kept: id3 (default) stores it in each track's tags; sidecar " \
+            f"stores it in a '{SIDECAR_NAME}' database in the library root"
+    )
+    parser.add_argument(
+        '--sidecar-db',
+        metavar='FILE',
+        help="Use a single sidecar database at FILE instead of one per library root"
+    )
+
+def storage_from_args(args, library_paths, name = None):
+    name = name or args.storage
+    if name == SidecarStorage.NAME: return SidecarStorage(library_paths, args.sidecar_db)
+    return STORAGES[name](library_paths)
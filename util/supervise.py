@@ -0,0 +1,260 @@
+import os
+import sys
+import queue
+import atexit
+import logging
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+FILE_TIMEOUT = 30
+FILE_MEMORY = 1024
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def default_quarantine_path(): return os.path.join(os.path.expanduser('~'), '.udltool', 'quarantine.txt')
+
+def supervise_cmdline_opt(parser):
+    parser.add_argument(
+        '--isolate',
+        action='store_true',
+        help="Parse and write tracks in supervised worker processes. A track that takes longer " \
+            "than --file-timeout or more memory than --file-memory gets its worker killed and " \
+            "restarted, and is quarantined"
+    )
+    parser.add_argument(
+        '--isolate-jobs',
+        type=int,
+        default=os.cpu_count(),
+        metavar='N',
+        help=f"Number of worker processes used with --isolate (default {os.cpu_count()})"
+    )
+    parser.add_argument(
+        '--file-timeout',
+        type=float,
+        default=FILE_TIMEOUT,
+        metavar='SECONDS',
+        help=f"Time a worker may spend on a single track (default {FILE_TIMEOUT})"
+    )
+    parser.add_argument(
+        '--file-memory',
+        type=int,
+        default=FILE_MEMORY,
+        metavar='MB',
+        help=f"Memory a worker may use (default {FILE_MEMORY})"
+    )
+    parser.add_argument(
+        '--quarantine',
+        default=default_quarantine_path(),
+        metavar='FILE',
+        help=f"List of quarantined tracks, which are always skipped; remove lines from it to try " \
+            f"them again (default {default_quarantine_path()})"
+    )
+
+"""
+    Tracks that broke a worker, one per line as the path followed by a tab and the reason. The
+    file is only created once the first track is quarantined.
+"""
+class Quarantine:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.paths = set()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    p = line.rstrip('\r\n').split('\t', 1)[0]
+                    if p: self.paths.add(p)
+        except FileNotFoundError:
+            pass
+        if len(self.paths): logger.info(f'Skipping {len(self.paths)} quarantined tracks listed in {path}')
+    def __contains__(self, track_path): return track_path in self.paths
+    def add(self, track_path, reason):
+        logger.error(f'Quarantined {track_path}: {reason}')
+        with self.lock:
+            if track_path in self.paths: return
+            self.paths.add(track_path)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f: f.write(f'{track_path}\t{reason}\n')
+
+class WorkerFailed(Exception): pass
+
+""" A worker process, started with `python -m util.supervise` and talking over a pipe. """
+class Worker:
+    def __init__(self, memory):
+        (self.conn, child) = Pipe()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'util.supervise', str(child.fileno()), str(memory)],
+            pass_fds=[child.fileno()], env=env
+        )
+        child.close()
+    def kill(self):
+        self.conn.close()
+        if self.process.poll() is None: self.process.kill()
+        self.process.wait()
+    def close(self):
+        self.conn.close()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.kill()
+
+    """ Runs `func(*args)`, raising WorkerFailed if it doesn't finish in time or the worker died. """
+    def call(self, func, args, timeout):
+        self.conn.send((func, args))
+        if not self.conn.poll(timeout): raise WorkerFailed(f'Took longer than {timeout}s')
+        try:
+            (ok, value) = self.conn.recv()
+        except (EOFError, OSError):
+            self.process.wait()
+            raise WorkerFailed(f'Worker died with exit code {self.process.returncode}')
+        if ok: return value
+        if isinstance(value, MemoryError): raise WorkerFailed('Ran out of memory')
+        raise value
+
+"""
+    Runs functions on tracks in a pool of `jobs` worker processes, each limited to `memory` MB.
+    A call that takes longer than `timeout` seconds, runs out of memory or crashes its worker
+    gets the worker replaced and the track added to `quarantine`; other exceptions are passed on
+    to the caller. Workers are started on first use and stopped by `close` or at exit.
+"""
+class Supervisor:
+    def __init__(self, jobs = os.cpu_count(), timeout = FILE_TIMEOUT, memory = FILE_MEMORY, quarantine = None):
+        self.jobs = max(1, jobs or 1)
+        self.timeout = timeout
+        self.memory = memory
+        self.quarantine = quarantine
+        self.idle = queue.Queue()
+        self.started = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def worker(self):
+        with self.lock:
+            if self.started < self.jobs and self.idle.empty():
+                if self.started == 0: atexit.register(self.close)
+                self.started += 1
+                return Worker(self.memory)
+        return self.idle.get()
+
+    """ Runs `func(*args)` in a worker process on behalf of the track `track_path`. """
+    def call(self, track_path, func, *args):
+        worker = self.worker()
+        try:
+            result = worker.call(func, args, self.timeout)
+        except WorkerFailed as e:
+            worker.kill()
+            worker = Worker(self.memory)
+            if not self.quarantine is None: self.quarantine.add(track_path, str(e))
+            raise WorkerFailed(f'{track_path}: {e}')
+        finally:
+            self.idle.put(worker)
+        return result
+
+    """
+        Yields (path, result, exception) for `func(path, *args)` on each path in order, with up
+        to twice as many calls in flight as there are workers.
+    """
+    def map(self, func, paths, *args):
+        def run(path):
+            try:
+                return (path, self.call(path, func, path, *args), None)
+            except Exception as e:
+                return (path, None, e)
+        window = 2 * self.jobs
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            pending = deque()
+            for path in paths:
+                pending.append(pool.submit(run, path))
+                if len(pending) > window: yield pending.popleft().result()
+            while len(pending): yield pending.popleft().result()
+
+    def close(self):
+        with self.lock:
+            if self.closed: return
+            self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+def supervisor_from_args(args, quarantine):
+    if not args.isolate: return None
+    return Supervisor(args.isolate_jobs, args.file_timeout, args.file_memory, quarantine)
+
+""" Worker entry point: loads a track in a worker process (eagerly, as lazy frames can't be sent back). """
+def load_track(track_location, storage):
+    return storage.load(track_location)
+
+def worker_main(fd, memory):
+    if not resource is None and memory > 0:
+        limit = memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    conn = Connection(fd)
+    while True:
+        try:
+            (func, args) = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = (True, func(*args))
+        except BaseException as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # The exception (or result) could not be pickled
+            conn.send((False, RuntimeError(f'{type(e).__name__}: {e}')))
+
+if __name__ == "__main__" and len(sys.argv) == 3:
+    worker_main(int(sys.argv[1]), int(sys.argv[2]))
+elif __name__ == "__main__":
+    import time
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as d:
+        quarantine = Quarantine(os.path.join(d, 'quarantine.txt'))
+        supervisor = Supervisor(jobs=1, timeout=1, memory=256, quarantine=quarantine)
+        assert(supervisor.call('/music/a.mp3', os.getpid) != os.getpid())
+        # Exceptions of the function are passed on, and leave the worker running
+        try:
+            supervisor.call('/music/a.mp3', int, 'x')
+            assert(False)
+        except ValueError:
+            pass
+        assert(not '/music/a.mp3' in quarantine)
+
+        # A track that takes too long gets its worker replaced and is quarantined
+        try:
+            supervisor.call('/music/slow.mp3', time.sleep, 5)
+            assert(False)
+        except WorkerFailed:
+            pass
+        assert('/music/slow.mp3' in quarantine)
+        # So does one that crashes its worker
+        try:
+            supervisor.call('/music/crash.mp3', os._exit, 1)
+            assert(False)
+        except WorkerFailed:
+            pass
+        assert('/music/crash.mp3' in quarantine)
+        assert(supervisor.call('/music/b.mp3', abs, -1) == 1)
+
+        # The list is read back by the next run
+        assert(set(Quarantine(quarantine.path).paths) == {'/music/slow.mp3', '/music/crash.mp3'})
+        results = list(supervisor.map(divmod, [7, 8], 2))
+        assert(results == [(7, (3, 1), None), (8, (4, 0), None)])
+        supervisor.close()
+        print('Supervisor ok')
@@ -0,0 +1,205 @@
+import json
+import math
+import logging
+from contextlib import nullcontext
+from typing import List,Optional
+from concurrent.futures import ProcessPoolExecutor
+
+from udlf.dictify import undictify
+from udlf.marker import Beatgrid,Marker,Tolerance,resolve_markers
+from udlf.trackinfo import TrackInfo,UnknownFormatError
+from util.storage import ID3Storage
+from util.lock import track_lock
+
+logger = logging.getLogger(__name__)
+
+""" Tracks handed to a worker process at once """
+CHUNK_SIZE = 64
+
+ERROR = 'error'
+WARNING = 'warning'
+
+""" Length of a track in seconds, or None if it can't be determined. """
+def track_duration(track_location):
+    try:
+        import mutagen
+        f = mutagen.File(track_location)
+        return None if f is None or f.info is None else f.info.length
+    except Exception:
+        return None
+
+"""
+    Decodes the raw text of a key the way `UDL_ID3` does, but raising instead of returning None.
+    Also returns whether the text looks like several frames merged into one: Mutagen joins the
+    texts of TXXX frames with the same description when reading a tag, and only lists with a
+    single element carry a '' filler, so a longer list holding one was merged.
+"""
+def decode_raw(text):
+    if len(text) > 1:
+        merged = len(text) > 2 and '' in text
+        return ([json.loads(t) for t in text if t], merged)
+    return (json.loads(text[0]), False)
+
+"""
+    Checks the UDL data of a track. Returns a list of issues, each a dict of the affected `key`,
+    the `check` that failed, its `severity` and a `message`, and a copy of the data rewritten in
+    canonical form (normalized beatgrid, re-encoded markers, one frame per key) as far as it
+    could be decoded. `duration` is the track length in seconds if known.
+"""
+def check_track(info, duration=None, tol=Tolerance()):
+    issues = []
+    def issue(key, check, message, severity=ERROR):
+        issues.append({'key': key, 'check': check, 'severity': severity, 'message': message})
+    fixed = TrackInfo(info.track_location)
+    fixed.assign(info)
+
+    keys = sorted(set(info.keys()))
+    seen = {}
+    for key in keys:
+        if key.lower() in seen:
+            issue(key, 'duplicate-frame', f"Frames for both '{seen[key.lower()]}' and '{key}'")
+        seen.setdefault(key.lower(), key)
+
+    values = {}
+    for key in keys:
+        text = info.getraw(key)[0]
+        try:
+            (value, merged) = decode_raw(text)
+        except (ValueError, IndexError) as e:
+            issue(key, 'undecodable', f'Invalid JSON: {e}')
+            continue
+        if merged:
+            issue(key, 'duplicate-frame', 'Holds the values of several frames')
+        values[key] = value
+
+    beatgrid = None
+    if 'beatgrid' in values:
+        value = values['beatgrid']
+        if isinstance(value, list) and len(value) and isinstance(value[0], dict):
+            # Merged duplicate frames; the first one is kept on repair
+            if not 'beatgrid' in [i['key'] for i in issues]:
+                issue('beatgrid', 'duplicate-frame', 'Holds the values of several frames')
+            value = value[0]
+        try:
+            beatgrid = undictify(Beatgrid, value)
+        except Exception as e:
+            issue('beatgrid', 'invalid-beatgrid', str(e))
+    if not beatgrid is None:
+        for (i, region) in enumerate(beatgrid.regions):
+            if not region.length > 0:
+                issue('beatgrid', 'region-length', f'Region {i} has length {region.length}')
+            if not (region.bpm > 0 and math.isfinite(region.bpm)):
+                issue('beatgrid', 'region-bpm', f'Region {i} has tempo {region.bpm}')
+            if region.bpb < 1:
+                issue('beatgrid', 'region-bpb', f'Region {i} has {region.bpb} beats per bar')
+        if not duration is None and beatgrid.start > duration + tol.time:
+            issue('beatgrid', 'beatgrid-outside-track', f'Starts at {beatgrid.start:.3f}s, after the end of the track ({duration:.3f}s)')
+        # Normalizing also drops zero-length regions
+        (normalized, error) = beatgrid.normalize(tol)
+        fixed.setbeatgrid(normalized, tol, normalize=False)
+        if fixed.getraw('beatgrid') != info.getraw('beatgrid') and not any(i['key'] == 'beatgrid' for i in issues):
+            issue('beatgrid', 'not-normalized', f'Not in normalized form (beats move by up to {error:.6f}s)', WARNING)
+
+    for key in keys:
+        if not key.startswith('markers/') or not key in values: continue
+        name = key[len('markers/'):]
+        try:
+            markers = undictify(List[Optional[Marker]], values[key] if isinstance(values[key], list) else [values[key]])
+        except Exception as e:
+            issue(key, 'invalid-markers', str(e))
+            continue
+        for (i, (marker, resolved)) in enumerate(zip(markers, resolve_markers(markers, beatgrid))):
+            if marker is None: continue
+            if resolved is None:
+                issue(key, 'marker-unresolved', f'Marker {i} can not be placed on the beatgrid')
+                continue
+            (start, end) = (resolved[0], resolved[0] if resolved[1] is None else resolved[1])
+            if start < -tol.time or (not duration is None and end > duration + tol.time):
+                issue(key, 'marker-outside-track', f'Marker {i} at {start:.3f}s is outside the track')
+        if not any(i['key'] == key and i['check'] == 'duplicate-frame' for i in issues):
+            fixed.setmarkers(name, markers)
+
+    return (issues, fixed)
+
+"""
+    Verifies one track and returns its report entry, or None if there is nothing to report and
+    `report_all` is False. With `repair`, the canonical form of the data is written back if it
+    differs; data that can't be decoded is never touched.
+"""
+def verify_info(info, storage, repair=False, tol=Tolerance(), report_all=False):
+    uses_duration = any(k == 'beatgrid' or k.startswith('markers/') for k in info.keys())
+    duration = track_duration(info.track_location) if uses_duration else None
+    (issues, fixed) = check_track(info, duration, tol)
+    entry = {'path': info.track_location, 'issues': issues}
+    changes = info.rawdiff(fixed)
+    if repair and len(changes):
+        info.applyraw(changes)
+        storage.save(info)
+        entry['repaired'] = sorted(changes)
+    if not len(issues) and not 'repaired' in entry and not report_all: return None
+    return entry
+
+""" Worker entry point: verifies a track stored in its own file. """
+def verify_path(track_location, repair=False, tol=Tolerance(), report_all=False):
+    try:
+        # A repair must not undo what was written between loading and saving the track
+        with track_lock(track_location) if repair else nullcontext():
+            storage = ID3Storage(None)
+            return verify_info(storage.load(track_location), storage, repair, tol, report_all)
+    except UnknownFormatError:
+        return {'path': track_location, 'error': 'Unknown file format'}
+    except Exception as e:
+        return {'path': track_location, 'error': f'{type(e).__name__}: {e}'}
+def verify_path_args(path_args): return verify_path(path_args[0], *path_args[1])
+
+"""
+    Verifies all tracks of a library, yielding report entries in library order. Tracks stored in
+    their own files are checked by `jobs` worker processes; other storages are read in this process.
+"""
+def verify_library(library, jobs=None, repair=False, tol=Tolerance(), report_all=False):
+    if not library.storage.IN_FILE:
+        for info in library:
+            try:
+                entry = verify_info(info, library.storage, repair, tol, report_all)
+            except Exception as e:
+                entry = {'path': info.track_location, 'error': f'{type(e).__name__}: {e}'}
+            if not entry is None: yield entry
+        return
+    args = (repair, tol, report_all)
+    if jobs == 1:
+        results = (verify_path(p, *args) for p in library.track_paths())
+        yield from (e for e in results if not e is None)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(verify_path_args, ((p, args) for p in library.track_paths()), chunksize=CHUNK_SIZE)
+        yield from (e for e in results if not e is None)
+
+if __name__ == "__main__":
+    from udlf.marker import BeatgridRegion,TimedMarker
+
+    def checks(info, duration=None): return sorted((i['key'], i['check'], i['severity']) for i in check_track(info, duration)[0])
+
+    info = TrackInfo('/music/a.mp3')
+    info.setbeatgrid(Beatgrid(0.5, [BeatgridRegion(10.0, 120.0)]))
+    info.sethotcues([TimedMarker(1.0, name='Drop'), None])
+    assert(checks(info, 60.0) == [])
+
+    # Data that can be rewritten in canonical form is only warned about, and repaired
+    info.setbeatgrid(Beatgrid(0.5, [BeatgridRegion(10.0, 120.0), BeatgridRegion(10.0, 120.0)]), normalize=False)
+    assert(checks(info, 60.0) == [('beatgrid', 'not-normalized', WARNING)])
+    (_, fixed) = check_track(info, 60.0)
+    assert(len(fixed.getbeatgrid().regions) == 1)
+    assert(checks(fixed, 60.0) == [])
+
+    info.sethotcues([TimedMarker(90.0, name='Late')])
+    info.setraw('comment', [['{not json']])
+    assert(checks(info, 60.0) == [
+        ('beatgrid', 'not-normalized', WARNING), ('comment', 'undecodable', ERROR),
+        ('markers/hotcue', 'marker-outside-track', ERROR)
+    ])
+    # Without the duration, markers can't be outside the track
+    assert(checks(info) == [('beatgrid', 'not-normalized', WARNING), ('comment', 'undecodable', ERROR)])
+
+    info.setbeatgrid(Beatgrid(0.5, [BeatgridRegion(10.0, -1.0)]), normalize=False)
+    assert(('beatgrid', 'region-bpm', ERROR) in checks(info))
+    print('Checks ok')
@@ -0,0 +1,162 @@
+import os
+import re
+import fnmatch
+import logging
+from datetime import datetime
+
+from udlf.trackinfo import FORMATS
+
+logger = logging.getLogger(__name__)
+
+IGNORE_FILES = ['System Volume Information', '$RECYCLE.BIN', 'thumbs.db', '.DS_Store', '.Spotlight-V100']
+
+def is_ignored_dir(name): return any(name.endswith(s) for s in IGNORE_FILES)
+def is_ignored_file(name): return name.startswith('.') or any(name.endswith(s) for s in IGNORE_FILES)
+def has_track_extension(name, formats=FORMATS): return name.rsplit('.', 1)[-1].lower() in formats
+
+def compile_globs(globs):
+    if not len(globs): return None
+    return re.compile('|'.join(f'(?:{fnmatch.translate(g)})' for g in globs))
+
+"""
+    Include and exclude glob rules. Globs containing a '/' are matched against the path relative
+    to the library path, all others against the file or directory name. Excluded directories are
+    not descended into. If there are include rules, only files matching one of them are kept.
+"""
+class PathRules:
+    def __init__(self, include=[], exclude=[]):
+        self.include_name = compile_globs([g for g in include if not '/' in g])
+        self.include_path = compile_globs([g for g in include if '/' in g])
+        self.exclude_name = compile_globs([g for g in exclude if not '/' in g])
+        self.exclude_path = compile_globs([g for g in exclude if '/' in g])
+        self.has_include = len(include) > 0
+
+    def excluded(self, rel, name):
+        return (not self.exclude_name is None and not self.exclude_name.match(name) is None) or \
+            (not self.exclude_path is None and not self.exclude_path.match(rel) is None)
+    def included(self, rel, name):
+        if not self.has_include: return True
+        return (not self.include_name is None and not self.include_name.match(name) is None) or \
+            (not self.include_path is None and not self.include_path.match(rel) is None)
+    def accepts(self, rel, name): return self.included(rel, name) and not self.excluded(rel, name)
+
+"""
+    Parses a --changed-since cutoff: Unix seconds, an ISO 8601 date/time, or the path of a file
+    whose modification time is used. Returns Unix seconds.
+"""
+def parse_cutoff(s):
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(s).timestamp()
+    except ValueError:
+        pass
+    if os.path.exists(s): return os.stat(s).st_mtime
+    raise ValueError(f"Invalid time '{s}'; expected Unix seconds, an ISO date/time or an existing file")
+
+"""
+    Tests if `walk_tracks` would yield the file `track_path` when searching `root` with `rules`,
+    without reading any directories: no directory on the way is ignored or excluded, and the file
+    itself passes the name, extension and include/exclude checks.
+"""
+def accepts_path(root, track_path, rules=None, formats=FORMATS):
+    if track_path == root: return True
+    parts = os.path.relpath(track_path, root).split(os.sep)
+    for (i, name) in enumerate(parts[:-1]):
+        if is_ignored_dir(name): return False
+        if not rules is None and rules.excluded('/'.join(parts[:i + 1]), name): return False
+    name = parts[-1]
+    if is_ignored_file(name) or not has_track_extension(name, formats): return False
+    return rules is None or rules.accepts('/'.join(parts), name)
+
+"""
+    Yields the track files below `roots`, which may also be files themselves. Directories are read
+    with `os.scandir`, ignored and excluded directories are pruned before descending, and files
+    are filtered by extension and `rules` before anything else touches them. Each file and
+    directory is visited once even if roots overlap or symlinks form loops. If `changed_since` is
+    given, only files modified at or after that time (Unix seconds) are yielded.
+"""
+def walk_tracks(roots, rules=None, changed_since=None, formats=FORMATS):
+    seen_files = set()
+    seen_dirs = set()
+    def wanted(st):
+        return changed_since is None or st.st_mtime >= changed_since
+    for root in roots:
+        if os.path.isfile(root):
+            st = os.stat(root)
+            if not (st.st_dev, st.st_ino) in seen_files and wanted(st):
+                seen_files.add((st.st_dev, st.st_ino))
+                yield root
+            continue
+        stack = [(root, '')]
+        while len(stack):
+            (d, reldir) = stack.pop()
+            try:
+                st = os.stat(d)
+                if (st.st_dev, st.st_ino) in seen_dirs: continue
+                seen_dirs.add((st.st_dev, st.st_ino))
+                with os.scandir(d) as it: entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                logger.warning(f'Could not read directory {d}: {e}')
+                continue
+            subdirs = []
+            for entry in entries:
+                rel = reldir + entry.name
+                try:
+                    if entry.is_dir():
+                        if is_ignored_dir(entry.name): continue
+                        if not rules is None and rules.excluded(rel, entry.name): continue
+                        subdirs.append((entry.path, rel + '/'))
+                        continue
+                    if not entry.is_file(): continue
+                    if is_ignored_file(entry.name) or not has_track_extension(entry.name, formats): continue
+                    if not rules is None and not rules.accepts(rel, entry.name): continue
+                    # Symlinks may point anywhere; everything else shares the directory's device
+                    if entry.is_symlink() or not changed_since is None:
+                        est = entry.stat()
+                        key = (est.st_dev, est.st_ino)
+                        if not wanted(est): continue
+                    else:
+                        key = (st.st_dev, entry.inode())
+                except OSError as e:
+                    logger.warning(f'Could not read {entry.path}: {e}')
+                    continue
+                if key in seen_files: continue
+                seen_files.add(key)
+                yield entry.path
+            stack.extend(reversed(subdirs))
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as root:
+        files = [
+            'a.mp3', 'b.FLAC', 'notes.txt', '.a.mp3.udl-lock', '.a.mp3.udl-tmp',
+            'sets/c.mp3', 'sets/old/d.wav', 'skip/e.mp3', '$RECYCLE.BIN/f.mp3', 'sets/thumbs.db'
+        ]
+        for f in files:
+            path = os.path.join(root, *f.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb'): pass
+        os.utime(os.path.join(root, 'sets', 'old', 'd.wav'), (0, 0))
+        # A loop and a second route to the same directory are walked once
+        os.symlink(root, os.path.join(root, 'sets', 'loop'))
+
+        def walked(*args, **kwargs): return sorted(os.path.relpath(p, root) for p in walk_tracks([root], *args, **kwargs))
+        assert(walked() == ['a.mp3', 'b.FLAC', 'sets/c.mp3', 'sets/old/d.wav', 'skip/e.mp3'])
+        assert(walked(PathRules(exclude=['skip', 'old/*'])) == ['a.mp3', 'b.FLAC', 'sets/c.mp3', 'sets/old/d.wav'])
+        assert(walked(PathRules(exclude=['skip', 'sets/old'])) == ['a.mp3', 'b.FLAC', 'sets/c.mp3'])
+        assert(walked(PathRules(include=['*.mp3'], exclude=['skip'])) == ['a.mp3', 'sets/c.mp3'])
+        assert(walked(changed_since=time.time() - 3600) == ['a.mp3', 'b.FLAC', 'sets/c.mp3', 'skip/e.mp3'])
+        assert(walked(formats=('wav',)) == ['sets/old/d.wav'])
+
+        # accepts_path agrees with the walk for every file
+        for rules in [None, PathRules(exclude=['skip', 'old/*']), PathRules(include=['sets/*'], exclude=['old'])]:
+            expected = walked(rules)
+            for f in files:
+                accepted = accepts_path(root, os.path.join(root, *f.split('/')), rules)
+                assert(accepted == (f in expected))
+        print('Walking ok')
@@ -0,0 +1,285 @@
+import os
+import shutil
+import logging
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor,wait
+
+from udlf.trackinfo import format_backend,file_stamp
+from util.events import events
+from util.lock import track_lock
+from util.supervise import load_track
+
+logger = logging.getLogger(__name__)
+
+def writer_cmdline_opt(parser):
+    parser.add_argument(
+        '--write-jobs',
+        type=int,
+        default=4,
+        metavar='N',
+        help="Number of tracks written at the same time (default 4)"
+    )
+    parser.add_argument(
+        '--no-fsync',
+        action='store_true',
+        help="Don't wait for written tracks to reach the disk"
+    )
+
+""" Where a track is rewritten before it replaces the original """
+def temp_path(track_location):
+    (d, name) = os.path.split(track_location)
+    return os.path.join(d, f'.{name}.udl-tmp')
+
+def fsync_path(path):
+    # Directories can't be opened for syncing everywhere (e.g. on Windows)
+    flags = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) if os.path.isdir(path) else os.O_RDONLY
+    try:
+        fd = os.open(path, flags)
+    except OSError as e:
+        logger.debug(f'Could not open {path} to sync it: {e}')
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        logger.debug(f'Could not sync {path}: {e}')
+    finally:
+        os.close(fd)
+
+"""
+    Writes tags so that a crash never leaves a track half rewritten. If the new tags fit where
+    the old ones were, the track is overwritten in place and the audio is never moved. Otherwise
+    a copy is written next to it and renamed over the original. Returns True if it was written
+    in place.
+"""
+def atomic_write(track_location, tags, sync = True):
+    backend = format_backend(track_location)
+    if hasattr(backend, 'fits_in_place') and backend.fits_in_place(track_location, tags):
+        backend.save(track_location, tags)
+        return True
+    tmp = temp_path(track_location)
+    try:
+        shutil.copyfile(track_location, tmp)
+        st = os.stat(track_location)
+        shutil.copymode(track_location, tmp)
+        try:
+            os.chown(tmp, st.st_uid, st.st_gid)
+        except (OSError, AttributeError):
+            pass
+        backend.save(tmp, tags)
+        # The data has to be on disk before the rename is
+        if sync: fsync_path(tmp)
+        os.replace(tmp, track_location)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    return False
+
+""" Writes tags with `atomic_write` and waits until they are on disk. For saves outside a `TagWriter`. """
+def durable_write(track_location, tags):
+    in_place = atomic_write(track_location, tags)
+    # A replaced track is only durable once its directory entry is
+    fsync_path(track_location if in_place else os.path.dirname(track_location))
+
+"""
+    Saves tracks in the background with at most `jobs` writes running and at most twice as many
+    waiting. Every track is written with `atomic_write` while holding its lock (see
+    `util.lock.track_lock`); instead of syncing each write on its own, the written tracks and the
+    directories of replaced tracks are synced once when the writer is flushed. Leaving the
+    writer flushes it and logs the outcome, so everything submitted is written (or reported as
+    failed) before the command exits. With a `supervisor`, the tags are written (and tracks
+    loaded again) by its worker processes (see `util.supervise`).
+"""
+class TagWriter:
+    def __init__(self, jobs = 4, sync = True, supervisor = None):
+        self.jobs = max(1, jobs)
+        self.sync = sync
+        self.supervisor = supervisor
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(2 * self.jobs)
+        self.pending = {} # Track path -> (info, changes, stamp) waiting to be written
+        self.queued = {} # Track path -> future of its last submitted save
+        self.futures = set()
+        self.unsynced = set() # Tracks and directories to sync on flush
+        self.counts = {'in_place': 0, 'replaced': 0, 'stored': 0, 'merged': 0, 'failed': 0}
+        self.results = {} # Track path -> None if its last save succeeded, else the exception
+    def __enter__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        return self
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+        c = self.counts
+        # Saves to storages outside the tracks (e.g. the sidecar) are neither in place nor replaced
+        stored = f"{c['stored']} stored outside the tracks, " if c['stored'] else ''
+        message = f"Wrote {c['in_place'] + c['replaced'] + c['stored']} tracks ({c['in_place']} in place, " \
+            f"{c['replaced']} replaced, {stored}{c['merged']} saves merged)"
+        if c['failed']: logger.warning(f"{message}; {c['failed']} could not be written")
+        else: logger.info(message)
+
+    """
+        Saves `info` in the background. Blocks while too many saves are waiting.
+
+        `changes` are the changes (see `rawdiff`) made to `info` since it was loaded from its
+        storage, and `stamp` the `file_stamp` of the track taken before it was loaded. If the
+        track was written by anyone else by the time the save runs, it is loaded again and only
+        `changes` are applied to it, and changes to a track whose save is still waiting are
+        merged into that save. Without `changes`, `info` replaces the track's data as a whole and
+        is only queued once earlier saves of the track are done. Callers must not hold the
+        track's lock, which the save takes.
+    """
+    def submit(self, info, changes = None, stamp = None):
+        if not info.storage is None and not info.storage.IN_FILE:
+            # Other storages aren't safe to use from other threads
+            self.write_info(info)
+            return
+        path = info.track_location
+        while True:
+            with self.lock:
+                if path in self.pending and not changes is None:
+                    (pending_info, pending_changes, _) = self.pending[path]
+                    pending_info.applyraw(changes)
+                    if not pending_changes is None: pending_changes.update(changes)
+                    self.counts['merged'] += 1
+                    return
+                future = self.queued.get(path)
+                if future is None or future.done() or not changes is None:
+                    self.pending[path] = (info, changes, stamp)
+                    future = self.executor.submit(self.run, path)
+                    self.queued[path] = future
+                    self.futures.add(future)
+                    break
+            wait([future])
+        future.add_done_callback(lambda f: self.done(path, f))
+        self.slots.acquire()
+    def done(self, track_location, future):
+        with self.lock:
+            self.futures.discard(future)
+            if self.queued.get(track_location) is future: del self.queued[track_location]
+        self.slots.release()
+
+    def run(self, track_location):
+        with self.lock: (info, changes, stamp) = self.pending.pop(track_location)
+        self.write_info(info, changes, stamp)
+    def write_info(self, info, changes = None, stamp = None):
+        in_file = info.storage is None or info.storage.IN_FILE
+        try:
+            with track_lock(info.track_location) if in_file else nullcontext():
+                if not changes is None and file_stamp(info.track_location) != stamp:
+                    logger.debug('%s was written since it was loaded; Loading it again...', info.track_location)
+                    info = self.reload(info)
+                    info.applyraw(changes)
+                info.save(self.write)
+            logger.info('Wrote to %s', info.track_location)
+            with self.lock:
+                self.results[info.track_location] = None
+                if not in_file: self.counts['stored'] += 1
+            if not in_file: events.emit('write', path=info.track_location, outcome='stored')
+        except Exception as e:
+            logger.exception(f'Could not write {info.track_location}')
+            with self.lock:
+                self.counts['failed'] += 1
+                self.results[info.track_location] = e
+            events.emit('write', path=info.track_location, outcome='failed')
+    def reload(self, info):
+        if self.supervisor is None: return info.storage.load(info.track_location)
+        return self.supervisor.call(info.track_location, load_track, info.track_location, info.storage)
+    def write(self, track_location, tags):
+        if self.supervisor is None:
+            in_place = atomic_write(track_location, tags, self.sync)
+        else:
+            try:
+                in_place = self.supervisor.call(track_location, atomic_write, track_location, tags, self.sync)
+            finally:
+                # Left behind if the worker was killed while rewriting the track
+                tmp = temp_path(track_location)
+                if os.path.exists(tmp): os.remove(tmp)
+        with self.lock:
+            self.counts['in_place' if in_place else 'replaced'] += 1
+            self.unsynced.add(track_location if in_place else os.path.dirname(track_location))
+        events.emit('write', path=track_location, outcome='in-place' if in_place else 'replaced')
+
+    """ Waits for all submitted saves and syncs what they wrote. """
+    def flush(self):
+        while True:
+            with self.lock: futures = set(self.futures)
+            if not len(futures): break
+            wait(futures)
+        with self.lock: (paths, self.unsynced) = (self.unsynced, set())
+        if not self.sync: return
+        # Files before their directories
+        for path in sorted(paths, key=lambda p: (os.path.isdir(p), p)): fsync_path(path)
+        logger.debug(f'Synced {len(paths)} tracks and directories')
+
+if __name__ == "__main__":
+    import tempfile
+    from mutagen.id3 import ID3
+    from udlf.formats import MP3Format
+    from udlf.id3 import UDL_ID3
+    from udlf.trackinfo import TrackInfo
+    from util.storage import ID3Storage,SidecarStorage
+
+    def tags_with(**values):
+        tags = UDL_ID3(ID3())
+        for (key, value) in values.items(): tags[key] = value
+        return tags.id3tags
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'track.mp3')
+        with open(path, 'wb') as f: f.write((b'\xff\xfb\x90\x64' + b'\x00' * 413) * 10)
+        assert(not atomic_write(path, tags_with(a='one'))) # No tag to overwrite yet
+        assert(atomic_write(path, tags_with(a='two')))
+        assert(TrackInfo.load(path)['a'] == 'two')
+
+        # A write that fails half way leaves the track as it was, and no temporary copy
+        with open(path, 'rb') as f: original = f.read()
+        def failing_save(track_location, tags):
+            with open(track_location, 'r+b') as f: f.write(b'garbage')
+            raise OSError('Disk full')
+        (save, MP3Format.save) = (MP3Format.save, staticmethod(failing_save))
+        try:
+            atomic_write(path, tags_with(a='x' * 100000))
+            assert(False)
+        except OSError:
+            pass
+        finally:
+            MP3Format.save = save
+        with open(path, 'rb') as f: assert(f.read() == original)
+        assert(not os.path.exists(temp_path(path)))
+        print('atomic_write ok')
+
+        # Changes to a track that is still waiting to be written are merged into its save, and
+        # are applied again if the track was written by someone else since it was loaded
+        storage = ID3Storage([d])
+        logging.disable(logging.CRITICAL) # The missing track fails on purpose
+        with TagWriter(1) as writer:
+            # Keeps the only write job busy until everything was submitted
+            busy = threading.Event()
+            writer.executor.submit(busy.wait)
+            for (key, value) in [('b', 'one'), ('c', 'one'), ('a', 'three')]:
+                stamp = file_stamp(path)
+                info = storage.load(path)
+                before = storage.load(path)
+                info[key] = value
+                writer.submit(info, before.rawdiff(info), stamp)
+            other = storage.load(path)
+            other['d'] = 'other'
+            other.save()
+            writer.submit(TrackInfo(os.path.join(d, 'missing.mp3')))
+            busy.set()
+        logging.disable(logging.NOTSET)
+        assert(writer.counts['merged'] == 2)
+        info = storage.load(path)
+        assert((info['a'], info['b'], info['c'], info['d']) == ('three', 'one', 'one', 'other'))
+        assert(writer.results[path] is None)
+        assert(isinstance(writer.results[os.path.join(d, 'missing.mp3')], FileNotFoundError))
+
+        # Saves to the sidecar are counted although they never reach `write`
+        with SidecarStorage([d]) as sidecar, TagWriter(1) as writer:
+            info = sidecar.load(path)
+            info['a'] = 'sidecar'
+            writer.submit(info)
+        assert(writer.counts['stored'] == 1)
+        print('TagWriter ok')